@@ -1,4 +1,10 @@
 from brukva.client import Connection, Client
-from brukva.exceptions import RedisError, ConnectionError, ResponseError, InvalidResponse
+from brukva.pool import ConnectionPool
+from brukva.sharding import ShardedClient
+from brukva.replication import ReplicatedClient
+from brukva.cluster import ClusterClient
+from brukva.cache import CachedClient, KeyspaceInvalidator
+from brukva.bulk import BulkWriter
+from brukva.exceptions import RedisError, ConnectionError, TimeoutError, ResponseError, InvalidResponse, WatchError
 from brukva import adisp
 
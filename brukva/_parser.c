@@ -0,0 +1,548 @@
+/*
+ * C implementation of brukva.parser.Reader.
+ *
+ * Same interface and semantics as the pure-Python reader: raw data is fed
+ * with feed(), complete replies are taken out with gets(), which returns
+ * False while no whole reply is buffered, drain() takes out the data not
+ * parsed yet. Error replies are returned as
+ * brukva.exceptions.ResponseError instances, protocol errors raise
+ * brukva.exceptions.InvalidResponse.
+ *
+ * With lazy_threshold set, multibulk replies of at least that many bulk
+ * strings come out as brukva.parser.MultiBulkView instances. The reply stays
+ * in the buffer until all of it is there, its elements are scanned as they
+ * arrive and it is copied out once.
+ */
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <string.h>
+
+#define READER_INITIAL_BUFFER 16384
+#define READER_INITIAL_STACK 8
+
+typedef struct {
+    PyObject *list;
+    Py_ssize_t length;
+    Py_ssize_t filled;
+} ReaderTask;
+
+typedef struct {
+    PyObject_HEAD
+    char *buf;
+    Py_ssize_t pos;
+    Py_ssize_t len;
+    Py_ssize_t size;
+    ReaderTask *stack;
+    Py_ssize_t depth;
+    Py_ssize_t stack_size;
+    Py_ssize_t lazy_threshold;          /* -1 without views */
+    /* the view being read: its elements, those scanned, their offsets and
+     * lengths in the data following the header (at pos), and the offset
+     * of the next one; view_length is -1 between views */
+    Py_ssize_t view_length;
+    Py_ssize_t view_filled;
+    Py_ssize_t view_size;
+    Py_ssize_t view_at;
+    long *offsets;
+    long *lengths;
+} Reader;
+
+static PyObject *ResponseError = NULL;
+static PyObject *InvalidResponse = NULL;
+static PyObject *MultiBulkView = NULL;
+static PyObject *array = NULL;
+
+static int
+Reader_init(Reader *self, PyObject *args, PyObject *kwargs)
+{
+    static char *kwlist[] = {"lazy_threshold", NULL};
+    PyObject *threshold = Py_None;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "|O", kwlist, &threshold))
+        return -1;
+    self->lazy_threshold = -1;
+    self->view_length = -1;
+    if (threshold != Py_None) {
+        self->lazy_threshold = PyNumber_AsSsize_t(threshold, PyExc_OverflowError);
+        if (self->lazy_threshold == -1 && PyErr_Occurred())
+            return -1;
+        if (self->lazy_threshold < 0) {
+            PyErr_SetString(PyExc_ValueError, "lazy_threshold must not be negative");
+            return -1;
+        }
+    }
+    return 0;
+}
+
+static void
+end_view(Reader *self)
+{
+    PyMem_Free(self->offsets);
+    PyMem_Free(self->lengths);
+    self->offsets = self->lengths = NULL;
+    self->view_length = -1;
+    self->view_size = 0;
+}
+
+static void
+Reader_dealloc(Reader *self)
+{
+    Py_ssize_t i;
+    for (i = 0; i < self->depth; i++)
+        Py_DECREF(self->stack[i].list);
+    end_view(self);
+    PyMem_Free(self->stack);
+    PyMem_Free(self->buf);
+    Py_TYPE(self)->tp_free((PyObject *)self);
+}
+
+static PyObject *
+Reader_feed(Reader *self, PyObject *args)
+{
+    const char *data;
+    Py_ssize_t length, unread, needed;
+
+    if (!PyArg_ParseTuple(args, "s#", &data, &length))
+        return NULL;
+    if (length == 0)
+        Py_RETURN_NONE;
+
+    unread = self->len - self->pos;
+    needed = unread + length;
+    if (self->pos && self->len + length > self->size) {
+        /* reclaim the consumed head before growing */
+        memmove(self->buf, self->buf + self->pos, unread);
+        self->pos = 0;
+        self->len = unread;
+    }
+    if (self->len + length > self->size) {
+        Py_ssize_t size = self->size ? self->size : READER_INITIAL_BUFFER;
+        char *buf;
+        while (size < needed)
+            size *= 2;
+        buf = PyMem_Realloc(self->buf, size);
+        if (buf == NULL)
+            return PyErr_NoMemory();
+        self->buf = buf;
+        self->size = size;
+    }
+    memcpy(self->buf + self->len, data, length);
+    self->len += length;
+    Py_RETURN_NONE;
+}
+
+/* Returns offset of "\r\n" starting at pos, or -1 when there is none yet. */
+static Py_ssize_t
+find_crlf(const char *buf, Py_ssize_t pos, Py_ssize_t len)
+{
+    const char *start = buf + pos, *p = start, *end = buf + len;
+    while (p < end - 1) {
+        p = memchr(p, '\r', end - p - 1);
+        if (p == NULL)
+            return -1;
+        if (p[1] == '\n')
+            return p - buf;
+        p++;
+    }
+    return -1;
+}
+
+static int
+parse_integer(const char *p, Py_ssize_t len, long long *value)
+{
+    long long v = 0;
+    int negative = 0;
+    Py_ssize_t i = 0;
+
+    if (len > 0 && p[0] == '-') {
+        negative = 1;
+        i = 1;
+    }
+    if (i == len)
+        return -1;
+    for (; i < len; i++) {
+        if (p[i] < '0' || p[i] > '9')
+            return -1;
+        v = v * 10 + (p[i] - '0');
+    }
+    *value = negative ? -v : v;
+    return 0;
+}
+
+static PyObject *
+protocol_error(const char *message, char byte)
+{
+    PyErr_Format(InvalidResponse, message, byte);
+    return NULL;
+}
+
+static PyObject *
+make_error(const char *p, Py_ssize_t len)
+{
+    PyObject *message, *error;
+
+    if (len >= 3 && memcmp(p, "ERR", 3) == 0) {
+        Py_ssize_t skip = len >= 4 ? 4 : 3;
+        p += skip;
+        len -= skip;
+    }
+    message = PyString_FromStringAndSize(p, len);
+    if (message == NULL)
+        return NULL;
+    error = PyObject_CallFunction(ResponseError, "OO", message, Py_None);
+    Py_DECREF(message);
+    return error;
+}
+
+static int
+push_task(Reader *self, Py_ssize_t length)
+{
+    PyObject *list;
+
+    if (self->depth == self->stack_size) {
+        Py_ssize_t size = self->stack_size ? self->stack_size * 2 : READER_INITIAL_STACK;
+        ReaderTask *stack = PyMem_Realloc(self->stack, size * sizeof(ReaderTask));
+        if (stack == NULL) {
+            PyErr_NoMemory();
+            return -1;
+        }
+        self->stack = stack;
+        self->stack_size = size;
+    }
+    list = PyList_New(length);
+    if (list == NULL)
+        return -1;
+    self->stack[self->depth].list = list;
+    self->stack[self->depth].length = length;
+    self->stack[self->depth].filled = 0;
+    self->depth++;
+    return 0;
+}
+
+/* An array('l') of the first n longs of values. */
+static PyObject *
+make_array(long *values, Py_ssize_t n)
+{
+    PyObject *result, *ok;
+
+    result = PyObject_CallFunction(array, "s", "l");
+    if (result == NULL)
+        return NULL;
+    ok = PyObject_CallMethod(result, "fromstring", "s#", (char *)values, n * (Py_ssize_t)sizeof(long));
+    if (ok == NULL) {
+        Py_DECREF(result);
+        return NULL;
+    }
+    Py_DECREF(ok);
+    return result;
+}
+
+static PyObject *
+make_view(Reader *self)
+{
+    PyObject *data, *offsets = NULL, *lengths = NULL, *view = NULL;
+
+    data = PyString_FromStringAndSize(self->buf + self->pos, self->view_at);
+    if (data == NULL)
+        return NULL;
+    offsets = make_array(self->offsets, self->view_filled);
+    if (offsets != NULL)
+        lengths = make_array(self->lengths, self->view_filled);
+    if (lengths != NULL)
+        view = PyObject_CallFunctionObjArgs(MultiBulkView, data, offsets, lengths, NULL);
+    Py_DECREF(data);
+    Py_XDECREF(offsets);
+    Py_XDECREF(lengths);
+    return view;
+}
+
+#define VIEW_ERROR -1
+#define VIEW_INCOMPLETE 0
+#define VIEW_DONE 1
+#define VIEW_PLAIN 2
+
+/* Scans the elements of the view buffered since the last call. Sets reply
+ * once all of them are there, returns VIEW_PLAIN when an element is no bulk
+ * string, the reply is then read as usual from pos on. */
+static int
+gets_view(Reader *self, PyObject **reply)
+{
+    const char *buf = self->buf + self->pos;
+    Py_ssize_t len = self->len - self->pos, at = self->view_at, end;
+    long long size;
+
+    while (self->view_filled < self->view_length) {
+        end = find_crlf(buf, at, len);
+        if (end == -1)
+            break;
+        if (buf[at] != '$') {
+            Py_ssize_t length = self->view_length;
+            end_view(self);
+            if (push_task(self, length) < 0)
+                return VIEW_ERROR;
+            return VIEW_PLAIN;
+        }
+        if (parse_integer(buf + at + 1, end - at - 1, &size) < 0) {
+            protocol_error("Protocol error, bad bulk length after %c", '$');
+            return VIEW_ERROR;
+        }
+        if (size >= 0 && end + 2 + size + 2 > len)
+            break;
+        if (self->view_filled == self->view_size) {
+            Py_ssize_t grown = self->view_size ? self->view_size * 2 : 1024;
+            long *offsets, *lengths;
+            if (grown > self->view_length)
+                grown = self->view_length;
+            offsets = PyMem_Realloc(self->offsets, grown * sizeof(long));
+            if (offsets != NULL)
+                self->offsets = offsets;
+            lengths = PyMem_Realloc(self->lengths, grown * sizeof(long));
+            if (lengths != NULL)
+                self->lengths = lengths;
+            if (offsets == NULL || lengths == NULL) {
+                PyErr_NoMemory();
+                return VIEW_ERROR;
+            }
+            self->view_size = grown;
+        }
+        if (size < 0) {
+            self->offsets[self->view_filled] = 0;
+            self->lengths[self->view_filled] = -1;
+            at = end + 2;
+        } else {
+            self->offsets[self->view_filled] = (long)(end + 2);
+            self->lengths[self->view_filled] = (long)size;
+            at = end + 2 + size + 2;
+        }
+        self->view_filled++;
+    }
+    self->view_at = at;
+    if (self->view_filled < self->view_length)
+        return VIEW_INCOMPLETE;
+    *reply = make_view(self);
+    if (*reply == NULL)
+        return VIEW_ERROR;
+    self->pos += at;
+    if (self->pos == self->len)
+        self->pos = self->len = 0;
+    end_view(self);
+    return VIEW_DONE;
+}
+
+static PyObject *
+Reader_gets(Reader *self)
+{
+    const char *buf = self->buf;
+    Py_ssize_t pos = self->pos, end;
+    long long length;
+    PyObject *reply;
+
+    if (self->view_length != -1) {
+        switch (gets_view(self, &reply)) {
+        case VIEW_ERROR:
+            return NULL;
+        case VIEW_INCOMPLETE:
+            Py_RETURN_FALSE;
+        case VIEW_DONE:
+            return reply;
+        }
+    }
+
+    for (;;) {
+        if (pos >= self->len)
+            break;
+        end = find_crlf(buf, pos, self->len);
+        if (end == -1)
+            break;
+
+        switch (buf[pos]) {
+        case '$':
+            if (parse_integer(buf + pos + 1, end - pos - 1, &length) < 0)
+                return protocol_error("Protocol error, bad bulk length after %c", '$');
+            if (length < 0) {
+                Py_INCREF(Py_None);
+                reply = Py_None;
+                pos = end + 2;
+            } else {
+                if (end + 2 + length + 2 > self->len)
+                    goto incomplete;
+                reply = PyString_FromStringAndSize(buf + end + 2, (Py_ssize_t)length);
+                pos = end + 2 + length + 2;
+            }
+            break;
+        case '*':
+            if (parse_integer(buf + pos + 1, end - pos - 1, &length) < 0)
+                return protocol_error("Protocol error, bad multibulk length after %c", '*');
+            pos = end + 2;
+            if (self->lazy_threshold != -1 && length > 0 && length >= self->lazy_threshold
+                && self->depth == 0) {
+                self->pos = pos;
+                self->view_length = (Py_ssize_t)length;
+                self->view_filled = 0;
+                self->view_at = 0;
+                switch (gets_view(self, &reply)) {
+                case VIEW_ERROR:
+                    return NULL;
+                case VIEW_INCOMPLETE:
+                    Py_RETURN_FALSE;
+                case VIEW_DONE:
+                    return reply;
+                }
+                continue;
+            }
+            if (length < 0) {
+                Py_INCREF(Py_None);
+                reply = Py_None;
+            } else if (length == 0) {
+                reply = PyList_New(0);
+            } else {
+                if (push_task(self, (Py_ssize_t)length) < 0)
+                    return NULL;
+                continue;
+            }
+            break;
+        case '+':
+            reply = PyString_FromStringAndSize(buf + pos + 1, end - pos - 1);
+            pos = end + 2;
+            break;
+        case ':':
+            if (parse_integer(buf + pos + 1, end - pos - 1, &length) < 0)
+                return protocol_error("Protocol error, bad integer after %c", ':');
+            if (length >= LONG_MIN && length <= LONG_MAX)
+                reply = PyInt_FromLong((long)length);
+            else
+                reply = PyLong_FromLongLong(length);
+            pos = end + 2;
+            break;
+        case '-':
+            reply = make_error(buf + pos + 1, end - pos - 1);
+            pos = end + 2;
+            break;
+        default:
+            return protocol_error("Protocol error, unknown reply type byte '%c'", buf[pos]);
+        }
+
+        if (reply == NULL)
+            return NULL;
+        self->pos = pos;
+
+        while (self->depth > 0) {
+            ReaderTask *task = &self->stack[self->depth - 1];
+            PyList_SET_ITEM(task->list, task->filled, reply);
+            task->filled++;
+            if (task->filled < task->length)
+                break;
+            reply = task->list;
+            self->depth--;
+        }
+        if (self->depth == 0) {
+            if (self->pos == self->len)
+                self->pos = self->len = 0;
+            return reply;
+        }
+    }
+
+incomplete:
+    self->pos = pos;
+    if (self->pos == self->len)
+        self->pos = self->len = 0;
+    Py_RETURN_FALSE;
+}
+
+static PyObject *
+Reader_drain(Reader *self)
+{
+    PyObject *data;
+
+    data = PyString_FromStringAndSize(self->buf + self->pos, self->len - self->pos);
+    if (data == NULL)
+        return NULL;
+    self->pos = self->len = 0;
+    end_view(self);
+    return data;
+}
+
+static PyMethodDef Reader_methods[] = {
+    {"feed", (PyCFunction)Reader_feed, METH_VARARGS, "Feed raw data to the reader."},
+    {"gets", (PyCFunction)Reader_gets, METH_NOARGS, "Return the next complete reply, or False."},
+    {"drain", (PyCFunction)Reader_drain, METH_NOARGS, "Take out the data not parsed yet."},
+    {NULL}
+};
+
+static PyTypeObject ReaderType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "brukva._parser.Reader",            /* tp_name */
+    sizeof(Reader),                     /* tp_basicsize */
+    0,                                  /* tp_itemsize */
+    (destructor)Reader_dealloc,         /* tp_dealloc */
+    0,                                  /* tp_print */
+    0,                                  /* tp_getattr */
+    0,                                  /* tp_setattr */
+    0,                                  /* tp_compare */
+    0,                                  /* tp_repr */
+    0,                                  /* tp_as_number */
+    0,                                  /* tp_as_sequence */
+    0,                                  /* tp_as_mapping */
+    0,                                  /* tp_hash */
+    0,                                  /* tp_call */
+    0,                                  /* tp_str */
+    0,                                  /* tp_getattro */
+    0,                                  /* tp_setattro */
+    0,                                  /* tp_as_buffer */
+    Py_TPFLAGS_DEFAULT,                 /* tp_flags */
+    "Incremental parser of redis replies", /* tp_doc */
+    0,                                  /* tp_traverse */
+    0,                                  /* tp_clear */
+    0,                                  /* tp_richcompare */
+    0,                                  /* tp_weaklistoffset */
+    0,                                  /* tp_iter */
+    0,                                  /* tp_iternext */
+    Reader_methods,                     /* tp_methods */
+    0,                                  /* tp_members */
+    0,                                  /* tp_getset */
+    0,                                  /* tp_base */
+    0,                                  /* tp_dict */
+    0,                                  /* tp_descr_get */
+    0,                                  /* tp_descr_set */
+    0,                                  /* tp_dictoffset */
+    (initproc)Reader_init,              /* tp_init */
+    0,                                  /* tp_alloc */
+    PyType_GenericNew,                  /* tp_new */
+};
+
+PyMODINIT_FUNC
+init_parser(void)
+{
+    PyObject *module, *exceptions, *parser, *arrays;
+
+    if (PyType_Ready(&ReaderType) < 0)
+        return;
+
+    exceptions = PyImport_ImportModule("brukva.exceptions");
+    if (exceptions == NULL)
+        return;
+    ResponseError = PyObject_GetAttrString(exceptions, "ResponseError");
+    InvalidResponse = PyObject_GetAttrString(exceptions, "InvalidResponse");
+    Py_DECREF(exceptions);
+    if (ResponseError == NULL || InvalidResponse == NULL)
+        return;
+
+    parser = PyImport_ImportModule("brukva.parser");
+    if (parser == NULL)
+        return;
+    MultiBulkView = PyObject_GetAttrString(parser, "MultiBulkView");
+    Py_DECREF(parser);
+    arrays = PyImport_ImportModule("array");
+    if (arrays == NULL)
+        return;
+    array = PyObject_GetAttrString(arrays, "array");
+    Py_DECREF(arrays);
+    if (MultiBulkView == NULL || array == NULL)
+        return;
+
+    module = Py_InitModule3("_parser", NULL, "C implementation of brukva.parser");
+    if (module == NULL)
+        return;
+    Py_INCREF(&ReaderType);
+    PyModule_AddObject(module, "Reader", (PyObject *)&ReaderType);
+}
@@ -88,42 +88,83 @@ get all their result for processing at once:
 
 After *all* the asynchronous calls will complete `responses` will be a list of
 responses corresponding to given urls.
+
+## Futures
+
+Futures (anything with an `add_done_callback` method, like the ones brukva
+commands return when called without callbacks) may be yielded as well, alone
+or in a list, without wrapping them in @async. The result of a future is
+sent back into the function, its exception is raised there:
+
+    @process
+    def get_both():
+        foo, bar = yield [client.get('foo'), client.get('bar')]
 '''
+import sys
 from functools import partial
 
 class CallbackDispatcher(object):
     def __init__(self, generator):
         self.g = generator
+        self.exc_info = None
+        self.call_count = 0
         try:
             self.call(self.g.next())
         except StopIteration:
             pass
 
-    def _send_result(self, results, single):
+    def send(self, result):
         try:
-            result = results[0] if single else results
-            self.call(self.g.send(result))
+            exc_info, self.exc_info = self.exc_info, None
+            if exc_info is not None:
+                self.call(self.g.throw(*exc_info))
+            else:
+                self.call(self.g.send(result))
         except StopIteration:
             pass
 
     def call(self, callers):
-        single = not hasattr(callers, '__iter__')
-        if single:
-            callers = [callers]
-        self.call_count = len(list(callers))
+        # a single call is sent its result as is, without a list to collect
+        # it in; futures may be iterable too
+        if hasattr(callers, 'add_done_callback'):
+            callers.add_done_callback(self.future_done)
+            return
+        if not hasattr(callers, '__iter__'):
+            callers(callback=self.send)
+            return
+        callers = list(callers)
+        self.call_count = len(callers)
         results = [None] * self.call_count
-        if self.call_count == 0:
-            self._send_result(results, single)
-        else:
-            for count, caller in enumerate(callers):
-                caller(callback=partial(self.callback, results, count, single))
+        if not callers:
+            self.send(results)
+            return
+        for index, caller in enumerate(callers):
+            if hasattr(caller, 'add_done_callback'):
+                caller.add_done_callback(partial(self.future_callback, results, index))
+            else:
+                caller(callback=partial(self.callback, results, index))
+
+    def future_result(self, future):
+        try:
+            return future.result()
+        except Exception:
+            # the first exception is raised in the generator
+            if self.exc_info is None:
+                self.exc_info = sys.exc_info()
+            return None
+
+    def future_done(self, future):
+        self.send(self.future_result(future))
+
+    def future_callback(self, results, index, future):
+        self.callback(results, index, self.future_result(future))
 
-    def callback(self, results, index, single, arg):
+    def callback(self, results, index, arg):
         self.call_count -= 1
         results[index] = arg
         if self.call_count > 0:
             return
-        self._send_result(results, single)
+        self.send(results)
 
 def process(func):
     def wrapper(*args, **kwargs):
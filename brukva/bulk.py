@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+from functools import partial
+from itertools import izip
+
+from brukva.client import Future, resolve_future
+from brukva.exceptions import RedisError, ResponseError
+
+
+def command_size(command):
+    # bytes of the arguments of a command, numbers count for 8
+    size = 0
+    for arg in command:
+        size += len(arg) if isinstance(arg, basestring) else 8
+    return size
+
+
+class BulkWriter(object):
+    '''
+    Writes the commands of an iterable, e.g. a generator reading them from a
+    file, in pipelines of `batch_size` commands, with at most `window`
+    pipelines waiting for their replies at once.
+
+    Commands are tuples of a command name and its arguments, like
+    ('SET', 'foo', 'bar'). They are taken from the iterable only when a
+    pipeline can be sent, so at most `window` batches are held, encoded or
+    not, at any time. With `batch_bytes`, a batch also ends once its
+    arguments add up to that many bytes.
+
+    `on_error` is called with every command that failed and its error,
+    `on_progress` with the writer after the replies to every batch, whose
+    `sent`, `written` and `failed` count the commands sent, replied to
+    without an error and failed.
+
+    `write` callbacks get the number of commands written once all of them
+    are replied to, or the error of a batch that failed as a whole, e.g. on
+    a lost connection, after which no more batches are sent.
+    '''
+    def __init__(self, client, batch_size=1000, window=4, batch_bytes=None, on_error=None, on_progress=None):
+        self.client = client
+        self.batch_size = batch_size
+        self.window = window
+        self.batch_bytes = batch_bytes
+        self.on_error = on_error
+        self.on_progress = on_progress
+        self.sent = 0
+        self.written = 0
+        self.failed = 0
+        self.error = None
+        self.in_flight = 0
+        self._commands = None
+        self._callbacks = None
+        self._filling = False
+
+    def __repr__(self):
+        return 'Brukva bulk writer (sent=%s, written=%s, failed=%s)' % (self.sent, self.written, self.failed)
+
+    def write(self, commands, callbacks=None):
+        if self._callbacks is not None:
+            raise RedisError('A bulk write is running already')
+        future = None
+        if callbacks is None:
+            future = Future()
+            callbacks = [partial(resolve_future, future)]
+        elif not hasattr(callbacks, '__iter__'):
+            callbacks = [callbacks]
+        self.sent = self.written = self.failed = 0
+        self.error = None
+        self._commands = iter(commands)
+        self._callbacks = callbacks
+        self.fill()
+        return future
+
+    def fill(self):
+        self._filling = True
+        try:
+            while self.in_flight < self.window and self._commands is not None and self.error is None:
+                self.send_batch()
+        finally:
+            self._filling = False
+        if not self.in_flight and (self._commands is None or self.error is not None):
+            self.finish()
+
+    def send_batch(self):
+        pipe = self.client.pipeline()
+        batch = []
+        size = 0
+        try:
+            for command in self._commands:
+                try:
+                    pipe.execute_command(command[0], None, *command[1:])
+                except RedisError, e:
+                    # not sendable, e.g. keys on several shards
+                    self.on_failed(command, e)
+                    continue
+                batch.append(command)
+                if self.batch_bytes is not None:
+                    size += command_size(command)
+                    if size >= self.batch_bytes:
+                        break
+                if len(batch) >= self.batch_size:
+                    break
+            else:
+                self._commands = None
+        except Exception, e:
+            # the iterable failed, what was taken of it is still sent
+            self._commands = None
+            self.error = e
+        if not batch:
+            pipe.release()
+            return
+        self.in_flight += 1
+        self.sent += len(batch)
+        pipe.execute(partial(self.on_batch, batch))
+        # executing keeps nothing of it, the next batch may reuse it
+        pipe.release()
+
+    def on_batch(self, batch, results):
+        self.in_flight -= 1
+        if isinstance(results, tuple):
+            # the pipeline failed as a whole
+            if self.error is None:
+                self.error = results[0]
+            self.failed += len(batch)
+        else:
+            for command, (error, data) in izip(batch, results):
+                if error is None and isinstance(data, ResponseError):
+                    error = data
+                if error:
+                    self.on_failed(command, error)
+                else:
+                    self.written += 1
+        if self.on_progress is not None:
+            self.on_progress(self)
+        if not self._filling:
+            self.fill()
+
+    def on_failed(self, command, error):
+        self.failed += 1
+        if self.on_error is not None:
+            self.on_error(command, error)
+
+    def finish(self):
+        callbacks, self._callbacks = self._callbacks, None
+        self._commands = None
+        if callbacks is None:
+            return
+        if self.error is not None:
+            result = (self.error, None)
+        else:
+            result = (None, self.written)
+        for callback in callbacks:
+            callback(result)
@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+import time
+from collections import OrderedDict
+from functools import partial
+
+from brukva.client import Client, Future, encode, format, resolve_future, resolve_pipeline_future
+from brukva.parser import MultiBulkView, PairsView
+from brukva.commands import CACHEABLE_COMMANDS, get_command
+
+
+DEFAULT_CACHED_COMMANDS = frozenset(['GET', 'HGET', 'HGETALL', 'HMGET'])
+
+# commands after which nothing cached holds
+CLEARING_COMMANDS = frozenset(['FLUSHALL', 'FLUSHDB', 'SELECT'])
+
+def value_size(value):
+    # bytes of the strings of a reply, numbers count for 8
+    if isinstance(value, basestring):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(value_size(k) + value_size(v) for k, v in value.iteritems())
+    if isinstance(value, MultiBulkView):
+        return len(value.data)
+    if isinstance(value, PairsView):
+        return len(value.view.data)
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return sum(value_size(v) for v in value)
+    return 8
+
+MISSING = object()
+
+
+class LocalCache(object):
+    '''
+    Replies by request, with the requests waiting for a reply.
+
+    Once there are more than `max_entries` replies or their size exceeds
+    `max_bytes`, the least recently used ones are dropped. Entries are
+    indexed by the key they were read from for invalidate(). No entry is
+    kept longer than `max_ttl` seconds, when it is set.
+    '''
+    def __init__(self, max_entries=10000, max_bytes=64*1024*1024, max_ttl=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_ttl = max_ttl
+        # request -> (reply, size, expiry time or None, key), least recently
+        # used first
+        self.entries = OrderedDict()
+        # request -> callbacks waiting for the reply to it
+        self.flights = {}
+        # key -> requests of its entries and flights
+        self.keys = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _unindex(self, key, request):
+        requests = self.keys.get(key)
+        if requests is not None:
+            requests.discard(request)
+            if not requests:
+                del self.keys[key]
+
+    def get(self, request):
+        entry = self.entries.pop(request, None)
+        if entry is not None:
+            expires = entry[2]
+            if expires is None or expires > time.time():
+                self.entries[request] = entry
+                self.hits += 1
+                return entry[0]
+            self.bytes -= entry[1]
+            self._unindex(entry[3], request)
+        self.misses += 1
+        return MISSING
+
+    def set(self, request, key, value, ttl=None):
+        size = len(request) + value_size(value)
+        if size > self.max_bytes:
+            return
+        old = self.entries.pop(request, None)
+        if old is not None:
+            self.bytes -= old[1]
+        if self.max_ttl is not None and (not ttl or ttl > self.max_ttl):
+            ttl = self.max_ttl
+        expires = time.time() + ttl if ttl else None
+        self.entries[request] = (value, size, expires, key)
+        self.keys.setdefault(key, set()).add(request)
+        self.bytes += size
+        while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+            request, entry = self.entries.popitem(last=False)
+            self.bytes -= entry[1]
+            self._unindex(entry[3], request)
+            self.evictions += 1
+
+    def start_flight(self, request, key):
+        waiting = self.flights[request] = []
+        self.keys.setdefault(key, set()).add(request)
+        return waiting
+
+    def end_flight(self, request, key, waiting):
+        # False when the key was invalidated while the request was on its way,
+        # the reply may be older than the change
+        if self.flights.get(request) is not waiting:
+            return False
+        del self.flights[request]
+        self._unindex(key, request)
+        return True
+
+    def invalidate(self, key):
+        for request in self.keys.pop(encode(key), ()):
+            entry = self.entries.pop(request, None)
+            if entry is not None:
+                self.bytes -= entry[1]
+            self.flights.pop(request, None)
+
+    def clear(self):
+        self.entries.clear()
+        self.flights.clear()
+        self.keys.clear()
+        self.bytes = 0
+
+
+class CachedClient(Client):
+    '''
+    Client keeping the replies of some read commands in a local cache.
+
+    `commands` are the cached commands, in a dict by command when their
+    replies are kept for different numbers of seconds, otherwise they are
+    kept `ttl` seconds (forever when it is None). Concurrent reads of a
+    request not in the cache wait for the same reply. Commands changing keys
+    sent through this client drop what was read from those keys, changes
+    made by others are only seen once the replies expire, unless a
+    KeyspaceInvalidator watches the cache. Replies are shared between the
+    callers and the cache and must not be modified.
+
+    `client` is any client (Client, ShardedClient, ReplicatedClient...),
+    `cache` a LocalCache, by default one of `max_entries` and `max_bytes`.
+    Transactions run on `client`, their reads go around the cache and the
+    keys they write are dropped from it once they are done.
+    '''
+    def __init__(self, client, commands=DEFAULT_CACHED_COMMANDS, ttl=60, cache=None,
+                 max_entries=10000, max_bytes=64*1024*1024):
+        self.client = client
+        if not isinstance(commands, dict):
+            commands = dict.fromkeys(commands, ttl)
+        unknown = set(commands) - CACHEABLE_COMMANDS
+        if unknown:
+            raise ValueError('%s can not be cached' % ', '.join(sorted(unknown)))
+        self.commands = commands
+        self.cache = LocalCache(max_entries, max_bytes) if cache is None else cache
+        self._io_loop = client._io_loop
+        self.pool = None
+        self.timeout = client.timeout
+        self.deadline = client.deadline
+        self.subscribed = False
+
+    def __repr__(self):
+        return 'Brukva cached client (%r)' % self.client
+
+    def pipeline(self, transactional=False):
+        return CachedPipeline(self, self.client.pipeline(transactional))
+
+    def connect(self, callbacks=None):
+        self.client.connect(callbacks)
+
+    def disconnect(self):
+        self.client.disconnect()
+
+    def subscribe(self, channels, callbacks=None):
+        return self.client.subscribe(channels, callbacks)
+
+    def unsubscribe(self, channels, callbacks=None):
+        return self.client.unsubscribe(channels, callbacks)
+
+    def psubscribe(self, patterns, callbacks=None):
+        return self.client.psubscribe(patterns, callbacks)
+
+    def punsubscribe(self, patterns, callbacks=None):
+        return self.client.punsubscribe(patterns, callbacks)
+
+    def listen(self, callbacks=None):
+        self.client.listen(callbacks)
+
+    def set_from_file(self, key, fileobj, length=None, callbacks=None):
+        self.cache.invalidate(key)
+        return self.client.set_from_file(key, fileobj, length, callbacks)
+
+    def transaction(self, func, *keys, **kwargs):
+        callbacks = kwargs.pop('callbacks', None)
+        future = None
+        if callbacks is None:
+            future = Future()
+            callbacks = [partial(resolve_pipeline_future, future)]
+        elif not hasattr(callbacks, '__iter__'):
+            callbacks = [callbacks]
+        # the pipeline of the last attempt
+        pipes = []
+        def queue(client, pipe):
+            pipes[:] = [CachedPipeline(self, pipe)]
+            return func(client, pipes[0])
+        def on_done(result):
+            for pipe in pipes:
+                for cmd, args in pipe.command_stack:
+                    self.invalidate_command(cmd, args)
+        self.client.transaction(queue, *keys, callbacks=[on_done] + callbacks, **kwargs)
+        return future
+
+    def invalidate_command(self, cmd, args):
+        # drops what a command sent through this client may change
+        if cmd in CLEARING_COMMANDS:
+            self.cache.clear()
+            return
+        writes = get_command(cmd).writes
+        if writes is None:
+            return
+        for key in writes(args):
+            self.cache.invalidate(key)
+
+    def execute_command(self, cmd, callbacks, *args, **kwargs):
+        future = None
+        if callbacks is None:
+            future = Future()
+            callbacks = [partial(resolve_future, future)]
+        elif not hasattr(callbacks, '__iter__'):
+            callbacks = [callbacks]
+        timeout = kwargs.pop('timeout', self.timeout)
+        deadline = kwargs.pop('deadline', self.deadline)
+        if cmd not in self.commands or 'sink' in kwargs:
+            self.invalidate_command(cmd, args)
+            self.client.execute_command(cmd, callbacks, *args, timeout=timeout, deadline=deadline, **kwargs)
+            return future
+
+        if timeout is not None or deadline is not None:
+            callbacks = self.limit_callbacks(callbacks, timeout, deadline)
+            if callbacks is None:
+                return future
+        cache = self.cache
+        request = format(cmd, *args)
+        if kwargs:
+            request += repr(sorted(kwargs.iteritems()))
+        value = cache.get(request)
+        if value is not MISSING:
+            self.call_callbacks(callbacks, (None, value))
+            return future
+        waiting = cache.flights.get(request)
+        if waiting is not None:
+            cache.coalesced += 1
+            waiting.extend(callbacks)
+            return future
+        key = encode(args[0])
+        waiting = cache.start_flight(request, key)
+        waiting.extend(callbacks)
+        # the request itself is bounded by the timeout of the wrapped client,
+        # every caller by its own
+        self.client.execute_command(cmd, partial(self.on_reply, request, key, self.commands[cmd], waiting),
+                                    *args, **kwargs)
+        return future
+
+    def on_reply(self, request, key, ttl, waiting, result):
+        error, value = result
+        if self.cache.end_flight(request, key, waiting) and not error and not isinstance(value, Exception):
+            self.cache.set(request, key, value, ttl)
+        self.call_callbacks(waiting, result)
+
+
+class CachedPipeline(Client):
+    '''
+    Pipeline of a CachedClient, the keys its commands change are dropped from
+    the cache when it is executed. Its reads are not cached.
+    '''
+    def __init__(self, client, pipe):
+        self.client = client
+        self.pipe = pipe
+        self.timeout = client.timeout
+        self.deadline = client.deadline
+        self.command_stack = []
+
+    def _get_transactional(self):
+        return self.pipe.transactional
+
+    def _set_transactional(self, transactional):
+        self.pipe.transactional = transactional
+
+    transactional = property(_get_transactional, _set_transactional)
+
+    def execute_command(self, cmd, callbacks, *args, **kwargs):
+        self.pipe.execute_command(cmd, callbacks, *args, **kwargs)
+        self.command_stack.append((cmd, args))
+
+    def discard(self):
+        self.pipe.discard()
+        self.command_stack = []
+
+    def release(self):
+        self.command_stack = []
+        self.pipe.release()
+
+    def execute(self, callbacks=None, timeout=None, deadline=None):
+        command_stack = self.command_stack
+        self.command_stack = []
+        for cmd, args in command_stack:
+            self.client.invalidate_command(cmd, args)
+        return self.pipe.execute(callbacks, timeout=self.timeout if timeout is None else timeout,
+                          deadline=self.deadline if deadline is None else deadline)
+
+
+class KeyspaceInvalidator(object):
+    '''
+    Drops the entries of `cache` for the keys changed in database `db` by
+    anyone, as told by the keyspace notifications of the server.
+
+    The server has to publish them, with notify-keyspace-events set to 'KA'
+    for instance. `subscriber` is the client listening to them, a client of
+    its own or one on a ConnectionPool (pub/sub takes a dedicated connection
+    of the pool), and its connections must not reconnect on their own. While
+    it is not subscribed, changes go unnoticed: entries are then kept at most
+    `fallback_ttl` seconds, the cache is emptied whenever the subscription is
+    lost or made anew, and subscribing is tried again after `retry_delay`
+    seconds.
+    '''
+    def __init__(self, cache, subscriber=None, db=0, fallback_ttl=1, retry_delay=1, io_loop=None):
+        self.cache = cache
+        self.subscriber = Client(io_loop=io_loop) if subscriber is None else subscriber
+        self._io_loop = self.subscriber._io_loop
+        self.pattern = '__keyspace@%s__:*' % db
+        self.fallback_ttl = fallback_ttl
+        self.retry_delay = retry_delay
+        self.subscribed = False
+        self.running = False
+        self._retry = None
+        cache.max_ttl = fallback_ttl
+
+    def start(self):
+        self.running = True
+        self._retry = None
+        subscriber = self.subscriber
+        if not subscriber.connection.connected() and not subscriber.connection.connecting:
+            subscriber.connect()
+        subscriber.psubscribe(self.pattern, [self.on_subscribed])
+        subscriber.listen(self.on_message)
+
+    def stop(self):
+        self.running = False
+        if self._retry is not None:
+            self._io_loop.remove_timeout(self._retry)
+            self._retry = None
+        self.lost()
+        self.subscriber.disconnect()
+
+    def on_subscribed(self, result):
+        (error, _) = result
+        if error:
+            self.on_lost(error)
+            return
+        # whatever changed before is unknown
+        self.cache.clear()
+        self.cache.max_ttl = None
+        self.subscribed = True
+
+    def on_message(self, result):
+        (error, message) = result
+        if error:
+            self.on_lost(error)
+        elif message.kind == 'pmessage':
+            self.cache.invalidate(message.channel[len(self.pattern)-1:])
+
+    def lost(self):
+        self.subscribed = False
+        self.cache.max_ttl = self.fallback_ttl
+        self.cache.clear()
+
+    def on_lost(self, error):
+        if not self.running or self._retry is not None:
+            return
+        self.lost()
+        self._retry = self._io_loop.add_timeout(time.time() + self.retry_delay, self.start)
+        # fails the listener, which is restarted with the subscription
+        self.subscriber.disconnect()
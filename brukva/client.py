@@ -1,19 +1,37 @@
 # -*- coding: utf-8 -*-
+import copy
+import os
+import random
 import socket
+import time
 from tornado.ioloop import IOLoop
 from tornado.iostream import IOStream
-from adisp import async, process
 
+from collections import deque
 from functools import partial
+from hashlib import sha1
 from itertools import izip
 from datetime import datetime
-from brukva.exceptions import RedisError, ConnectionError, ResponseError, InvalidResponse
+from brukva.exceptions import RedisError, ConnectionError, TimeoutError, ResponseError, WatchError
+try:
+    from brukva._parser import Reader
+except ImportError:
+    from brukva.parser import Reader
+from brukva.commands import (COMMANDS, CommandStats, get_command, set_replies, BLOCKING_COMMANDS,
+                             COALESCED_COMMANDS, DEDICATED_COMMANDS, READ_ONLY_COMMANDS, SESSION_COMMANDS)
+from brukva.parser import MultiBulkView, PairsView
+try:
+    from tornado.concurrent import Future
+except ImportError:
+    from brukva.future import Future
 
 class Message(object):
-    def __init__(self, kind, channel, body):
+    def __init__(self, kind, channel, body, pattern=None):
         self.kind = kind
         self.channel = channel
         self.body = body
+        # the pattern a 'pmessage' matched
+        self.pattern = pattern
 
 class CmdLine(object):
     def __init__(self, cmd, *args, **kwargs):
@@ -24,13 +42,234 @@ class CmdLine(object):
     def __repr__(self):
         return self.cmd + '(' + str(self.args)  + ',' + str(self.kwargs) + ')'
 
-def string_keys_to_dict(key_string, callback):
-    return dict([(key, callback) for key in key_string.split()])
+class PendingCommand(object):
+    '''
+    A command written to a connection and waiting for its reply.
 
-def dict_merge(*dicts):
-    merged = {}
-    [merged.update(d) for d in dicts]
-    return merged
+    `on_reply` is called with every reply read for the command and returns
+    True while the command expects more of them.
+    '''
+    __slots__ = ('cmd_line', 'callbacks', 'formatter')
+    # whether the connection passes the reply on to `feed` unparsed
+    streams = False
+
+    def __init__(self, cmd_line, callbacks, formatter):
+        self.cmd_line = cmd_line
+        self.callbacks = callbacks
+        self.formatter = formatter
+
+    def on_reply(self, reply):
+        try:
+            result = self.formatter(self.cmd_line, reply)
+        except Exception, e:
+            result = (e, None)
+        for callback in self.callbacks:
+            callback(result)
+        return False
+
+    def on_error(self, error):
+        for callback in self.callbacks:
+            callback((error, None))
+
+    def replay(self):
+        # data to send again when the connection is reestablished, None when
+        # the command may have taken effect already
+        if self.cmd_line.cmd in READ_ONLY_COMMANDS:
+            return format(self.cmd_line.cmd, *self.cmd_line.args)
+        return None
+
+class PendingStream(PendingCommand):
+    '''
+    A command whose bulk reply is written to `sink`, a file-like object or a
+    callable, in the chunks it arrives in instead of being buffered whole.
+
+    Callbacks get the length of the value, or None when there is none. Any
+    other reply (an error, most likely) is parsed and handled as usual.
+    '''
+    __slots__ = ('streams', 'write', 'header', 'length', 'remaining')
+
+    def __init__(self, cmd_line, callbacks, formatter, sink):
+        super(PendingStream, self).__init__(cmd_line, callbacks, formatter)
+        self.streams = True
+        self.write = getattr(sink, 'write', sink)
+        self.header = ''
+        self.length = None
+        self.remaining = None
+
+    def feed(self, data):
+        # returns None while the reply goes on, then the data following it
+        if self.remaining is None:
+            data = self.header + data
+            end = data.find('\r\n')
+            if end == -1:
+                self.header = data
+                return None
+            self.header = ''
+            if data[0] != '$' or data[1] == '-':
+                # nothing to stream, the reader takes it
+                self.streams = False
+                return data
+            self.length = int(data[1:end])
+            self.remaining = self.length + 2
+            data = data[end+2:]
+        size = len(data)
+        value = min(size, self.remaining - 2)
+        if value > 0:
+            self.write(data[:value] if value < size else data)
+        consumed = min(size, self.remaining)
+        self.remaining -= consumed
+        if self.remaining:
+            return None
+        return data[consumed:]
+
+    def finish(self):
+        for callback in self.callbacks:
+            callback((None, self.length))
+
+    def replay(self):
+        # part of the value may have been written to the sink already
+        return None
+
+class PendingPipeline(PendingCommand):
+    __slots__ = ('replies',)
+
+    def __init__(self, command_stack, callbacks, formatter):
+        super(PendingPipeline, self).__init__(command_stack, callbacks, formatter)
+        self.replies = []
+
+    def on_reply(self, reply):
+        self.replies.append(reply)
+        if len(self.replies) < len(self.cmd_line):
+            return True
+        return super(PendingPipeline, self).on_reply(self.replies)
+
+    def replay(self):
+        return None
+
+class PendingListen(PendingCommand):
+    __slots__ = ('client', 'connection')
+
+    def __init__(self, client, connection, callbacks):
+        # 'LISTEN' is just for exception information, it is not actually sent anywhere
+        super(PendingListen, self).__init__(CmdLine('LISTEN'), callbacks, client.process_reply)
+        self.client = client
+        self.connection = connection
+
+    def on_reply(self, reply):
+        if not self.client.subscribed:
+            # subscribing has failed, the reply belongs to the next command
+            pending = self.connection.pending
+            if pending:
+                command = pending.popleft()
+                if command.on_reply(reply):
+                    pending.appendleft(command)
+            return False
+        super(PendingListen, self).on_reply(reply)
+        return self.client.subscribed
+
+    def replay(self):
+        # nothing to send, messages flow again once the channels are
+        # subscribed anew
+        return ''
+
+class PendingReset(PendingCommand):
+    '''
+    Brings a connection that listened to channels back to its ordinary
+    state: the replies to UNSUBSCRIBE and PUNSUBSCRIBE, and any message still
+    under way, are thrown away up to the reply to the PING written after
+    them.
+    '''
+    __slots__ = ()
+
+    def __init__(self, callbacks):
+        super(PendingReset, self).__init__(CmdLine('PING'), callbacks, ignore_reply)
+
+    def on_reply(self, reply):
+        if isinstance(reply, ResponseError):
+            self.on_error(reply)
+            return False
+        # PING replies in kind while still subscribed
+        if reply == 'PONG' or (isinstance(reply, list) and reply and reply[0] == 'pong'):
+            for callback in self.callbacks:
+                callback((None, True))
+            return False
+        return True
+
+    def replay(self):
+        return None
+
+class ReplyTimeout(object):
+    '''
+    Stands in for the callbacks of a command that may not wait for its reply
+    past `expires`.
+
+    When the time is up the callbacks get a TimeoutError, the reply still
+    arrives later (keeping the replies of the connection in order) and is
+    thrown away.
+    '''
+    __slots__ = ('callbacks', 'io_loop', 'handle')
+
+    def __init__(self, callbacks, io_loop, expires):
+        self.callbacks = callbacks
+        self.io_loop = io_loop
+        self.handle = io_loop.add_timeout(expires, self.expire)
+
+    def __call__(self, result):
+        callbacks, self.callbacks = self.callbacks, None
+        if callbacks is None:
+            return
+        self.io_loop.remove_timeout(self.handle)
+        for callback in callbacks:
+            callback(result)
+
+    def expire(self):
+        callbacks, self.callbacks = self.callbacks, None
+        if callbacks is None:
+            return
+        for callback in callbacks:
+            callback((TimeoutError('Timed out waiting for the reply'), None))
+
+def chain_callbacks(callbacks, result):
+    for callback in callbacks:
+        callback(result)
+
+def ignore_reply(cmd_line, reply):
+    return None, reply
+
+def resolve_future(future, result):
+    (error, data) = result
+    if error is None and isinstance(data, ResponseError):
+        # the reply could not be formatted
+        error = data
+    if error:
+        future.set_exception(error)
+    else:
+        future.set_result(data)
+
+def resolve_pipeline_future(future, results):
+    # a list of (error, data) pairs, or a single pair when the pipeline
+    # failed as a whole
+    if isinstance(results, tuple):
+        resolve_future(future, results)
+    else:
+        future.set_result(results)
+
+def call_command_callbacks(command_callbacks, results):
+    # the callbacks of every command of a pipeline, with its own result or
+    # the error of the whole pipeline
+    if isinstance(results, tuple):
+        results = [results] * len(command_callbacks)
+    for callbacks, result in izip(command_callbacks, results):
+        if callbacks:
+            for callback in callbacks:
+                callback(result)
+
+def end_flight(flights, request, callbacks, result):
+    if flights.get(request) is callbacks:
+        del flights[request]
+
+# released pipelines a client keeps for reuse
+MAX_FREE_PIPELINES = 16
 
 def encode(value):
     if isinstance(value, str):
@@ -40,105 +279,465 @@ def encode(value):
     # pray and hope
     return str(value)
 
-def format(*tokens):
-    cmds = []
-    for t in tokens:
-        e_t = encode(t)
-        cmds.append('$%s\r\n%s\r\n' % (len(e_t), e_t))
-    return '*%s\r\n%s' % (len(tokens), ''.join(cmds))
+# '*<count>\r\n' and '$<length>\r\n' for the usual counts and lengths
+ARRAY_HEADERS = ['*%d\r\n' % n for n in xrange(64)]
+BULK_HEADERS = ['$%d\r\n' % n for n in xrange(1024)]
+# pre-encoded bulk strings of recent short arguments, keys mostly
+BULK_CACHE_SIZE = 10000
+BULK_CACHE_MAX_LENGTH = 64
+_bulks = {}
+
+def pack_command(fragments, cmd, args):
+    # appends the fragments of a request to the list, they are joined only
+    # once for a whole command, pipeline or flush, so large values are
+    # copied once
+    append = fragments.append
+    count = len(args) + 1
+    append(ARRAY_HEADERS[count] if count < 64 else '*%d\r\n' % count)
+    command = COMMANDS.get(cmd)
+    if command is None:
+        command = get_command(cmd)
+    append(command.header)
+    for arg in args:
+        if arg.__class__ is not str:
+            arg = encode(arg)
+        length = len(arg)
+        if length <= BULK_CACHE_MAX_LENGTH:
+            bulk = _bulks.get(arg)
+            if bulk is None:
+                if len(_bulks) >= BULK_CACHE_SIZE:
+                    _bulks.clear()
+                bulk = _bulks[arg] = BULK_HEADERS[length] + arg + '\r\n'
+            append(bulk)
+        else:
+            append(BULK_HEADERS[length] if length < 1024 else '$%d\r\n' % length)
+            append(arg)
+            append('\r\n')
+
+def format_upload_header(cmd, args, length):
+    # the request up to its last argument, `length` bytes sent separately
+    fragments = []
+    pack_command(fragments, cmd, args)
+    fragments[0] = '*%d\r\n' % (len(args) + 2)
+    fragments.append('$%d\r\n' % length)
+    return ''.join(fragments)
+
+def file_length(fileobj):
+    try:
+        # mmap
+        return len(fileobj)
+    except TypeError:
+        return os.fstat(fileobj.fileno()).st_size - fileobj.tell()
+
+class Upload(object):
+    '''
+    A request whose last argument is read from a file object (or mmap) and
+    written in chunks as the socket drains.
+    '''
+    __slots__ = ('header', 'fileobj', 'remaining')
+
+    def __init__(self, header, fileobj, length):
+        self.header = header
+        self.fileobj = fileobj
+        self.remaining = length
+
+def format(cmd, *args):
+    fragments = []
+    pack_command(fragments, cmd, args)
+    return ''.join(fragments)
 
 def format_pipeline_request(command_stack):
-    return ''.join(format(c.cmd, *c.args, **c.kwargs) for c in command_stack)
+    fragments = []
+    for c in command_stack:
+        pack_command(fragments, c.cmd, c.args)
+    return ''.join(fragments)
 
 class Connection(object):
-    def __init__(self, host, port, timeout=None, io_loop=None):
+    def __init__(self, host, port, timeout=None, io_loop=None, autopipeline=False, connect_queue_limit=10000,
+                 db=None, reconnect=False, replay_reads=False, reconnect_delay=0.1, max_reconnect_delay=30,
+                 max_reconnect_attempts=None, coalesce_reads=False, lazy_threshold=None):
         self.host = host
         self.port = port
+        # bounds the time spent connecting, the connect itself never blocks
         self.timeout = timeout
         self._stream = None
-        self._io_loop = io_loop
-
-        self.in_progress = False
-        self.read_queue = []
-
-    def connect(self):
-        try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
-            sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
-            sock.settimeout(self.timeout)
-            sock.connect((self.host, self.port))
-            self._stream = IOStream(sock, io_loop=self._io_loop)
-        except socket.error, e:
-            raise ConnectionError(str(e))
-
-    def disconnect(self):
-        try:
-            self._stream.close()
-        except socket.error, e:
-            pass
-        self._stream = None
+        self._io_loop = io_loop or IOLoop.instance()
 
-    def write(self, data):
-        self._stream.write(data)
+        # with autopipeline on, writes made during one IOLoop iteration are
+        # sent to the socket together on the next one
+        self.autopipeline = autopipeline
+        self._write_buffer = []
+
+        # writes made while connecting are held back, up to this many
+        self.connecting = False
+        self.connect_queue_limit = connect_queue_limit
+        self._connect_callback = None
+        self._connect_timeout = None
+
+        # connection state restored on every connect
+        self.db = db
+        self.password = None
+        self.channels = set()
+        self.patterns = set()
+
+        # with reconnect on, a lost connection is reestablished after a
+        # jittered, exponentially growing delay. Commands waiting for a reply
+        # fail, or with replay_reads on, read-only ones are sent again
+        self.reconnect = reconnect
+        self.replay_reads = replay_reads
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.max_reconnect_attempts = max_reconnect_attempts
+        self._reconnect_attempts = 0
+        self._reconnect_timeout = None
+
+        # uploads are written one at a time, writes made meanwhile wait in the
+        # buffer
+        self.upload_chunk_size = 65536
+        self._upload = None
+        self._uploads = 0
+
+        # with coalesce_reads on, a read identical to one still waiting for its
+        # reply shares that reply instead of being sent. Requests in flight by
+        # their data, and the number of requests saved
+        self.flights = {} if coalesce_reads else None
+        self.coalesced = 0
+
+        # SHA1s of the registered scripts loaded through this connection
+        self.scripts = set()
+
+        # transactions WATCHing keys on this connection take turns, the first
+        # one is running
+        self.transactions = deque()
+
+        # multibulk replies of at least this many bulk strings come as
+        # MultiBulkView instances, read by the pure Python reader
+        self.lazy_threshold = lazy_threshold
+
+        self.pending = deque()
+        self._reader = None
+        self._streaming = None
+        self._dispatching = False
+
+    def connect(self, callback=None):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
+        sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+        stream = self._stream = IOStream(sock, io_loop=self._io_loop)
+        stream.set_close_callback(partial(self.on_stream_closed, stream))
+        self._reader = Reader(self.lazy_threshold)
+        self._streaming = None
+        self.scripts = set()
+        self.connecting = True
+        self._connect_callback = callback
+        if self.timeout:
+            self._connect_timeout = self._io_loop.add_timeout(time.time() + self.timeout,
+                                                              partial(self.on_connect_timeout, stream))
+        stream.connect((self.host, self.port), partial(self.on_connect, stream))
+
+    def on_connect(self, stream):
+        if stream is not self._stream:
+            return
+        self._clear_connect_timeout()
+        self.connecting = False
+        self._reconnect_attempts = 0
+        self.restore_state()
+        # everything the socket delivers goes straight into the reader
+        stream.read_until_close(self.on_data, self.on_data)
+        self.flush()
+        callback, self._connect_callback = self._connect_callback, None
+        if callback is not None:
+            callback((None, True))
+
+    def restore_state(self):
+        # goes out ahead of everything written while connecting
+        setup = []
+        if self.password is not None:
+            setup.append(CmdLine('AUTH', self.password))
+        if self.db is not None:
+            setup.append(CmdLine('SELECT', self.db))
+        # one channel per command, every SUBSCRIBE has exactly one reply
+        setup.extend(CmdLine('SUBSCRIBE', channel) for channel in self.channels)
+        setup.extend(CmdLine('PSUBSCRIBE', pattern) for pattern in self.patterns)
+        if not setup:
+            return
+        self._write_buffer[0:0] = [format(cmd_line.cmd, *cmd_line.args) for cmd_line in setup]
+        self.pending.extendleft(PendingCommand(cmd_line, [], ignore_reply) for cmd_line in reversed(setup))
 
-    def consume(self, length):
-        self._stream.read_bytes(length, NOOP_CB)
+    def remember(self, cmd_line, result):
+        (error, _) = result
+        if error:
+            return
+        cmd = cmd_line.cmd
+        if cmd == 'SELECT':
+            self.db = cmd_line.args[0]
+        elif cmd == 'AUTH':
+            self.password = cmd_line.args[0]
+        elif cmd == 'SUBSCRIBE':
+            self.channels.update(cmd_line.args)
+        elif cmd == 'UNSUBSCRIBE':
+            self.channels.difference_update(cmd_line.args)
+        elif cmd == 'PSUBSCRIBE':
+            self.patterns.update(cmd_line.args)
+        elif cmd == 'PUNSUBSCRIBE':
+            self.patterns.difference_update(cmd_line.args)
+
+    def on_connect_timeout(self, stream):
+        self._connect_timeout = None
+        if stream is self._stream and self.connecting:
+            self.connection_lost(ConnectionError('Timed out connecting to %s:%s' % (self.host, self.port)))
+
+    def on_stream_closed(self, stream):
+        if stream is not self._stream:
+            return
+        if self.connecting:
+            error = ConnectionError('Could not connect to %s:%s: %s' % (self.host, self.port, getattr(stream, 'error', None)))
+        else:
+            error = ConnectionError('Socket closed on remote end')
+        self.connection_lost(error)
 
-    def read(self, length, callback):
-        self._stream.read_bytes(length, callback)
+    def connection_lost(self, error):
+        if self.reconnect and (self.max_reconnect_attempts is None
+                               or self._reconnect_attempts < self.max_reconnect_attempts):
+            self.schedule_reconnect(error)
+        else:
+            self.close(error)
+
+    def schedule_reconnect(self, error):
+        was_connected = not self.connecting
+        stream, self._stream = self._stream, None
+        if stream is not None and not stream.closed():
+            stream.close()
+        self._clear_connect_timeout()
+        # commands keep being queued until the connection is back
+        self.connecting = True
+        if was_connected:
+            # anything written may have reached the server, nothing written
+            # before a failed connect attempt did
+            pending, self.pending = self.pending, deque()
+            self._write_buffer = []
+            self._upload = None
+            self._uploads = 0
+            for command in pending:
+                data = command.replay()
+                if data is not None and (self.replay_reads or not data):
+                    self.pending.append(command)
+                    if data:
+                        self._write_buffer.append(data)
+                else:
+                    command.on_error(error)
+        delay = min(self.max_reconnect_delay, self.reconnect_delay * 2 ** self._reconnect_attempts)
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        self._reconnect_attempts += 1
+        self._reconnect_timeout = self._io_loop.add_timeout(time.time() + delay, self._reconnect)
+
+    def _reconnect(self):
+        self._reconnect_timeout = None
+        self.connect(self._connect_callback)
+
+    def _clear_connect_timeout(self):
+        if self._connect_timeout is not None:
+            self._io_loop.remove_timeout(self._connect_timeout)
+            self._connect_timeout = None
+
+    def close(self, error):
+        # tears the connection down and fails everything still waiting on it
+        stream, self._stream = self._stream, None
+        if stream is not None:
+            try:
+                stream.close()
+            except socket.error, e:
+                pass
+        self._clear_connect_timeout()
+        if self._reconnect_timeout is not None:
+            self._io_loop.remove_timeout(self._reconnect_timeout)
+            self._reconnect_timeout = None
+        self._reconnect_attempts = 0
+        self.connecting = False
+        self._write_buffer = []
+        self._upload = None
+        self._uploads = 0
+        self._streaming = None
+        pending, self.pending = self.pending, deque()
+        for command in pending:
+            command.on_error(error)
+        callback, self._connect_callback = self._connect_callback, None
+        if callback is not None:
+            callback((error, None))
 
-    def readline(self, callback):
-        self._stream.read_until('\r\n', callback)
+    def disconnect(self):
+        self.close(ConnectionError('Disconnected'))
 
-    def try_to_perform_read(self):
-        if not self.in_progress and self.read_queue:
-            self.in_progress = True
-            self._io_loop.add_callback(partial(self.read_queue.pop(0), None) )
+    def connected(self):
+        return self._stream is not None and not self.connecting and not self._stream.closed()
 
-    @async
-    def queue_wait(self, callback):
-        self.read_queue.append(callback)
-        self.try_to_perform_read()
+    def add_connect_callback(self, callback):
+        # called along with the one given to the connect in progress
+        previous = self._connect_callback
+        if previous is None:
+            self._connect_callback = callback
+        else:
+            self._connect_callback = partial(chain_callbacks, [previous, callback])
 
-    def read_done(self):
-        self.in_progress = False
-        self.try_to_perform_read()
+    def write(self, data):
+        # a request, or the list of its fragments, joined once at flush time
+        # when autopipelining
+        if self._stream is not None and self._stream.closed():
+            # lost, but the close callback has not run yet
+            self.on_stream_closed(self._stream)
+        if self.connecting or self._uploads:
+            if len(self._write_buffer) >= self.connect_queue_limit:
+                raise ConnectionError('Too many commands issued while connecting')
+            self._write_buffer.append(''.join(data) if data.__class__ is list else data)
+            return
+        if self._stream is None:
+            raise ConnectionError('Not connected')
+        if not self.autopipeline:
+            self._stream.write(''.join(data) if data.__class__ is list else data)
+            return
+        if self._stream.closed():
+            raise IOError('Stream is closed')
+        if not self._write_buffer:
+            self._io_loop.add_callback(self.flush)
+        if data.__class__ is list:
+            self._write_buffer.extend(data)
+        else:
+            self._write_buffer.append(data)
+
+    def end_flights(self):
+        # reads sent from now on may see the effect of a write, they do not
+        # share the replies of earlier ones
+        if self.flights:
+            self.flights.clear()
+
+    def upload(self, upload):
+        if self._stream is not None and self._stream.closed():
+            self.on_stream_closed(self._stream)
+        if self._stream is None and not self.connecting:
+            raise ConnectionError('Not connected')
+        self._write_buffer.append(upload)
+        self._uploads += 1
+        self.flush()
+
+    def flush(self):
+        if not self._write_buffer or self._stream is None or self.connecting or self._upload is not None:
+            return
+        buffer = self._write_buffer
+        if not self._uploads:
+            self._write_buffer = []
+            self._stream.write(''.join(buffer))
+            return
+        for i, item in enumerate(buffer):
+            if item.__class__ is Upload:
+                break
+        self._write_buffer = buffer[i+1:]
+        self._upload = item
+        self._stream.write(''.join(buffer[:i]) + item.header)
+        self.send_upload()
+
+    def send_upload(self):
+        upload = self._upload
+        if upload is None or self._stream is None:
+            return
+        if upload.remaining:
+            chunk = upload.fileobj.read(min(self.upload_chunk_size, upload.remaining))
+            if not chunk:
+                self.close(ConnectionError('Upload ended %s bytes short' % upload.remaining))
+                return
+            upload.remaining -= len(chunk)
+            if upload.remaining:
+                # the next chunk is read once this one is sent
+                self._stream.write(chunk, self.send_upload)
+                return
+            self._stream.write(chunk)
+        self._stream.write('\r\n')
+        self._upload = None
+        self._uploads -= 1
+        self.flush()
+
+    def on_data(self, data):
+        if self._streaming is not None:
+            self.feed_stream(data)
+        else:
+            self._reader.feed(data)
+        self.dispatch_replies()
 
-def reply_to_bool(r, *args, **kwargs):
+    def feed_stream(self, data):
+        command = self._streaming
+        data = command.feed(data)
+        if data is None:
+            return
+        self._streaming = None
+        self._reader.feed(data)
+        if command.streams:
+            self.pending.popleft()
+            command.finish()
+
+    def dispatch_replies(self):
+        # commands may be issued from inside a reply callback, they are
+        # queued and picked up by the loop below instead of a nested dispatch
+        if self._dispatching:
+            return
+        self._dispatching = True
+        try:
+            pending = self.pending
+            while pending and self._streaming is None:
+                if pending[0].streams:
+                    self._streaming = pending[0]
+                    self.feed_stream(self._reader.drain())
+                    continue
+                reply = self._reader.gets()
+                if reply is False:
+                    break
+                command = pending.popleft()
+                if command.on_reply(reply):
+                    pending.appendleft(command)
+        finally:
+            self._dispatching = False
+
+def reply_to_bool(r, args):
     return bool(r)
 
 def make_reply_assert_msg(msg):
-    def reply_assert_msg(r, *args, **kwargs):
+    def reply_assert_msg(r, args):
         return r == msg
     return reply_assert_msg
 
-def reply_set(r, *args, **kwargs):
+def reply_set(r, args):
     return set(r)
 
-def reply_dict_from_pairs(r, *args, **kwargs):
-    return dict(izip(r[::2], r[1::2]))
+def reply_dict_from_pairs(r, args):
+    if isinstance(r, MultiBulkView):
+        return r.to_dict()
+    items = iter(r)
+    return dict(izip(items, items))
 
-def reply_str(r, *args, **kwargs):
+def reply_str(r, args):
     return r or ''
 
-def reply_int(r, *args, **kwargs):
+def reply_int(r, args):
     return int(r) if r is not None else None
 
-def reply_float(r, *args, **kwargs):
+def reply_float(r, args):
     return float(r) if r is not None else None
 
-def reply_datetime(r, *args, **kwargs):
+def reply_datetime(r, args):
     return datetime.fromtimestamp(int(r))
 
-def reply_pubsub_message(r, *args, **kwargs):
+def reply_pubsub_message(r, args):
+    if len(r) == 4:
+        # pmessage, pattern, channel, body
+        return Message(r[0], r[2], r[3], r[1])
     return Message(*r)
 
-def reply_zset(r, *args, **kwargs):
+def reply_zset(r, args):
     if (not r ) or (not 'WITHSCORES' in args):
         return r
-    return zip(r[::2], map(float, r[1::2]))
+    if isinstance(r, MultiBulkView):
+        return PairsView(r, float)
+    items = iter(r)
+    return [(member, float(score)) for member, score in izip(items, items)]
 
-def reply_info(response):
+def reply_info(response, args):
     info = {}
     def get_value(value):
         if ',' not in value:
@@ -159,85 +758,492 @@ def reply_info(response):
             info[key] = get_value(value)
     return info
 
-def reply_ttl(r, *args, **kwargs):
+def reply_ttl(r, args):
     return r != -1 and r or None
 
-class Client(object):
-    def __init__(self, host='localhost', port=6379, io_loop=None):
-        self._io_loop = io_loop or IOLoop.instance()
+def reply_script(r, args):
+    if args[0].upper() == 'EXISTS':
+        return [bool(flag) for flag in r]
+    if args[0].upper() == 'FLUSH':
+        return r == 'OK'
+    return r
+
+def reply_scan(r, args):
+    # the next cursor, 0 once the scan is over, and a batch
+    return int(r[0]), r[1]
+
+def reply_hscan(r, args):
+    return int(r[0]), reply_dict_from_pairs(r[1], args)
+
+def reply_zscan(r, args):
+    items = iter(r[1])
+    return int(r[0]), [(member, float(score)) for member, score in izip(items, items)]
+
+set_replies('AUTH BGREWRITEAOF BGSAVE DEL EXISTS EXPIRE HDEL HEXISTS HMSET MOVE MSET MSETNX SAVE SETNX',
+            reply_to_bool)
+set_replies('FLUSHALL FLUSHDB SELECT SET SETEX SHUTDOWN RENAME RENAMENX WATCH UNWATCH',
+            make_reply_assert_msg('OK'))
+set_replies('SMEMBERS SINTER SUNION SDIFF', reply_set)
+set_replies('HGETALL', reply_dict_from_pairs)
+set_replies('HGET', reply_str)
+set_replies('SUBSCRIBE UNSUBSCRIBE PSUBSCRIBE PUNSUBSCRIBE LISTEN', reply_pubsub_message)
+set_replies('ZRANK ZREVRANK ZSCORE ZINCRBY', reply_int)
+set_replies('ZRANGE ZRANGEBYSCORE ZREVRANGE', reply_zset)
+set_replies('PING', make_reply_assert_msg('PONG'))
+set_replies('LASTSAVE', reply_datetime)
+set_replies('TTL', reply_ttl)
+set_replies('SCAN SSCAN', reply_scan)
+set_replies('HSCAN', reply_hscan)
+set_replies('ZSCAN', reply_zscan)
+set_replies('SCRIPT', reply_script)
+set_replies('INFO', reply_info)
+
+def scan_options(match, count):
+    tokens = []
+    if match is not None:
+        tokens.append('MATCH')
+        tokens.append(match)
+    if count is not None:
+        tokens.append('COUNT')
+        tokens.append(count)
+    return tokens
+
+# sources of the registered scripts by SHA1, for pipelines to load them
+# ahead of their EVALSHA
+SCRIPTS = {}
+
+class Script(object):
+    '''
+    A Lua script, called with its keys and arguments, run with EVALSHA.
+
+    On a NOSCRIPT error the script is sent whole with EVAL, which has the
+    server cache it for the next calls. Called with a pipeline as `client`,
+    the EVALSHA is queued on it, and the pipeline loads the script on its
+    connection with SCRIPT LOAD ahead of it the first time. A pipeline run
+    after the scripts were flushed from the server gets NOSCRIPT errors, the
+    next one loads them again.
+    '''
+    def __init__(self, client, source):
+        self.client = client
+        self.source = encode(source)
+        self.sha = sha1(self.source).hexdigest()
+        SCRIPTS[self.sha] = self.source
+
+    def __repr__(self):
+        return 'Brukva script %s' % self.sha
 
-        self.connection = Connection(host, port, io_loop=self._io_loop)
-        self.queue = []
-        self.current_cmd_line = None
+    def __call__(self, keys=(), args=(), client=None, callbacks=None):
+        client = client or self.client
+        if hasattr(client, 'command_stack'):
+            return client.evalsha(self.sha, keys, args)
+        future = None
+        if callbacks is None:
+            future = Future()
+            callbacks = [partial(resolve_future, future)]
+        elif not hasattr(callbacks, '__iter__'):
+            callbacks = [callbacks]
+        client.evalsha(self.sha, keys, args, partial(self.on_reply, client, keys, args, callbacks))
+        return future
+
+    def on_reply(self, client, keys, args, callbacks, result):
+        (error, _) = result
+        if isinstance(error, ResponseError) and error.message.startswith('NOSCRIPT'):
+            client.eval(self.source, keys, args, callbacks)
+            return
+        for callback in callbacks:
+            callback(result)
+
+class TransactionResults(list):
+    # the results of the pipeline of a transaction, `retries` the number of
+    # times it started over
+    retries = 0
+
+class Transaction(object):
+    '''
+    Runs `func` as an optimistic transaction. The keys are WATCHed, `func` is
+    called with the client, to read values with, and a transactional
+    pipeline, to queue writes on, and the pipeline is executed. When a
+    watched key changed meanwhile, EXEC runs nothing and it all starts over
+    after a jittered, exponentially growing delay, up to `max_attempts`
+    times, after which callbacks get a WatchError. The results, or the
+    error, carry the number of times it started over as `retries`.
+
+    `func` returns None once the writes are queued, or a Future, or an adisp
+    caller which is passed a callback, to tell when they are. An exception
+    raised, set on the Future or passed to the callback aborts the
+    transaction:
+
+        @adisp.async
+        @adisp.process
+        def incr(client, pipe, callback):
+            value = yield client.get('counter')
+            pipe.set('counter', int(value or 0) + 1)
+            callback(None)
+
+    With a pool, every transaction WATCHes on a connection of its own,
+    checked out of the pool. Without one, it pins the connection of the
+    client: transactions on the same connection take turns, as the EXEC of
+    one would drop the WATCH of the other.
+    '''
+    def __init__(self, client, func, keys, callbacks, max_attempts=10, backoff=0.01):
+        self.client = client
+        self.func = func
+        self.keys = keys
+        self.callbacks = callbacks
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.attempts = 0
+        self.pinned = client.pinned()
+
+    def __repr__(self):
+        return 'Brukva transaction on %s (attempts=%s)' % (', '.join(self.keys), self.attempts)
+
+    def run(self):
+        if self.client.pool is None:
+            waiting = self.client.connection.transactions
+            waiting.append(self)
+            if len(waiting) > 1:
+                return
+        self.attempt()
+
+    def attempt(self):
+        self.attempts += 1
+        self.pinned.execute_command('WATCH', self.on_watch, *self.keys)
+
+    def on_watch(self, result):
+        (error, _) = result
+        if error:
+            if self.client.pool is not None:
+                self.pinned.release_dedicated('watch', close=True)
+            self.finish((error, None))
+            return
+        pipe = self.pinned.pipeline(transactional=True)
+        try:
+            waiting = self.func(self.pinned, pipe)
+        except Exception, e:
+            self.abort(e)
+            return
+        if waiting is None:
+            self.execute(pipe)
+        elif hasattr(waiting, 'add_done_callback'):
+            waiting.add_done_callback(partial(self.on_func_done, pipe))
+        else:
+            waiting(callback=partial(self.on_func_result, pipe))
+
+    def on_func_done(self, pipe, future):
+        self.on_func_result(pipe, future.exception())
+
+    def on_func_result(self, pipe, error):
+        if isinstance(error, Exception):
+            self.abort(error)
+        else:
+            self.execute(pipe)
+
+    def execute(self, pipe):
+        if not pipe.command_stack:
+            # nothing to write
+            self.pinned.execute_command('UNWATCH', [])
+            self.finish([])
+            return
+        pipe.execute(self.on_exec)
+
+    def on_exec(self, results):
+        if (isinstance(results, tuple) and isinstance(results[0], WatchError)
+            and self.attempts < self.max_attempts):
+            self.client.transaction_retries += 1
+            delay = self.backoff * 2 ** (self.attempts - 1)
+            delay = delay / 2 + random.uniform(0, delay / 2)
+            self.client._io_loop.add_timeout(time.time() + delay, self.attempt)
+            return
+        self.finish(results)
+
+    def abort(self, error):
+        self.pinned.execute_command('UNWATCH', [])
+        self.finish((error, None))
+
+    def finish(self, result):
+        if self.client.pool is None:
+            waiting = self.client.connection.transactions
+            waiting.popleft()
+            if waiting:
+                waiting[0].attempt()
+        retries = self.attempts - 1
+        if isinstance(result, tuple):
+            try:
+                result[0].retries = retries
+            except AttributeError:
+                pass
+        else:
+            result = TransactionResults(result)
+            result.retries = retries
+        for callback in self.callbacks:
+            callback(result)
+
+class ScanIterator(object):
+    '''
+    Walks the cursor of SCAN, HSCAN, SSCAN or ZSCAN a batch at a time.
+
+    `scans` are scan methods of clients, walked one after the other, called
+    with `args` and the cursor. A batch is requested only when `next` is
+    called, and one at a time, so the consumer sets the pace and memory use
+    stays bounded by the size of a batch. Callbacks of `next` get the next
+    batch, never an empty one, or None once the walk is over. Without
+    callbacks, `next` returns a Future of it:
+
+        keys = client.scan_iter('user:*', count=1000)
+        while True:
+            batch = yield keys.next()
+            if batch is None:
+                break
+
+    `each` calls a function with every batch instead, as described there.
+    A key may come more than once, and keys changed during the walk may or
+    may not come at all, see the SCAN documentation.
+    '''
+    def __init__(self, scans, args=(), match=None, count=None):
+        self.scans = scans
+        self.args = args
+        self.match = match
+        self.count = count
+        self.cursor = 0
+        self.done = not scans
+
+    def next(self, callbacks=None):
+        future = None
+        if callbacks is None:
+            future = Future()
+            callbacks = [partial(resolve_future, future)]
+        elif not hasattr(callbacks, '__iter__'):
+            callbacks = [callbacks]
+        self.request(callbacks)
+        return future
+
+    def request(self, callbacks):
+        if self.done:
+            for callback in callbacks:
+                callback((None, None))
+            return
+        args = self.args + (self.cursor, self.match, self.count)
+        self.scans[0](*args, callbacks=partial(self.on_batch, callbacks))
+
+    def on_batch(self, callbacks, result):
+        (error, data) = result
+        if error is None and isinstance(data, ResponseError):
+            error = data
+        if error:
+            for callback in callbacks:
+                callback((error, None))
+            return
+        self.cursor, batch = data
+        if not self.cursor:
+            self.scans = self.scans[1:]
+            self.done = not self.scans
+        if not batch:
+            # SCAN may reply with nothing before it is over
+            self.request(callbacks)
+            return
+        for callback in callbacks:
+            callback((None, batch))
+
+    def each(self, function, callbacks=None):
+        '''
+        Calls `function` with every batch. The next one is requested when it
+        returns, or when the Future it returns is done. Callbacks get
+        (None, None) once the walk is over, or the error that stopped it.
+        '''
+        future = None
+        if callbacks is None:
+            future = Future()
+            callbacks = [partial(resolve_future, future)]
+        elif not hasattr(callbacks, '__iter__'):
+            callbacks = [callbacks]
+        self.request([partial(self.on_each, function, callbacks)])
+        return future
+
+    def on_each(self, function, callbacks, result):
+        (error, batch) = result
+        if error is None and batch is not None:
+            try:
+                waiting = function(batch)
+            except Exception, e:
+                error = e
+            else:
+                if hasattr(waiting, 'add_done_callback'):
+                    waiting.add_done_callback(partial(self.on_each_done, function, callbacks))
+                else:
+                    self.request([partial(self.on_each, function, callbacks)])
+                return
+        for callback in callbacks:
+            callback((error, None))
+
+    def on_each_done(self, function, callbacks, future):
+        error = future.exception()
+        if error is not None:
+            for callback in callbacks:
+                callback((error, None))
+        else:
+            self.request([partial(self.on_each, function, callbacks)])
+
+class Client(object):
+    def __init__(self, host='localhost', port=6379, io_loop=None, autopipeline=False, pool=None, connect_timeout=None,
+                 reconnect=False, replay_reads=False, timeout=None, coalesce_reads=False, lazy_threshold=None,
+                 instrument=False):
+        self.pool = pool
+        # seconds a command waits for its reply, and the time after which
+        # no command waits any longer
+        self.timeout = timeout
+        self.deadline = None
+        if pool is not None:
+            self._io_loop = pool.io_loop
+            self.connection = pool.connection
+        else:
+            self._io_loop = io_loop or IOLoop.instance()
+            self.connection = Connection(host, port, timeout=connect_timeout, io_loop=self._io_loop,
+                                         autopipeline=autopipeline, reconnect=reconnect, replay_reads=replay_reads,
+                                         coalesce_reads=coalesce_reads, lazy_threshold=lazy_threshold)
+        # connections checked out of the pool for pub/sub and WATCH, or
+        # callbacks waiting for them
+        self._dedicated = {}
+        # transactions run, and attempts of them started over since a watched
+        # key changed
+        self.transactions = 0
+        self.transaction_retries = 0
+        # CommandStats by command name, when instrumented
+        self.stats = {} if instrument else None
         self.subscribed = False
-        self.REPLY_MAP = dict_merge(
-                string_keys_to_dict('AUTH BGREWRITEAOF BGSAVE DEL EXISTS EXPIRE HDEL HEXISTS '
-                                    'HMSET MOVE MSET MSETNX SAVE SETNX',
-                                    reply_to_bool),
-                string_keys_to_dict('FLUSHALL FLUSHDB SELECT SET SETEX SHUTDOWN '
-                                    'RENAME RENAMENX WATCH UNWATCH',
-                                    make_reply_assert_msg('OK')),
-                string_keys_to_dict('SMEMBERS SINTER SUNION SDIFF',
-                                    reply_set),
-                string_keys_to_dict('HGETALL',
-                                    reply_dict_from_pairs),
-                string_keys_to_dict('HGET',
-                                    reply_str),
-                string_keys_to_dict('SUBSCRIBE UNSUBSCRIBE LISTEN',
-                                    reply_pubsub_message),
-                string_keys_to_dict('ZRANK ZREVRANK',
-                                    reply_int),
-                string_keys_to_dict('ZSCORE ZINCRBY',
-                                    reply_int),
-                string_keys_to_dict('ZRANGE ZRANGEBYSCORE ZREVRANGE',
-                                    reply_zset),
-                {'PING': make_reply_assert_msg('PONG')},
-                {'LASTSAVE': reply_datetime },
-                {'TTL': reply_ttl } ,
-                {'INFO': reply_info},
-                {'MULTI_PART': make_reply_assert_msg('QUEUED')},
-            )
-
-        self._pipeline = None
+        self._free_pipelines = []
 
     def __repr__(self):
         return 'Brukva client (host=%s, port=%s)' % (self.connection.host, self.connection.port)
 
     def pipeline(self, transactional=False):
-        if not self._pipeline:
-            self._pipeline =  Pipeline(io_loop = self._io_loop, transactional=transactional)
-            self._pipeline.connection = self.connection
-        return self._pipeline
+        # a pipeline of its own for every caller, released ones are reused
+        if self._free_pipelines:
+            pipe = self._free_pipelines.pop()
+            pipe.transactional = transactional
+            pipe.timeout = self.timeout
+            pipe.deadline = self.deadline
+            return pipe
+        return self.new_pipeline(transactional)
+
+    def new_pipeline(self, transactional):
+        return Pipeline(self, transactional)
+
+    def bounded(self, timeout=None, deadline=None):
+        '''
+        Returns a client sharing the connections of this one, whose commands
+        wait at most `timeout` seconds each and fail once `deadline` (a
+        time.time() value) has passed, e.g. to bound the time a request
+        handler spends on redis altogether.
+        This is how the command methods are bounded, their `timeout`
+        arguments being those of the redis commands (BLPOP and the like).
+        '''
+        client = copy.copy(self)
+        client._free_pipelines = []
+        if timeout is not None:
+            client.timeout = timeout
+        if deadline is not None:
+            client.deadline = deadline if self.deadline is None else min(deadline, self.deadline)
+        return client
 
     #### connection
-    def connect(self):
-        self.connection.connect()
+    def connect(self, callbacks=None):
+        if callbacks is None:
+            callbacks = []
+        elif not hasattr(callbacks, '__iter__'):
+            callbacks = [callbacks]
+        callback = partial(self.call_callbacks, callbacks)
+        if self.pool is not None:
+            self.pool.connect(callback)
+        else:
+            self.connection.connect(callback)
 
     def disconnect(self):
-        self.connection.disconnect()
+        if self.pool is None:
+            self.connection.disconnect()
+            return
+        # the shared connection stays with the pool, dedicated ones go back
+        # to it once they no longer watch keys or listen to channels
+        for purpose in self._dedicated.keys():
+            self.reset_dedicated(purpose)
+        self.subscribed = False
+
+    def with_dedicated(self, purpose, callback):
+        connection = self._dedicated.get(purpose)
+        if isinstance(connection, Connection):
+            callback(connection)
+            return
+        if connection is not None:
+            connection.append(callback)
+            return
+        self._dedicated[purpose] = [callback]
+        self.pool.get_connection(partial(self._on_dedicated, purpose))
+
+    def _on_dedicated(self, purpose, connection):
+        waiting = self._dedicated.get(purpose)
+        if waiting is None:
+            # released before the pool could provide it
+            self.pool.release(connection)
+            return
+        self._dedicated[purpose] = connection
+        for callback in waiting:
+            callback(connection)
+
+    def reset_dedicated(self, purpose):
+        connection = self._dedicated.pop(purpose, None)
+        if not isinstance(connection, Connection):
+            # not provided yet, _on_dedicated gives it back
+            return
+        release = partial(self._on_reset, connection)
+        if not connection.connected():
+            release((ConnectionError('Disconnected'), None))
+            return
+        if purpose == 'watch':
+            self.send_command(connection, CmdLine('UNWATCH'), [release])
+            return
+        # listeners and unanswered subscriptions are done with, the channels
+        # are left for good
+        pending = list(connection.pending)
+        connection.pending.clear()
+        connection.channels.clear()
+        connection.patterns.clear()
+        error = ConnectionError('Disconnected')
+        for command in pending:
+            command.on_error(error)
+        try:
+            connection.write(format('UNSUBSCRIBE') + format('PUNSUBSCRIBE') + format('PING'))
+        except (ConnectionError, IOError), e:
+            release((e, None))
+            return
+        connection.pending.append(PendingReset([release]))
+
+    def _on_reset(self, connection, result):
+        (error, _) = result
+        if error:
+            connection.disconnect()
+        self.pool.release(connection)
+
+    def release_dedicated(self, purpose, close=False):
+        connection = self._dedicated.pop(purpose, None)
+        if isinstance(connection, Connection):
+            if close:
+                connection.disconnect()
+            self.pool.release(connection)
     ####
 
     #### formatting
     def encode(self, value):
-        if isinstance(value, str):
-            return value
-        elif isinstance(value, unicode):
-            return value.encode('utf-8')
-        # pray and hope
-        return str(value)
+        return encode(value)
 
     def format(self, *tokens):
-        cmds = []
-        for t in tokens:
-            e_t = self.encode(t)
-            cmds.append('$%s\r\n%s\r\n' % (len(e_t), e_t))
-        return '*%s\r\n%s' % (len(tokens), ''.join(cmds))
+        return format(*tokens)
 
     def format_reply(self, cmd_line, data):
-        if cmd_line.cmd not in self.REPLY_MAP:
+        command = COMMANDS.get(cmd_line.cmd)
+        if command is None or command.reply is None:
             return data
         try:
-            res =  self.REPLY_MAP[cmd_line.cmd](data, *cmd_line.args, **cmd_line.kwargs)
+            res = command.reply(data, cmd_line.args)
         except Exception, e:
             res = ResponseError('failed to format reply, raw data: %s' % data, cmd_line)
         return res
@@ -248,202 +1254,285 @@ class Client(object):
         for cb in callbacks:
             cb(*args, **kwargs)
 
-    def _sudden_disconnect(self, callbacks):
-        self.connection.disconnect()
+    def limit_callbacks(self, callbacks, timeout, deadline):
+        # returns None, after failing the callbacks, when the deadline has
+        # passed already
+        now = time.time()
+        expires = deadline
+        if timeout is not None and (expires is None or now + timeout < expires):
+            expires = now + timeout
+        if expires <= now:
+            self.call_callbacks(callbacks, (TimeoutError('Deadline exceeded'), None))
+            return None
+        return [ReplyTimeout(callbacks, self._io_loop, expires)]
+
+    def _sudden_disconnect(self, callbacks, connection=None):
+        (connection or self.connection).disconnect()
         self.call_callbacks(callbacks, (ConnectionError("Socket closed on remote end"), None))
 
-    @process
+    def process_reply(self, cmd_line, reply):
+        if isinstance(reply, ResponseError):
+            reply.cmd_line = cmd_line
+            return reply, None
+        return None, self.format_reply(cmd_line, reply)
+
     def execute_command(self, cmd, callbacks, *args, **kwargs):
+        # without callbacks, returns a Future of the reply, an empty list of
+        # them ignores it. timeout and deadline default to those of the
+        # client, see bounded()
+        future = None
         if callbacks is None:
-            callbacks = []
+            future = Future()
+            callbacks = [partial(resolve_future, future)]
         elif not hasattr(callbacks, '__iter__'):
             callbacks = [callbacks]
+        timeout = kwargs.pop('timeout', self.timeout)
+        deadline = kwargs.pop('deadline', self.deadline)
+        # a bulk reply is written to the sink as it arrives
+        sink = kwargs.pop('sink', None)
+        cmd_line = CmdLine(cmd, *args, **kwargs)
+        if self.pool is not None and cmd in BLOCKING_COMMANDS:
+            self.execute_blocking(cmd_line, callbacks, timeout, deadline)
+            return future
+        if timeout is not None or deadline is not None:
+            callbacks = self.limit_callbacks(callbacks, timeout, deadline)
+            if callbacks is None:
+                return future
+        if self.pool is not None and cmd in DEDICATED_COMMANDS:
+            self.execute_dedicated(cmd_line, callbacks)
+        else:
+            self.send_command(self.connection, cmd_line, callbacks, sink)
+        return future
+
+    def send_command(self, connection, cmd_line, callbacks, sink=None):
+        if cmd_line.cmd in SESSION_COMMANDS:
+            callbacks = [partial(connection.remember, cmd_line)] + callbacks
+        if self.stats is not None:
+            callbacks = [partial(self.record_command, cmd_line.cmd, time.time())] + callbacks
+        request = []
+        pack_command(request, cmd_line.cmd, cmd_line.args)
+        flights = connection.flights
+        if flights is not None:
+            if cmd_line.cmd in COALESCED_COMMANDS and sink is None and not cmd_line.kwargs:
+                request = ''.join(request)
+                waiting = flights.get(request)
+                if waiting is not None:
+                    waiting.extend(callbacks)
+                    connection.coalesced += 1
+                    return
+                callbacks = [None] + callbacks
+                callbacks[0] = partial(end_flight, flights, request, callbacks)
+                flights[request] = callbacks
+            else:
+                connection.end_flights()
         try:
-            self.connection.write(self.format(cmd, *args, **kwargs))
+            connection.write(request)
+        except ConnectionError, e:
+            self.call_callbacks(callbacks, (e, None))
+            return
         except IOError:
-            self._sudden_disconnect(callbacks)
+            self._sudden_disconnect(callbacks, connection)
             return
-
-        cmd_line = CmdLine(cmd, *args, **kwargs)
-        yield self.connection.queue_wait()
-
-        data = yield async(self.connection.readline)()
-        if not data:
-            result = None
-            error = Exception('todo')
+        if sink is None:
+            connection.pending.append(PendingCommand(cmd_line, callbacks, self.process_reply))
         else:
-            try:
-                error, response = yield self.process_data(data, cmd_line)
-                result = self.format_reply(cmd_line, response)
-            except Exception, e:
-                error, result = e, None
-
-        self.connection.read_done()
-        self.call_callbacks(callbacks, (error, result))
-
-    @async
-    @process
-    def process_data(self, data, cmd_line, callback):
-        error, response = None, None
-
-        data = data[:-2] # strip \r\n
-
-        if data == '$-1':
-            response =  None
-        elif data == '*0' or data == '*-1':
-            response = []
+            connection.pending.append(PendingStream(cmd_line, callbacks, self.process_reply, sink))
+
+    def record_command(self, cmd, started, result):
+        (error, data) = result
+        if error is None and isinstance(data, ResponseError):
+            error = data
+        stats = self.stats.get(cmd)
+        if stats is None:
+            stats = self.stats[cmd] = CommandStats(get_command(cmd))
+        stats.add(error, time.time() - started)
+
+    def record_pipeline(self, command_stack, started, results):
+        if command_stack[0].cmd == 'MULTI':
+            # replied to as a whole
+            command_stack = command_stack[1:-1]
+        if isinstance(results, tuple):
+            results = [results] * len(command_stack)
+        for cmd_line, result in izip(command_stack, results):
+            self.record_command(cmd_line.cmd, started, result)
+
+    def execute_blocking(self, cmd_line, callbacks, timeout, deadline):
+        # the connection goes back to the pool with the reply, or once the
+        # wait for it timed out, when the pool closes it as it is still
+        # blocked
+        waiting = list(callbacks)
+        limited = waiting
+        if timeout is not None or deadline is not None:
+            limited = self.limit_callbacks(waiting, timeout, deadline)
+            if limited is None:
+                return
+        def on_connection(connection):
+            if limited is not waiting and limited[0].callbacks is None:
+                # timed out waiting for the connection
+                self.pool.release(connection)
+                return
+            waiting.insert(0, lambda result: self.pool.release(connection))
+            self.send_command(connection, cmd_line, limited)
+        self.pool.get_connection(on_connection)
+
+    def execute_dedicated(self, cmd_line, callbacks):
+        cmd = cmd_line.cmd
+        if cmd == 'UNWATCH' and 'watch' not in self._dedicated:
+            self.send_command(self.connection, cmd_line, callbacks)
         else:
-            head, tail = data[0], data[1:]
-
-            if head == '*':
-                error, response = yield self.consume_multibulk(int(tail), cmd_line)
-            elif head == '$':
-                error, response = yield self.consume_bulk(int(tail)+2)
-            elif head == '+':
-                response = tail
-            elif head == ':':
-                response = int(tail)
-            elif head == '-':
-                if tail.startswith('ERR'):
-                    tail = tail[4:]
-                error = ResponseError(tail, cmd_line)
-            else:
-                error = ResponseError('Unknown response type %s' % head, cmd_line)
-
-        callback( (error, response) )
-
-    @async
-    @process
-    def consume_multibulk(self, length, cmd_line, callback):
-        tokens = []
-        errors = {}
-        idx = 0
-        while len(tokens) < length:
-            data = yield async(self.connection.readline)()
-            if not data:
-                break
-
-            error, token = yield self.process_data(data, cmd_line) #FIXME error
-            tokens.append( token )
-            if error:
-                errors[idx] = error
-
-            idx += 1
-        callback( (errors, tokens) )
-
-    @async
-    @process
-    def consume_bulk(self, length, callback):
-        data = yield async(self.connection.read)(length)
-        error = None
-        if not data:
-            error = ResponseError('EmptyResponse')
-        else:
-            data = data[:-2]
-        callback( (error, data) )
+            purpose = 'watch' if cmd in ('WATCH', 'UNWATCH') else 'pubsub'
+            if cmd == 'UNWATCH':
+                callbacks = [lambda result: self.release_dedicated('watch')] + callbacks
+            self.with_dedicated(purpose, lambda connection: self.send_command(connection, cmd_line, callbacks))
     ####
 
     ### MAINTENANCE
     def bgrewriteaof(self, callbacks=None):
-        self.execute_command('BGREWRITEAOF', callbacks)
+        return self.execute_command('BGREWRITEAOF', callbacks)
 
     def dbsize(self, callbacks=None):
-        self.execute_command('DBSIZE', callbacks)
+        return self.execute_command('DBSIZE', callbacks)
 
     def flushall(self, callbacks=None):
-        self.execute_command('FLUSHALL', callbacks)
+        return self.execute_command('FLUSHALL', callbacks)
 
     def flushdb(self, callbacks=None):
-        self.execute_command('FLUSHDB', callbacks)
+        return self.execute_command('FLUSHDB', callbacks)
 
     def ping(self, callbacks=None):
-        self.execute_command('PING', callbacks)
+        return self.execute_command('PING', callbacks)
 
     def info(self, callbacks=None):
-        self.execute_command('INFO', callbacks)
+        return self.execute_command('INFO', callbacks)
 
     def select(self, db, callbacks=None):
-        self.execute_command('SELECT', callbacks, db)
+        return self.execute_command('SELECT', callbacks, db)
 
     def shutdown(self, callbacks=None):
-        self.execute_command('SHUTDOWN', callbacks)
+        return self.execute_command('SHUTDOWN', callbacks)
 
     def save(self, callbacks=None):
-        self.execute_command('SAVE', callbacks)
+        return self.execute_command('SAVE', callbacks)
 
     def bgsave(self, callbacks=None):
-        self.execute_command('BGSAVE', callbacks)
+        return self.execute_command('BGSAVE', callbacks)
 
     def lastsave(self, callbacks=None):
-        self.execute_command('LASTSAVE', callbacks)
+        return self.execute_command('LASTSAVE', callbacks)
 
     def keys(self, pattern, callbacks=None):
-        self.execute_command('KEYS', callbacks, pattern)
+        return self.execute_command('KEYS', callbacks, pattern)
+
+    def scan(self, cursor, match=None, count=None, callbacks=None):
+        return self.execute_command('SCAN', callbacks, cursor, *scan_options(match, count))
+
+    def scan_iter(self, match=None, count=None):
+        return ScanIterator([self.scan], (), match, count)
 
     def auth(self, password, callbacks=None):
-        self.execute_command('AUTH', callbacks, password)
+        return self.execute_command('AUTH', callbacks, password)
 
     ### BASIC KEY COMMANDS
     def append(self, key, value, callbacks=None):
-        self.execute_command('APPEND', callbacks, key, value)
+        return self.execute_command('APPEND', callbacks, key, value)
 
     def expire(self, key, ttl, callbacks=None):
-        self.execute_command('EXPIRE', callbacks, key, ttl)
+        return self.execute_command('EXPIRE', callbacks, key, ttl)
 
     def ttl(self, key, callbacks=None):
-        self.execute_command('TTL', callbacks, key)
+        return self.execute_command('TTL', callbacks, key)
 
     def type(self, key, callbacks=None):
-        self.execute_command('TYPE', callbacks, key)
+        return self.execute_command('TYPE', callbacks, key)
 
     def randomkey(self, callbacks=None):
-        self.execute_command('RANDOMKEY', callbacks)
+        return self.execute_command('RANDOMKEY', callbacks)
 
     def rename(self, src, dst, callbacks=None):
-        self.execute_command('RENAME', callbacks, src, dst)
+        return self.execute_command('RENAME', callbacks, src, dst)
 
     def renamenx(self, src, dst, callbacks=None):
-        self.execute_command('RENAMENX', callbacks, src, dst)
+        return self.execute_command('RENAMENX', callbacks, src, dst)
 
     def move(self, key, db, callbacks=None):
-        self.execute_command('MOVE', callbacks, key, db)
+        return self.execute_command('MOVE', callbacks, key, db)
 
     def substr(self, key, start, end, callbacks=None):
-        self.execute_command('SUBSTR', callbacks, key, start, end)
+        return self.execute_command('SUBSTR', callbacks, key, start, end)
 
     def delete(self, key, callbacks=None):
-        self.execute_command('DEL', callbacks, key)
+        return self.execute_command('DEL', callbacks, key)
 
     def set(self, key, value, callbacks=None):
-        self.execute_command('SET', callbacks, key, value)
+        return self.execute_command('SET', callbacks, key, value)
+
+    def set_from_file(self, key, fileobj, length=None, callbacks=None):
+        '''
+        Sets `key` to `length` bytes read from `fileobj`, a file or an mmap,
+        by default all that is left of it. The value is read and sent in
+        chunks as the socket drains rather than formatted whole.
+        '''
+        future = None
+        if callbacks is None:
+            future = Future()
+            callbacks = [partial(resolve_future, future)]
+        elif not hasattr(callbacks, '__iter__'):
+            callbacks = [callbacks]
+        if self.timeout is not None or self.deadline is not None:
+            callbacks = self.limit_callbacks(callbacks, self.timeout, self.deadline)
+            if callbacks is None:
+                return future
+        if length is None:
+            length = file_length(fileobj)
+        cmd_line = CmdLine('SET', key, fileobj)
+        connection = self.connection
+        connection.end_flights()
+        try:
+            connection.upload(Upload(format_upload_header('SET', (key,), length), fileobj, length))
+        except ConnectionError, e:
+            self.call_callbacks(callbacks, (e, None))
+            return future
+        except IOError:
+            self._sudden_disconnect(callbacks, connection)
+            return future
+        connection.pending.append(PendingCommand(cmd_line, callbacks, self.process_reply))
+        return future
 
     def setex(self, key, ttl, value, callbacks=None):
-        self.execute_command('SETEX', callbacks, key, ttl, value)
+        return self.execute_command('SETEX', callbacks, key, ttl, value)
 
     def setnx(self, key, value, callbacks=None):
-        self.execute_command('SETNX', callbacks, key, value)
+        return self.execute_command('SETNX', callbacks, key, value)
 
     def mset(self, mapping, callbacks=None):
         items = []
         [ items.extend(pair) for pair in mapping.iteritems() ]
-        self.execute_command('MSET', callbacks, *items)
+        return self.execute_command('MSET', callbacks, *items)
 
     def msetnx(self, mapping, callbacks=None):
         items = []
         [ items.extend(pair) for pair in mapping.iteritems() ]
-        self.execute_command('MSETNX', callbacks, *items)
+        return self.execute_command('MSETNX', callbacks, *items)
 
     def get(self, key, callbacks=None):
-        self.execute_command('GET', callbacks, key)
+        return self.execute_command('GET', callbacks, key)
+
+    def get_stream(self, key, sink, callbacks=None):
+        '''
+        Writes the value of `key` to `sink`, a file-like object or a
+        callable, chunk by chunk as it arrives. Callbacks get the length of
+        the value, None when there is no such key.
+        '''
+        return self.execute_command('GET', callbacks, key, sink=sink)
 
     def mget(self, keys, callbacks=None):
-        self.execute_command('MGET', callbacks, *keys)
+        return self.execute_command('MGET', callbacks, *keys)
 
     def getset(self, key, value, callbacks=None):
-        self.execute_command('GETSET', callbacks, key, value)
+        return self.execute_command('GETSET', callbacks, key, value)
 
     def exists(self, key, callbacks=None):
-        self.execute_command('EXISTS', callbacks, key)
+        return self.execute_command('EXISTS', callbacks, key)
 
     def sort(self, key, start=None, num=None, by=None, get=None, desc=False, alpha=False, store=None, callbacks=None):
         if (start is not None and num is None) or (num is not None and start is None):
@@ -471,137 +1560,143 @@ class Client(object):
 
     ### COUNTERS COMMANDS
     def incr(self, key, callbacks=None):
-        self.execute_command('INCR', callbacks, key)
+        return self.execute_command('INCR', callbacks, key)
 
     def decr(self, key, callbacks=None):
-        self.execute_command('DECR', callbacks, key)
+        return self.execute_command('DECR', callbacks, key)
 
     def incrby(self, key, amount, callbacks=None):
-        self.execute_command('INCRBY', callbacks, key, amount)
+        return self.execute_command('INCRBY', callbacks, key, amount)
 
     def decrby(self, key, amount, callbacks=None):
-        self.execute_command('DECRBY', callbacks, key, amount)
+        return self.execute_command('DECRBY', callbacks, key, amount)
 
     ### LIST COMMANDS
     def blpop(self, keys, timeout=0, callbacks=None):
         tokens = list(keys)
         tokens.append(timeout)
-        self.execute_command('BLPOP', callbacks, *tokens)
+        return self.execute_command('BLPOP', callbacks, *tokens)
 
     def brpop(self, keys, timeout=0, callbacks=None):
         tokens = list(keys)
         tokens.append(timeout)
-        self.execute_command('BRPOP', callbacks, *tokens)
+        return self.execute_command('BRPOP', callbacks, *tokens)
 
     def lindex(self, key, index, callbacks=None):
-        self.execute_command('LINDEX', callbacks, key, index)
+        return self.execute_command('LINDEX', callbacks, key, index)
 
     def llen(self, key, callbacks=None):
-        self.execute_command('LLEN', callbacks, key)
+        return self.execute_command('LLEN', callbacks, key)
 
     def lrange(self, key, start, end, callbacks=None):
-        self.execute_command('LRANGE', callbacks, key, start, end)
+        return self.execute_command('LRANGE', callbacks, key, start, end)
 
     def lrem(self, key, value, num=0, callbacks=None):
-        self.execute_command('LREM', callbacks, key, num, value)
+        return self.execute_command('LREM', callbacks, key, num, value)
 
     def lset(self, key, index, value, callbacks=None):
-        self.execute_command('LSET', callbacks, key, index, value)
+        return self.execute_command('LSET', callbacks, key, index, value)
 
     def ltrim(self, key, start, end, callbacks=None):
-        self.execute_command('LTRIM', callbacks, key, start, end)
+        return self.execute_command('LTRIM', callbacks, key, start, end)
 
     def lpush(self, key, value, callbacks=None):
-        self.execute_command('LPUSH', callbacks, key, value)
+        return self.execute_command('LPUSH', callbacks, key, value)
 
     def rpush(self, key, value, callbacks=None):
-        self.execute_command('RPUSH', callbacks, key, value)
+        return self.execute_command('RPUSH', callbacks, key, value)
 
     def lpop(self, key, callbacks=None):
-        self.execute_command('LPOP', callbacks, key)
+        return self.execute_command('LPOP', callbacks, key)
 
     def rpop(self, key, callbacks=None):
-        self.execute_command('RPOP', callbacks, key)
+        return self.execute_command('RPOP', callbacks, key)
 
     def rpoplpush(self, src, dst, callbacks=None):
-        self.execute_command('RPOPLPUSH', callbacks, src, dst)
+        return self.execute_command('RPOPLPUSH', callbacks, src, dst)
 
     ### SET COMMANDS
     def sadd(self, key, value, callbacks=None):
-        self.execute_command('SADD', callbacks, key, value)
+        return self.execute_command('SADD', callbacks, key, value)
 
     def srem(self, key, value, callbacks=None):
-        self.execute_command('SREM', callbacks, key, value)
+        return self.execute_command('SREM', callbacks, key, value)
 
     def scard(self, key, callbacks=None):
-        self.execute_command('SCARD', callbacks, key)
+        return self.execute_command('SCARD', callbacks, key)
 
     def spop(self, key, callbacks=None):
-        self.execute_command('SPOP', callbacks, key)
+        return self.execute_command('SPOP', callbacks, key)
 
     def smove(self, src, dst, value, callbacks=None):
-        self.execute_command('SMOVE', callbacks, src, dst, value)
+        return self.execute_command('SMOVE', callbacks, src, dst, value)
 
     def sismember(self, key, value, callbacks=None):
-        self.execute_command('SISMEMBER', callbacks, key, value)
+        return self.execute_command('SISMEMBER', callbacks, key, value)
 
     def smembers(self, key, callbacks=None):
-        self.execute_command('SMEMBERS', callbacks, key)
+        return self.execute_command('SMEMBERS', callbacks, key)
 
     def srandmember(self, key, callbacks=None):
-        self.execute_command('SRANDMEMBER', callbacks, key)
+        return self.execute_command('SRANDMEMBER', callbacks, key)
 
     def sinter(self, keys, callbacks=None):
-        self.execute_command('SINTER', callbacks, *keys)
+        return self.execute_command('SINTER', callbacks, *keys)
 
     def sdiff(self, keys, callbacks=None):
-        self.execute_command('SDIFF', callbacks, *keys)
+        return self.execute_command('SDIFF', callbacks, *keys)
 
     def sunion(self, keys, callbacks=None):
-        self.execute_command('SUNION', callbacks, *keys)
+        return self.execute_command('SUNION', callbacks, *keys)
 
     def sinterstore(self, keys, dst, callbacks=None):
-        self.execute_command('SINTERSTORE', callbacks, dst, *keys)
+        return self.execute_command('SINTERSTORE', callbacks, dst, *keys)
 
     def sunionstore(self, keys, dst, callbacks=None):
-        self.execute_command('SUNIONSTORE', callbacks, dst, *keys)
+        return self.execute_command('SUNIONSTORE', callbacks, dst, *keys)
 
     def sdiffstore(self, keys, dst, callbacks=None):
-        self.execute_command('SDIFFSTORE', callbacks, dst, *keys)
+        return self.execute_command('SDIFFSTORE', callbacks, dst, *keys)
+
+    def sscan(self, key, cursor, match=None, count=None, callbacks=None):
+        return self.execute_command('SSCAN', callbacks, key, cursor, *scan_options(match, count))
+
+    def sscan_iter(self, key, match=None, count=None):
+        return ScanIterator([self.sscan], (key,), match, count)
 
     ### SORTED SET COMMANDS
     def zadd(self, key, score, value, callbacks=None):
-        self.execute_command('ZADD', callbacks, key, score, value)
+        return self.execute_command('ZADD', callbacks, key, score, value)
 
     def zcard(self, key, callbacks=None):
-        self.execute_command('ZCARD', callbacks, key)
+        return self.execute_command('ZCARD', callbacks, key)
 
     def zincrby(self, key, value, amount, callbacks=None):
-        self.execute_command('ZINCRBY', callbacks, key, amount, value)
+        return self.execute_command('ZINCRBY', callbacks, key, amount, value)
 
     def zrank(self, key, value, callbacks=None):
-        self.execute_command('ZRANK', callbacks, key, value)
+        return self.execute_command('ZRANK', callbacks, key, value)
 
     def zrevrank(self, key, value, callbacks=None):
-        self.execute_command('ZREVRANK', callbacks, key, value)
+        return self.execute_command('ZREVRANK', callbacks, key, value)
 
     def zrem(self, key, value, callbacks=None):
-        self.execute_command('ZREM', callbacks, key, value)
+        return self.execute_command('ZREM', callbacks, key, value)
 
     def zscore(self, key, value, callbacks=None):
-        self.execute_command('ZSCORE', callbacks, key, value)
+        return self.execute_command('ZSCORE', callbacks, key, value)
 
     def zrange(self, key, start, num, with_scores, callbacks=None):
         tokens = [key, start, num]
         if with_scores:
             tokens.append('WITHSCORES')
-        self.execute_command('ZRANGE', callbacks, *tokens)
+        return self.execute_command('ZRANGE', callbacks, *tokens)
 
     def zrevrange(self, key, start, num, with_scores, callbacks=None):
         tokens = [key, start, num]
         if with_scores:
             tokens.append('WITHSCORES')
-        self.execute_command('ZREVRANGE', callbacks, *tokens)
+        return self.execute_command('ZREVRANGE', callbacks, *tokens)
 
     def zrangebyscore(self, key, start, end, offset=None, limit=None, with_scores=False, callbacks=None):
         tokens = [key, start, end]
@@ -611,13 +1706,13 @@ class Client(object):
             tokens.append(limit)
         if with_scores:
             tokens.append('WITHSCORES')
-        self.execute_command('ZRANGEBYSCORE', callbacks, *tokens)
+        return self.execute_command('ZRANGEBYSCORE', callbacks, *tokens)
 
     def zremrangebyrank(self, key, start, end, callbacks=None):
-        self.execute_command('ZREMRANGEBYRANK', callbacks, key, start, end)
+        return self.execute_command('ZREMRANGEBYRANK', callbacks, key, start, end)
 
     def zremrangebyscore(self, key, start, end, callbacks=None):
-        self.execute_command('ZREMRANGEBYSCORE', callbacks, key, start, end)
+        return self.execute_command('ZREMRANGEBYSCORE', callbacks, key, start, end)
 
     def zinterstore(self, dest, keys, aggregate=None, callbacks=None):
         return self._zaggregate('ZINTERSTORE', dest, keys, aggregate, callbacks)
@@ -642,41 +1737,53 @@ class Client(object):
             tokens.append(aggregate)
         return self.execute_command(command, callbacks, *tokens)
 
+    def zscan(self, key, cursor, match=None, count=None, callbacks=None):
+        return self.execute_command('ZSCAN', callbacks, key, cursor, *scan_options(match, count))
+
+    def zscan_iter(self, key, match=None, count=None):
+        return ScanIterator([self.zscan], (key,), match, count)
+
     ### HASH COMMANDS
     def hgetall(self, key, callbacks=None):
-        self.execute_command('HGETALL', callbacks, key)
+        return self.execute_command('HGETALL', callbacks, key)
 
     def hmset(self, key, mapping, callbacks=None):
         items = []
         [ items.extend(pair) for pair in mapping.iteritems() ]
-        self.execute_command('HMSET', callbacks, key, *items)
+        return self.execute_command('HMSET', callbacks, key, *items)
 
     def hset(self, key, field, value, callbacks=None):
-        self.execute_command('HSET', callbacks, key, field, value)
+        return self.execute_command('HSET', callbacks, key, field, value)
 
     def hget(self, key, field, callbacks=None):
-        self.execute_command('HGET', callbacks, key, field)
+        return self.execute_command('HGET', callbacks, key, field)
 
     def hdel(self, key, field, callbacks=None):
-        self.execute_command('HDEL', callbacks, key, field)
+        return self.execute_command('HDEL', callbacks, key, field)
 
     def hlen(self, key, callbacks=None):
-        self.execute_command('HLEN', callbacks, key)
+        return self.execute_command('HLEN', callbacks, key)
 
     def hexists(self, key, field, callbacks=None):
-        self.execute_command('HEXISTS', callbacks, key, field)
+        return self.execute_command('HEXISTS', callbacks, key, field)
 
     def hincrby(self, key, field, amount=1, callbacks=None):
-        self.execute_command('HINCRBY', callbacks, key, field, amount)
+        return self.execute_command('HINCRBY', callbacks, key, field, amount)
 
     def hkeys(self, key, callbacks=None):
-        self.execute_command('HKEYS', callbacks, key)
+        return self.execute_command('HKEYS', callbacks, key)
 
     def hmget(self, key, fields, callbacks=None):
-        self.execute_command('HMGET', callbacks, key, *fields)
+        return self.execute_command('HMGET', callbacks, key, *fields)
 
     def hvals(self, key, callbacks=None):
-        self.execute_command('HVALS', callbacks, key)
+        return self.execute_command('HVALS', callbacks, key)
+
+    def hscan(self, key, cursor, match=None, count=None, callbacks=None):
+        return self.execute_command('HSCAN', callbacks, key, cursor, *scan_options(match, count))
+
+    def hscan_iter(self, key, match=None, count=None):
+        return ScanIterator([self.hscan], (key,), match, count)
 
     ### PUBSUB
     def subscribe(self, channels, callbacks=None):
@@ -684,7 +1791,7 @@ class Client(object):
         if isinstance(channels, basestring):
             channels = [channels]
         callbacks = list(callbacks) + [self.on_subscribed]
-        self.execute_command('SUBSCRIBE', callbacks, *channels)
+        return self.execute_command('SUBSCRIBE', callbacks, *channels)
 
     def on_subscribed(self, result):
         (e, _) = result
@@ -696,120 +1803,277 @@ class Client(object):
         if isinstance(channels, basestring):
             channels = [channels]
         callbacks = list(callbacks) + [self.on_unsubscribed]
-        self.execute_command('UNSUBSCRIBE', callbacks, *channels)
+        return self.execute_command('UNSUBSCRIBE', callbacks, *channels)
 
     def on_unsubscribed(self, result):
         (e, _) = result
         if not e:
             self.subscribed = False
 
+    def psubscribe(self, patterns, callbacks=None):
+        callbacks = callbacks or []
+        if isinstance(patterns, basestring):
+            patterns = [patterns]
+        callbacks = list(callbacks) + [self.on_subscribed]
+        return self.execute_command('PSUBSCRIBE', callbacks, *patterns)
+
+    def punsubscribe(self, patterns, callbacks=None):
+        callbacks = callbacks or []
+        if isinstance(patterns, basestring):
+            patterns = [patterns]
+        callbacks = list(callbacks) + [self.on_unsubscribed]
+        return self.execute_command('PUNSUBSCRIBE', callbacks, *patterns)
+
     def publish(self, channel, message, callbacks=None):
-        self.execute_command('PUBLISH', callbacks, channel, message)
+        return self.execute_command('PUBLISH', callbacks, channel, message)
 
-    @process
     def listen(self, callbacks=None):
-        # 'LISTEN' is just for exception information, it is not actually sent anywhere
         callbacks = callbacks or []
         if not hasattr(callbacks, '__iter__'):
             callbacks = [callbacks]
+        if self.pool is not None:
+            self.with_dedicated('pubsub', partial(self._listen, callbacks))
+        else:
+            self._listen(callbacks, self.connection)
 
-        yield self.connection.queue_wait()
-        cmd_listen = CmdLine('LISTEN')
-        while self.subscribed:
-            data = yield async(self.connection.readline)()
-            try:
-                error, response = yield self.process_data(data, cmd_listen)
-                result = self.format_reply(cmd_listen, response)
-            except Exception, e:
-                error, result = e, None
+    def _listen(self, callbacks, connection):
+        connection.pending.append(PendingListen(self, connection, callbacks))
+        # messages may already be buffered in the reader
+        self._io_loop.add_callback(connection.dispatch_replies)
+
+    ### SCRIPTING
+    def eval(self, script, keys=(), args=(), callbacks=None):
+        return self.execute_command('EVAL', callbacks, script, len(keys), *(tuple(keys) + tuple(args)))
 
-            self.call_callbacks(callbacks, (error, result) )
+    def evalsha(self, sha, keys=(), args=(), callbacks=None):
+        return self.execute_command('EVALSHA', callbacks, sha, len(keys), *(tuple(keys) + tuple(args)))
+
+    def script_load(self, script, callbacks=None):
+        return self.execute_command('SCRIPT', callbacks, 'LOAD', script)
+
+    def script_exists(self, shas, callbacks=None):
+        return self.execute_command('SCRIPT', callbacks, 'EXISTS', *shas)
+
+    def script_flush(self, callbacks=None):
+        return self.execute_command('SCRIPT', callbacks, 'FLUSH')
+
+    def register_script(self, source):
+        return Script(self, source)
 
     ### CAS
     def watch(self, key, callbacks=None):
-        self.execute_command('WATCH', callbacks, key)
+        return self.execute_command('WATCH', callbacks, key)
 
     def unwatch(self, callbacks=None):
-        self.execute_command('UNWATCH', callbacks)
+        return self.execute_command('UNWATCH', callbacks)
+
+    def transaction(self, func, *keys, **kwargs):
+        '''
+        Runs `func` as an optimistic transaction on `keys`, see Transaction.
+        Takes `callbacks`, `max_attempts` and `backoff`, the delay in seconds
+        before the first retry, as keyword arguments. Callbacks get the
+        results of the pipeline, or a single (error, None) pair.
+        '''
+        callbacks = kwargs.pop('callbacks', None)
+        future = None
+        if callbacks is None:
+            future = Future()
+            callbacks = [partial(resolve_pipeline_future, future)]
+        elif not hasattr(callbacks, '__iter__'):
+            callbacks = [callbacks]
+        self.transactions += 1
+        Transaction(self, func, keys, callbacks, **kwargs).run()
+        return future
+
+    def pinned(self):
+        # shares the connections of this client, with pipelines and dedicated
+        # connections of its own
+        client = copy.copy(self)
+        client._free_pipelines = []
+        client._dedicated = {}
+        return client
 
 class Pipeline(Client):
-    def __init__(self, transactional, *args, **kwargs):
-        super(Pipeline, self).__init__(*args, **kwargs)
+    '''
+    Commands queued and sent to the connection of `client` together.
+
+    Every call of Client.pipeline gets a pipeline of its own, which shares
+    the connections of the client and may be executed any number of times.
+    Callbacks given to its commands are called with their own results, ahead
+    of the callbacks of `execute`. A pipeline no longer used may be handed
+    back with `release`, for the next Client.pipeline call to reuse, e.g. by
+    request handlers making one per request; it must not be used after that.
+    Other pipelines and transactions are those of the client.
+    '''
+    def __init__(self, client, transactional=False):
+        self.client = client
         self.transactional = transactional
+        self.connection = client.connection
+        self.pool = client.pool
+        self._dedicated = client._dedicated
+        self._io_loop = client._io_loop
+        self.timeout = client.timeout
+        self.deadline = client.deadline
+        self.stats = client.stats
+        self.subscribed = False
         self.command_stack = []
+        self.command_callbacks = []
+
+    def __repr__(self):
+        return 'Brukva pipeline (host=%s, port=%s, commands=%s)' % (
+            self.connection.host, self.connection.port, len(self.command_stack))
+
+    def _get_transactions(self):
+        return self.client.transactions
+
+    transactions = property(_get_transactions)
+
+    def _get_transaction_retries(self):
+        return self.client.transaction_retries
+
+    transaction_retries = property(_get_transaction_retries)
+
+    def pipeline(self, transactional=False):
+        return self.client.pipeline(transactional)
+
+    def transaction(self, func, *keys, **kwargs):
+        return self.client.transaction(func, *keys, **kwargs)
 
     def execute_command(self, cmd, callbacks, *args, **kwargs):
-        if cmd in ('AUTH'):
+        if cmd == 'AUTH':
             raise Exception('403')
+        if callbacks is not None and not hasattr(callbacks, '__iter__'):
+            callbacks = [callbacks]
         self.command_stack.append(CmdLine(cmd, *args, **kwargs))
+        self.command_callbacks.append(callbacks)
 
     def discard(self): # actually do nothing with redis-server, just flush command_stack
         self.command_stack = []
+        self.command_callbacks = []
 
-    @process
-    def execute(self, callbacks):
+    def release(self):
+        self.discard()
+        free = self.client._free_pipelines
+        if len(free) < MAX_FREE_PIPELINES and self not in free:
+            free.append(self)
+
+    def execute(self, callbacks=None, timeout=None, deadline=None):
+        # without callbacks, returns a Future of the list of (error, result)
+        # pairs, an empty list of them ignores it
         command_stack = self.command_stack
+        command_callbacks = self.command_callbacks
         self.command_stack = []
+        self.command_callbacks = []
 
+        future = None
         if callbacks is None:
-            callbacks = []
+            future = Future()
+            callbacks = [partial(resolve_pipeline_future, future)]
         elif not hasattr(callbacks, '__iter__'):
             callbacks = [callbacks]
 
+        if not command_stack:
+            self.call_callbacks(callbacks, [])
+            return future
+        if any(command_callbacks):
+            callbacks = [partial(call_command_callbacks, command_callbacks)] + callbacks
+
+        timeout = self.timeout if timeout is None else timeout
+        deadline = self.deadline if deadline is None else deadline
+        if timeout is not None or deadline is not None:
+            callbacks = self.limit_callbacks(callbacks, timeout, deadline)
+            if callbacks is None:
+                return future
+
         if self.transactional:
             command_stack = [CmdLine('MULTI')] + command_stack + [CmdLine('EXEC')]
 
-        request =  format_pipeline_request(command_stack)
+        if self.pool is not None and self.transactional and 'watch' in self._dedicated:
+            # EXEC has to go to the connection holding the WATCH, which is
+            # clean again once it has been replied to
+            callbacks = [lambda result: self.release_dedicated('watch')] + callbacks
+            self.with_dedicated('watch', partial(self.send_pipeline, command_stack, callbacks))
+        else:
+            self.send_pipeline(command_stack, callbacks, self.connection)
+        return future
+
+    def send_pipeline(self, command_stack, callbacks, connection):
+        if self.load_scripts(command_stack, connection):
+            callbacks = [partial(self.check_scripts, connection)] + callbacks
+        if self.stats is not None:
+            callbacks = [partial(self.record_pipeline, command_stack, time.time())] + callbacks
+        request = []
+        for c in command_stack:
+            pack_command(request, c.cmd, c.args)
+        connection.end_flights()
         try:
-            self.connection.write(request)
+            connection.write(request)
+        except ConnectionError, e:
+            self.call_callbacks(callbacks, (e, None))
+            return
         except IOError:
-            self.command_stack = []
-            self._sudden_disconnect(callbacks)
+            self._sudden_disconnect(callbacks, connection)
             return
+        connection.pending.append(PendingPipeline(command_stack, callbacks, self.format_replies))
+
+    def load_scripts(self, command_stack, connection):
+        # registered scripts the pipeline calls, not loaded on the
+        # connection yet, are loaded ahead of it. Returns whether it calls any
+        calls = False
+        for cmd_line in command_stack:
+            if cmd_line.cmd != 'EVALSHA':
+                continue
+            calls = True
+            sha = cmd_line.args[0]
+            if sha in connection.scripts or sha not in SCRIPTS:
+                continue
+            connection.scripts.add(sha)
+            self.send_command(connection, CmdLine('SCRIPT', 'LOAD', SCRIPTS[sha]),
+                              [partial(self.on_script_loaded, connection, sha)])
+        return calls
+
+    def on_script_loaded(self, connection, sha, result):
+        (error, _) = result
+        if error:
+            connection.scripts.discard(sha)
+
+    def check_scripts(self, connection, results):
+        # scripts flushed from the server since they were loaded are loaded
+        # again by the next pipeline
+        if isinstance(results, tuple):
+            return
+        for error, _ in results:
+            if isinstance(error, ResponseError) and error.message.startswith('NOSCRIPT') and error.cmd_line:
+                connection.scripts.discard(error.cmd_line.args[0])
 
-        yield self.connection.queue_wait()
+    def split_replies(self, cmd_lines, replies):
         responses = []
-        total = len(command_stack)
-        cmds = iter(command_stack)
-        while len(responses) < total:
-            data = yield async(self.connection.readline)()
-            if not data:
-                break
-            try:
-                cmd_line = cmds.next()
-                if self.transactional and cmd_line.cmd != 'EXEC':
-                    error, response = yield self.process_data(data, CmdLine('MULTI_PART'))
-                else:
-                    error, response = yield self.process_data(data, cmd_line)
-            except Exception, e:
-                error, response  = e, None
-
-            responses.append((error, response ) )
-        self.connection.read_done()
-
-        def format_replies(cmd_lines, responses):
-            result = []
-
-            for cmd_line, (error, response) in zip(cmd_lines, responses):
-                if not error:
-                    result.append((None,  self.format_reply(cmd_line, response)))
-                else:
-                    result.append((error, response))
-            return result
-
-        if self.transactional:
-            command_stack = command_stack[:-1]
-            errors, tr_responses = responses[-1] # actual data only from EXEC command
-            responses = [
-                (errors.get(idx, None), tr_responses[idx])
-                for idx in xrange(len(tr_responses))
-            ]
-
-            result = format_replies(command_stack[1:], responses)
-
-        else:
-            result = format_replies(command_stack, responses)
-
-        self.call_callbacks(callbacks, result)
+        for cmd_line, reply in izip(cmd_lines, replies):
+            if isinstance(reply, ResponseError):
+                reply.cmd_line = cmd_line
+                responses.append((reply, None))
+            else:
+                responses.append((None, reply))
+        return responses
 
+    def format_replies(self, command_stack, replies):
+        responses = self.split_replies(command_stack, replies)
 
+        # told by the commands sent, the pipeline may have been reused since
+        if command_stack[0].cmd == 'MULTI':
+            command_stack = command_stack[1:-1]
+            error, tr_responses = responses[-1] # actual data only from EXEC command
+            if error:
+                tr_responses = [error] * len(command_stack)
+            elif tr_responses is None:
+                # a watched key changed, nothing was run
+                return (WatchError('Watched keys changed, the transaction was aborted'), None)
+            responses = self.split_replies(command_stack, tr_responses or [])
+
+        result = []
+        for cmd_line, (error, response) in zip(command_stack, responses):
+            if not error:
+                result.append((None,  self.format_reply(cmd_line, response)))
+            else:
+                result.append((error, response))
+        return result
@@ -0,0 +1,455 @@
+# -*- coding: utf-8 -*-
+from functools import partial
+from tornado.ioloop import IOLoop
+
+from brukva.client import (Client, Future, ScanIterator, call_command_callbacks, resolve_future,
+                           resolve_pipeline_future)
+from brukva.commands import COMMANDS
+from brukva.exceptions import RedisError, ConnectionError, ResponseError
+from brukva.sharding import (Gather, hash_tag, merge_ordered, BROADCAST_COMMANDS, MULTI_KEY_COMMANDS,
+                             PUBSUB_COMMANDS, SPLIT_COMMANDS)
+
+
+SLOTS = 16384
+
+def make_crc16_table():
+    # CRC-16/XMODEM, the one of the cluster specification
+    table = []
+    for byte in xrange(256):
+        crc = byte << 8
+        for _ in xrange(8):
+            crc = ((crc << 1) ^ 0x1021 if crc & 0x8000 else crc << 1) & 0xffff
+        table.append(crc)
+    return table
+
+CRC16_TABLE = make_crc16_table()
+
+def crc16(data):
+    crc = 0
+    for c in data:
+        crc = ((crc << 8) & 0xffff) ^ CRC16_TABLE[(crc >> 8) ^ ord(c)]
+    return crc
+
+def key_slot(key):
+    return crc16(hash_tag(key)) % SLOTS
+
+def parse_redirect(error):
+    # (kind, slot, node name) of a MOVED or ASK error, or None
+    if not isinstance(error, ResponseError):
+        return None
+    parts = error.message.split()
+    if len(parts) != 3 or parts[0] not in ('MOVED', 'ASK'):
+        return None
+    return parts[0], int(parts[1]), parts[2]
+
+
+class ClusterClient(Client):
+    '''
+    Client of a Redis Cluster.
+
+    `nodes` are Client instances or (host, port) pairs of some of the nodes
+    of the cluster. On connect the slot map is loaded with CLUSTER SLOTS from
+    the first of them that answers, and a client is made for every master,
+    with the remaining arguments of Client. Commands are sent to the master
+    of the slot of their key, the CRC16 of the key (or of its hash tag, as
+    '{user:42}' in '{user:42}:name') modulo 16384, and commands sent before
+    the map is there wait for it.
+
+    A MOVED reply points the slot at the node named and has the map loaded
+    anew, the command is sent again to that node. A lost connection to a
+    node has the map loaded anew too. An ASK reply sends the
+    command once to the node named, after ASKING. A command is redirected
+    at most `max_redirects` times, after that the error is its reply.
+
+    As on ShardedClient, MGET, MSET and DEL are split, here by slot, keyless
+    commands go to every master, other commands using several keys must
+    have all of them in one slot, and scan_iter walks the masters one after
+    the other. Pipelines are split by node, their redirected commands are
+    sent again on their own, apart from transactional ones, which need all
+    of their keys on one node and are not redirected. Pub/sub and the other
+    keyless commands (MULTI, EXEC, UNWATCH...) are not supported, use the
+    client of a node directly. The timeout and deadline of a bounded()
+    cluster client apply to the commands it sends to the nodes. A
+    transaction runs on the node of its watched keys, which must all be in
+    one slot.
+    '''
+    def __init__(self, nodes, io_loop=None, max_redirects=5, **kwargs):
+        self._io_loop = io_loop or IOLoop.instance()
+        self.node_options = kwargs
+        self.max_redirects = max_redirects
+        # clients by 'host:port', and the ones to ask for the slot map first
+        self.nodes = {}
+        self.startup_nodes = []
+        for node in nodes:
+            if isinstance(node, Client):
+                name = '%s:%s' % (node.connection.host, node.connection.port)
+                self.nodes[name] = node
+            else:
+                name = '%s:%s' % tuple(node)
+            self.startup_nodes.append(name)
+        # master name by slot, and the masters
+        self.slots = [None] * SLOTS
+        self.names = []
+        # callbacks waiting for the slot map being loaded
+        self._loading = None
+        self.pool = None
+        self.timeout = None
+        self.deadline = None
+        self.subscribed = False
+
+    def __repr__(self):
+        return 'Brukva cluster client (%s)' % ', '.join(self.names or self.startup_nodes)
+
+    def pipeline(self, transactional=False):
+        return ClusterPipeline(self, transactional)
+
+    def get_node(self, name):
+        node = self.nodes.get(name)
+        if node is None:
+            host, port = name.rsplit(':', 1)
+            node = self.nodes[name] = Client(host, int(port), io_loop=self._io_loop, **self.node_options)
+            node.connect()
+        return node
+
+    def get_client(self, name):
+        # the node, bounded as this client is
+        node = self.get_node(name)
+        if self.timeout is None and self.deadline is None:
+            return node
+        return node.bounded(self.timeout, self.deadline)
+
+    def get_slot_node(self, slot):
+        return self.get_client(self.slots[slot])
+
+    def connect(self, callbacks=None):
+        if callbacks is None:
+            callbacks = []
+        elif not hasattr(callbacks, '__iter__'):
+            callbacks = [callbacks]
+        for name in self.startup_nodes:
+            node = self.nodes.get(name)
+            if node is not None and not node.connection.connected() and not node.connection.connecting:
+                node.connect()
+        self.load_slots(callbacks)
+
+    def disconnect(self):
+        for node in self.nodes.itervalues():
+            node.disconnect()
+
+    def listen(self, callbacks=None):
+        callbacks = callbacks or []
+        if not hasattr(callbacks, '__iter__'):
+            callbacks = [callbacks]
+        error = RedisError('Pub/sub is not supported on a cluster, use the client of a node')
+        self.call_callbacks(callbacks, (error, None))
+
+    def set_from_file(self, key, fileobj, length=None, callbacks=None):
+        return self.get_slot_node(key_slot(key)).set_from_file(key, fileobj, length, callbacks)
+
+    def scan_iter(self, match=None, count=None):
+        return ScanIterator([self.get_client(name).scan for name in self.names], (), match, count)
+
+    def load_slots(self, callbacks=None):
+        # asks the startup nodes, then the masters known, in turn
+        callbacks = callbacks or []
+        if self._loading is not None:
+            self._loading.extend(callbacks)
+            return
+        self._loading = list(callbacks)
+        candidates = self.startup_nodes + [name for name in self.names if name not in self.startup_nodes]
+        self.ask_slots(candidates, None)
+
+    def ask_slots(self, candidates, error):
+        if not candidates:
+            self.on_loaded((error or RedisError('No node to ask for the slot map'), None))
+            return
+        self.get_node(candidates[0]).execute_command('CLUSTER', partial(self.on_slots, candidates), 'SLOTS')
+
+    def on_slots(self, candidates, result):
+        (error, data) = result
+        if error is None and not data:
+            error = RedisError('No slots served by %s' % candidates[0])
+        if error:
+            self.ask_slots(candidates[1:], error)
+            return
+        slots = [None] * SLOTS
+        names = set()
+        for entry in data:
+            start, end, master = entry[0], entry[1], entry[2]
+            name = '%s:%s' % (master[0], master[1])
+            slots[start:end+1] = [name] * (end - start + 1)
+            names.add(name)
+        self.slots = slots
+        self.names = sorted(names)
+        for name in self.names:
+            self.get_node(name)
+        self.on_loaded((None, True))
+
+    def on_loaded(self, result):
+        callbacks, self._loading = self._loading, None
+        for callback in callbacks:
+            callback(result)
+
+    def transaction(self, func, *keys, **kwargs):
+        callbacks = kwargs.pop('callbacks', None)
+        future = None
+        if callbacks is None:
+            future = Future()
+            callbacks = [partial(resolve_pipeline_future, future)]
+        elif not hasattr(callbacks, '__iter__'):
+            callbacks = [callbacks]
+        slots = set(key_slot(key) for key in keys)
+        if len(slots) != 1:
+            self.call_callbacks(callbacks, (RedisError('Keys of a transaction must map to one slot'), None))
+        elif not self.names:
+            self.load_slots([partial(self.on_transaction_ready, func, keys, callbacks, kwargs)])
+        elif self.slots[key_slot(keys[0])] is None:
+            self.load_slots()
+            self.call_callbacks(callbacks, (RedisError('Slot %s is not served' % key_slot(keys[0])), None))
+        else:
+            self.get_slot_node(key_slot(keys[0])).transaction(func, *keys, callbacks=callbacks, **kwargs)
+        return future
+
+    def on_transaction_ready(self, func, keys, callbacks, kwargs, result):
+        (error, _) = result
+        if error:
+            self.call_callbacks(callbacks, (error, None))
+        else:
+            self.transaction(func, *keys, callbacks=callbacks, **kwargs)
+
+    def route(self, cmd, args):
+        keys = MULTI_KEY_COMMANDS.get(cmd)
+        if keys is None:
+            command = COMMANDS.get(cmd)
+            if not args or (command is not None and command.keys is None):
+                raise RedisError('%s has no key to be routed by' % cmd)
+            return key_slot(args[0])
+        slots = set(key_slot(key) for key in keys(args))
+        if len(slots) > 1:
+            raise RedisError('Keys of %s map to different slots' % cmd)
+        if not slots:
+            raise RedisError('%s without keys can not be routed' % cmd)
+        return slots.pop()
+
+    def execute_command(self, cmd, callbacks, *args, **kwargs):
+        future = None
+        if callbacks is None:
+            future = Future()
+            callbacks = [partial(resolve_future, future)]
+        elif not hasattr(callbacks, '__iter__'):
+            callbacks = [callbacks]
+        if cmd in PUBSUB_COMMANDS:
+            error = RedisError('Pub/sub is not supported on a cluster, use the client of a node')
+            self.call_callbacks(callbacks, (error, None))
+        elif not self.names:
+            self.load_slots([partial(self.on_ready, cmd, callbacks, args, kwargs)])
+        elif cmd == 'SCAN':
+            self.call_callbacks(callbacks, (RedisError('SCAN is not supported on a cluster, use scan_iter'), None))
+        elif cmd in BROADCAST_COMMANDS:
+            self.execute_broadcast(cmd, callbacks, args, kwargs)
+        elif cmd in SPLIT_COMMANDS:
+            self.execute_split(cmd, callbacks, args, kwargs)
+        else:
+            try:
+                slot = self.route(cmd, args)
+            except RedisError, e:
+                self.call_callbacks(callbacks, (e, None))
+                return future
+            self.send(slot, cmd, callbacks, args, kwargs)
+        return future
+
+    def on_ready(self, cmd, callbacks, args, kwargs, result):
+        (error, _) = result
+        if error:
+            self.call_callbacks(callbacks, (error, None))
+        else:
+            self.execute_command(cmd, callbacks, *args, **kwargs)
+
+    def execute_broadcast(self, cmd, callbacks, args, kwargs):
+        merge = BROADCAST_COMMANDS[cmd] or (lambda results: dict(zip(self.names, results)))
+        gather = Gather(len(self.names), merge, callbacks)
+        for i, name in enumerate(self.names):
+            self.get_client(name).execute_command(cmd, gather.callback(i), *args, **kwargs)
+
+    def execute_split(self, cmd, callbacks, args, kwargs):
+        step, merge = SPLIT_COMMANDS[cmd]
+        if not args:
+            self.call_callbacks(callbacks, (RedisError('%s without keys can not be routed' % cmd), None))
+            return
+        # slot -> (positions of its keys, its arguments)
+        groups = {}
+        for i in xrange(0, len(args), step):
+            positions, slot_args = groups.setdefault(key_slot(args[i]), ([], []))
+            positions.append(i // step)
+            slot_args.extend(args[i:i+step])
+        if len(groups) == 1:
+            self.send(groups.keys()[0], cmd, callbacks, args, kwargs)
+            return
+        groups = groups.items()
+        if merge is None:
+            merge = merge_ordered(len(args) // step, [positions for _, (positions, _) in groups])
+        gather = Gather(len(groups), merge, callbacks)
+        for i, (slot, (_, slot_args)) in enumerate(groups):
+            self.send(slot, cmd, [gather.callback(i)], slot_args, kwargs)
+
+    def send(self, slot, cmd, callbacks, args, kwargs, redirects=0, name=None, asking=False):
+        name = name or self.slots[slot]
+        if name is None:
+            # the map may be out of date
+            self.load_slots()
+            self.call_callbacks(callbacks, (RedisError('Slot %s is not served' % slot), None))
+            return
+        node = self.get_client(name)
+        if asking:
+            node.execute_command('ASKING', [])
+        node.execute_command(cmd, partial(self.on_reply, slot, cmd, callbacks, args, kwargs, redirects),
+                             *args, **kwargs)
+
+    def on_reply(self, slot, cmd, callbacks, args, kwargs, redirects, result):
+        redirect = parse_redirect(result[0])
+        if redirect is not None and redirects < self.max_redirects:
+            kind, slot, name = redirect
+            if kind == 'MOVED':
+                self.moved(slot, name)
+            self.send(slot, cmd, callbacks, args, kwargs, redirects + 1, name, kind == 'ASK')
+            return
+        if isinstance(result[0], ConnectionError):
+            # the node may have failed over
+            self.load_slots()
+        self.call_callbacks(callbacks, result)
+
+    def moved(self, slot, name):
+        # the slot is served elsewhere now, and likely more have moved
+        self.slots[slot] = name
+        self.load_slots()
+
+
+class ClusterPipeline(ClusterClient):
+    '''
+    Commands queued per node and sent as one pipeline to each of them.
+
+    Results come back in the order the commands were queued, commands
+    redirected are sent again on their own. Commands that can not be sent to
+    one slot fail with a RedisError in their place among the results.
+    '''
+    def __init__(self, client, transactional):
+        self.client = client
+        self.transactional = transactional
+        self.command_stack = []
+        self.command_callbacks = []
+
+    def execute_command(self, cmd, callbacks, *args, **kwargs):
+        if callbacks is not None and not hasattr(callbacks, '__iter__'):
+            callbacks = [callbacks]
+        try:
+            slot = self.get_slot(cmd, args)
+        except RedisError, e:
+            # the error is its result
+            slot = e
+        self.command_stack.append((slot, cmd, args, kwargs))
+        self.command_callbacks.append(callbacks)
+
+    def get_slot(self, cmd, args):
+        if cmd in BROADCAST_COMMANDS or cmd in PUBSUB_COMMANDS or cmd == 'SCAN':
+            raise RedisError('%s can not be pipelined over a cluster' % cmd)
+        if cmd not in SPLIT_COMMANDS:
+            return self.client.route(cmd, args)
+        slots = set(key_slot(key) for key in args[::SPLIT_COMMANDS[cmd][0]])
+        if len(slots) > 1:
+            raise RedisError('Keys of %s map to different slots' % cmd)
+        if not slots:
+            raise RedisError('%s without keys can not be routed' % cmd)
+        return slots.pop()
+
+    def discard(self):
+        self.command_stack = []
+        self.command_callbacks = []
+
+    def release(self):
+        # nothing to reuse, a pipeline is made per call
+        self.discard()
+
+    def execute(self, callbacks=None, timeout=None, deadline=None):
+        command_stack = self.command_stack
+        command_callbacks = self.command_callbacks
+        self.command_stack = []
+        self.command_callbacks = []
+
+        future = None
+        if callbacks is None:
+            future = Future()
+            callbacks = [partial(resolve_pipeline_future, future)]
+        elif not hasattr(callbacks, '__iter__'):
+            callbacks = [callbacks]
+        if any(command_callbacks):
+            callbacks = [partial(call_command_callbacks, command_callbacks)] + callbacks
+
+        if not command_stack:
+            self.call_callbacks(callbacks, [])
+        elif not self.client.names:
+            self.client.load_slots([partial(self.on_ready, command_stack, callbacks, timeout, deadline)])
+        else:
+            self.send_pipelines(command_stack, callbacks, timeout, deadline)
+        return future
+
+    def on_ready(self, command_stack, callbacks, timeout, deadline, result):
+        (error, _) = result
+        if error:
+            self.call_callbacks(callbacks, (error, None))
+        else:
+            self.send_pipelines(command_stack, callbacks, timeout, deadline)
+
+    def send_pipelines(self, command_stack, callbacks, timeout, deadline):
+        client = self.client
+        results = [None] * len(command_stack)
+        # node name -> positions of its commands
+        groups = {}
+        unserved = False
+        for i, (slot, cmd, args, kwargs) in enumerate(command_stack):
+            if isinstance(slot, RedisError):
+                results[i] = (slot, None)
+                continue
+            name = client.slots[slot]
+            if name is None:
+                results[i] = (RedisError('Slot %s is not served' % slot), None)
+                unserved = True
+            else:
+                groups.setdefault(name, []).append(i)
+        if unserved:
+            # the map may be out of date
+            client.load_slots()
+        if not groups:
+            self.call_callbacks(callbacks, results)
+            return
+
+        state = {'waiting': len(groups)}
+        def on_result(position, result):
+            results[position] = result
+            state['waiting'] -= 1
+            if not state['waiting']:
+                self.call_callbacks(callbacks, results)
+        def on_results(positions, node_results):
+            if isinstance(node_results, tuple):
+                # the whole pipeline of the node failed
+                node_results = [node_results] * len(positions)
+            for position, result in zip(positions, node_results):
+                redirect = parse_redirect(result[0])
+                if redirect is not None and not self.transactional:
+                    kind, slot, name = redirect
+                    if kind == 'MOVED':
+                        client.moved(slot, name)
+                    _, cmd, args, kwargs = command_stack[position]
+                    state['waiting'] += 1
+                    client.send(slot, cmd, [partial(on_result, position)], args, kwargs, 1, name, kind == 'ASK')
+                else:
+                    results[position] = result
+            state['waiting'] -= 1
+            if not state['waiting']:
+                self.call_callbacks(callbacks, results)
+
+        for name, positions in groups.items():
+            pipe = client.get_client(name).pipeline(self.transactional)
+            for i in positions:
+                _, cmd, args, kwargs = command_stack[i]
+                pipe.execute_command(cmd, None, *args, **kwargs)
+            pipe.execute(partial(on_results, positions), timeout=timeout, deadline=deadline)
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+
+
+# where the keys of a command are in its arguments
+def keys_first(args):
+    return args[:1]
+
+def keys_first_two(args):
+    return args[:2]
+
+def keys_all(args):
+    return args
+
+def keys_but_last(args):
+    return args[:-1]
+
+def keys_pairs(args):
+    return args[::2]
+
+def keys_zaggregate(args):
+    return (args[0],) + args[2:2+int(args[1])]
+
+def keys_eval(args):
+    return args[2:2+int(args[1])]
+
+def keys_none(args):
+    return ()
+
+def keys_sort_store(args):
+    for i in xrange(len(args) - 1):
+        if args[i] == 'STORE':
+            return args[i+1:i+2]
+    return ()
+
+
+class Command(object):
+    '''
+    What brukva knows of a command, looked up by its name in COMMANDS.
+
+    `header` is its name encoded as a bulk string, ready to be written.
+    `reply` formats its replies, called with the reply and the arguments of
+    the command. `keys` returns its keys from its arguments, None when it
+    has none, and `writes` the keys it changes, None when it changes none;
+    they are its keys unless it is read-only. `read_only` commands have no
+    side effects, `blocking` ones hold the connection until they are replied
+    to, `dedicated` ones need a connection of their own on a pool, `session`
+    ones change the state of the connection, `coalesced` ones may share the
+    reply of an identical request and `cacheable` ones, reads of their first
+    argument, may keep their replies in a local cache.
+    '''
+    __slots__ = ('name', 'header', 'reply', 'keys', 'writes', 'read_only', 'blocking', 'dedicated', 'session',
+                 'coalesced', 'cacheable')
+
+    def __init__(self, name, reply=None, keys=keys_first, writes=None, read_only=False, blocking=False,
+                 dedicated=False, session=False, coalesced=False, cacheable=False):
+        self.name = name
+        self.header = '$%d\r\n%s\r\n' % (len(name), name)
+        self.reply = reply
+        self.keys = keys
+        self.writes = writes or (None if read_only else keys)
+        self.read_only = read_only
+        self.blocking = blocking
+        self.dedicated = dedicated
+        self.session = session
+        self.coalesced = coalesced
+        self.cacheable = cacheable
+
+    def __repr__(self):
+        return 'Brukva command %s' % self.name
+
+class CommandStats(object):
+    '''
+    The calls of a command on an instrumented client: their number, those
+    that failed, and the seconds spent waiting for their replies. Commands
+    of a pipeline each count the wait for the whole pipeline. `command` is
+    the Command, e.g. to add up the stats of the read-only ones.
+    '''
+    __slots__ = ('command', 'calls', 'errors', 'seconds')
+
+    def __init__(self, command):
+        self.command = command
+        self.calls = 0
+        self.errors = 0
+        self.seconds = 0.0
+
+    def __repr__(self):
+        return 'Brukva stats of %s (calls=%s, errors=%s, seconds=%.3f)' % (
+            self.command.name, self.calls, self.errors, self.seconds)
+
+    def add(self, error, seconds):
+        self.calls += 1
+        if error is not None:
+            self.errors += 1
+        self.seconds += seconds
+
+COMMANDS = {}
+
+def register(names, **kwargs):
+    for name in names.split():
+        COMMANDS[name] = Command(name, **kwargs)
+
+def get_command(name):
+    # commands brukva does not know of are sent as they are, their keys
+    # taken to be their first argument; they are not registered, the names
+    # of arbitrary commands would pile up
+    command = COMMANDS.get(name)
+    if command is None:
+        command = Command(name)
+    return command
+
+def set_replies(names, reply):
+    for name in names.split():
+        COMMANDS[name].reply = reply
+
+# reads
+register('EXISTS GET HEXISTS HGET HGETALL HKEYS HLEN HMGET HVALS LINDEX LLEN LRANGE SCARD SISMEMBER '
+         'SMEMBERS SUBSTR TYPE ZCARD ZRANGE ZRANGEBYSCORE ZRANK ZREVRANGE ZREVRANK ZSCORE',
+         read_only=True, coalesced=True, cacheable=True)
+# changes with time, not cached
+register('TTL', read_only=True, coalesced=True)
+register('MGET SDIFF SINTER SUNION', keys=keys_all, read_only=True, coalesced=True)
+register('DBSIZE INFO KEYS LASTSAVE PING', keys=None, read_only=True, coalesced=True)
+# random replies are not shared
+register('SRANDMEMBER', read_only=True)
+register('RANDOMKEY', keys=None, read_only=True)
+register('HSCAN SSCAN ZSCAN', read_only=True)
+register('SCAN', keys=None, read_only=True)
+
+# writes
+register('APPEND DECR DECRBY EXPIRE GETSET HDEL HINCRBY HMSET HSET INCR INCRBY LPOP LPUSH LREM LSET LTRIM '
+         'MOVE RPOP RPUSH SADD SET SETEX SETNX SPOP SREM ZADD ZINCRBY ZREM ZREMRANGEBYRANK '
+         'ZREMRANGEBYSCORE')
+# reads its key, writes the one it STOREs to
+register('SORT', writes=keys_sort_store)
+register('DEL SDIFFSTORE SINTERSTORE SUNIONSTORE', keys=keys_all)
+register('MSET MSETNX', keys=keys_pairs)
+register('RENAME RENAMENX RPOPLPUSH SMOVE', keys=keys_first_two)
+register('ZINTERSTORE ZUNIONSTORE', keys=keys_zaggregate)
+register('EVAL EVALSHA', keys=keys_eval)
+register('BLPOP BRPOP', keys=keys_but_last, blocking=True, dedicated=True)
+
+# connection, transactions, pub/sub and the server
+register('AUTH SELECT', keys=None, session=True)
+register('SUBSCRIBE UNSUBSCRIBE PSUBSCRIBE PUNSUBSCRIBE', keys=None, dedicated=True, session=True)
+register('WATCH', keys=keys_all, writes=keys_none, dedicated=True)
+register('UNWATCH', keys=None, dedicated=True)
+register('MULTI EXEC DISCARD', keys=None)
+# LISTEN is never sent, it stands for the messages listened to
+register('LISTEN PUBLISH', keys=None)
+register('ASKING BGREWRITEAOF BGSAVE CLUSTER FLUSHALL FLUSHDB SAVE SCRIPT SHUTDOWN', keys=None)
+
+def command_names(flag):
+    return frozenset(name for name, command in COMMANDS.iteritems() if getattr(command, flag))
+
+# commands without side effects, safe to send again after a reconnect
+READ_ONLY_COMMANDS = command_names('read_only')
+# read-only commands whose identical concurrent requests may share one reply
+COALESCED_COMMANDS = command_names('coalesced')
+# commands that monopolise a connection, pooled clients run them on a
+# dedicated one
+BLOCKING_COMMANDS = command_names('blocking')
+DEDICATED_COMMANDS = command_names('dedicated')
+# commands whose effect lasts for the connection, redone after a reconnect
+SESSION_COMMANDS = command_names('session')
+# reads of a single key whose replies may be cached
+CACHEABLE_COMMANDS = command_names('cacheable')
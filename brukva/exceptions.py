@@ -6,6 +6,10 @@ class ConnectionError(RedisError):
     pass
 
 
+class TimeoutError(RedisError):
+    pass
+
+
 class ResponseError(RedisError):
     def __init__(self, message, cmd_line):
         self.message = message
@@ -19,3 +23,7 @@ class ResponseError(RedisError):
 
 class InvalidResponse(RedisError):
     pass
+
+
+class WatchError(RedisError):
+    pass
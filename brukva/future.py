@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+
+class Future(object):
+    '''
+    The eventual result of a command, for Tornado versions without
+    tornado.concurrent.Future, with the same interface.
+
+    Done callbacks are called with the future as soon as its result or
+    exception is set, or right away when it is done already.
+    '''
+    __slots__ = ('_done', '_result', '_exc_info', '_callbacks')
+
+    def __init__(self):
+        self._done = False
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def cancel(self):
+        return False
+
+    def cancelled(self):
+        return False
+
+    def running(self):
+        return not self._done
+
+    def done(self):
+        return self._done
+
+    def result(self, timeout=None):
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        self._check_done()
+        return self._result
+
+    def exception(self, timeout=None):
+        if self._exc_info is not None:
+            return self._exc_info[1]
+        self._check_done()
+        return None
+
+    def exc_info(self):
+        return self._exc_info
+
+    def add_done_callback(self, fn):
+        if self._done:
+            fn(self)
+        else:
+            self._callbacks.append(fn)
+
+    def set_result(self, result):
+        self._result = result
+        self._set_done()
+
+    def set_exception(self, exception):
+        self.set_exc_info((exception.__class__, exception, getattr(exception, '__traceback__', None)))
+
+    def set_exc_info(self, exc_info):
+        self._exc_info = exc_info
+        self._set_done()
+
+    def _check_done(self):
+        if not self._done:
+            raise Exception('The result is not ready yet')
+
+    def _set_done(self):
+        self._done = True
+        callbacks, self._callbacks = self._callbacks, None
+        for callback in callbacks:
+            callback(self)
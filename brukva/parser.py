@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+from array import array
+from itertools import izip
+
+from brukva.exceptions import ResponseError, InvalidResponse
+
+
+class MultiBulkView(object):
+    '''
+    A multibulk reply of bulk strings (or nils), decoded element by element
+    as they are used.
+
+    It keeps the data of the reply as it was received and the offset and
+    length of every element in two arrays, instead of a string object per
+    element. It supports len(), indexing, slicing (to a list), iteration
+    and comparison with lists. `pairs` and `to_dict` read the elements two
+    by two, as HGETALL and ZRANGE ... WITHSCORES replies are, without slicing.
+    '''
+    __slots__ = ('data', 'offsets', 'lengths')
+
+    def __init__(self, data, offsets, lengths):
+        self.data = data
+        self.offsets = offsets
+        self.lengths = lengths
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(len(self.offsets)))]
+        length = self.lengths[index]
+        if length == -1:
+            return None
+        offset = self.offsets[index]
+        return self.data[offset:offset+length]
+
+    def __iter__(self):
+        data = self.data
+        for offset, length in izip(self.offsets, self.lengths):
+            yield data[offset:offset+length] if length != -1 else None
+
+    def __eq__(self, other):
+        if isinstance(other, (MultiBulkView, PairsView)):
+            other = list(other)
+        return list(self) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '<MultiBulkView of %d elements>' % len(self.offsets)
+
+    def pairs(self, convert=None):
+        items = iter(self)
+        if convert is None:
+            return izip(items, items)
+        return ((key, convert(value)) for key, value in izip(items, items))
+
+    def to_dict(self):
+        return dict(self.pairs())
+
+    def tolist(self):
+        return list(self)
+
+
+class PairsView(object):
+    '''
+    The elements of a MultiBulkView two by two, the second of each pair
+    passed through `convert`, e.g. the (member, score) pairs of a ZRANGE ...
+    WITHSCORES reply.
+    '''
+    __slots__ = ('view', 'convert')
+
+    def __init__(self, view, convert):
+        self.view = view
+        self.convert = convert
+
+    def __len__(self):
+        return len(self.view) // 2
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('index out of range')
+        return (self.view[2*index], self.convert(self.view[2*index+1]))
+
+    def __iter__(self):
+        return self.view.pairs(self.convert)
+
+    def __eq__(self, other):
+        if isinstance(other, (MultiBulkView, PairsView)):
+            other = list(other)
+        return list(self) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '<PairsView of %d pairs>' % len(self)
+
+    def to_dict(self):
+        return dict(self)
+
+
+class Reader(object):
+    '''
+    Incremental parser of redis replies.
+
+    Raw data is fed in whatever chunks it arrives from the socket, complete
+    replies are taken out with `gets`, which returns False while the buffered
+    data does not hold a whole reply yet. Nested multibulk replies are
+    assembled on an internal stack, so a reply may be split at any byte.
+
+    Error replies are returned (not raised) as ResponseError instances without
+    a command line attached, the caller knows which command they belong to.
+
+    `drain` hands back the data buffered past the last complete reply, for
+    a caller that reads the next reply itself.
+
+    With `lazy_threshold` set, multibulk replies of at least that many bulk
+    strings come out as MultiBulkView instances.
+    '''
+    def __init__(self, lazy_threshold=None):
+        self._buffer = ''
+        self._pos = 0
+        self._chunks = []
+        self._size = 0 # unconsumed bytes, including not yet joined chunks
+        self._need = 0 # unconsumed bytes required to make any progress
+        self._stack = []
+        self.lazy_threshold = lazy_threshold
+        # state of a view being read, see _gets_view, and whether the reply
+        # at hand turned out to be no view
+        self._view = None
+        self._plain = False
+
+    def feed(self, data):
+        if data:
+            self._chunks.append(data)
+            self._size += len(data)
+
+    def gets(self):
+        if self._size < self._need or not self._size:
+            return False
+        if self._chunks:
+            self._buffer = self._buffer[self._pos:] + ''.join(self._chunks)
+            self._pos = 0
+            self._chunks = []
+        if self._view is not None:
+            return self._gets_view()
+
+        buf = self._buffer
+        pos = self._pos
+        stack = self._stack
+        while True:
+            end = buf.find('\r\n', pos)
+            if end == -1:
+                need = len(buf) - pos + 1
+                break
+            head = buf[pos]
+            if head == '$':
+                length = int(buf[pos+1:end])
+                if length == -1:
+                    reply = None
+                    pos = end + 2
+                else:
+                    start = end + 2
+                    stop = start + length
+                    if stop + 2 > len(buf):
+                        need = stop + 2 - pos
+                        break
+                    reply = buf[start:stop]
+                    pos = stop + 2
+            elif head == '*':
+                length = int(buf[pos+1:end])
+                if (self.lazy_threshold is not None and length >= self.lazy_threshold
+                    and not stack and not self._plain):
+                    self._view = (array('l'), array('l'), length, [], [0], buf[pos:end+2])
+                    self._pos = end + 2
+                    return self._gets_view()
+                pos = end + 2
+                if length == -1:
+                    reply = None
+                elif length == 0:
+                    reply = []
+                else:
+                    stack.append((length, []))
+                    continue
+            elif head == '+':
+                reply = buf[pos+1:end]
+                pos = end + 2
+            elif head == ':':
+                reply = int(buf[pos+1:end])
+                pos = end + 2
+            elif head == '-':
+                message = buf[pos+1:end]
+                if message.startswith('ERR'):
+                    message = message[4:]
+                reply = ResponseError(message, None)
+                pos = end + 2
+            else:
+                raise InvalidResponse('Protocol error, unknown reply type byte %r' % head)
+
+            while stack:
+                length, items = stack[-1]
+                items.append(reply)
+                if len(items) < length:
+                    break
+                stack.pop()
+                reply = items
+            else:
+                self._plain = False
+                self._consumed(pos, 0)
+                return reply
+
+        self._consumed(pos, need)
+        return False
+
+    def _gets_view(self):
+        # reads the elements of a large multibulk reply from the buffer.
+        # Elements scanned are moved out of the buffer to `parts`, so every
+        # chunk is joined with the unscanned rest only, and the data of the
+        # view is joined once, when all of it is there. `done` is the length
+        # of the parts, the offset in the view of the buffer position
+        offsets, lengths, length, parts, done, header = self._view
+        buf = self._buffer
+        pos = start = self._pos
+        base = done[0] - start
+        need = 0
+        find = buf.find
+        add_offset = offsets.append
+        add_length = lengths.append
+        size_of_buf = len(buf)
+        for _ in xrange(length - len(offsets)):
+            end = find('\r\n', pos)
+            if end == -1:
+                need = size_of_buf - pos + 1
+                break
+            if buf[pos] != '$':
+                # not bulk strings only, read as usual
+                self._view = None
+                self._plain = True
+                self._consumed(0, 0)
+                self._buffer = header + ''.join(parts) + buf[start:]
+                self._size = len(self._buffer)
+                return self.gets()
+            size = int(buf[pos+1:end])
+            if size == -1:
+                add_offset(0)
+                pos = end + 2
+            else:
+                stop = end + 2 + size
+                if stop + 2 > size_of_buf:
+                    need = stop + 2 - pos
+                    break
+                add_offset(base + end + 2)
+                pos = stop + 2
+            add_length(size)
+        if pos > start:
+            parts.append(buf[start:pos] if start or pos < size_of_buf else buf)
+            done[0] += pos - start
+        self._consumed(pos, need)
+        if need:
+            return False
+        self._view = None
+        return MultiBulkView(parts[0] if len(parts) == 1 else ''.join(parts), offsets, lengths)
+
+    def drain(self):
+        # takes the data not parsed yet out of the reader, only valid between
+        # replies
+        data = self._buffer[self._pos:] + ''.join(self._chunks)
+        self._buffer = ''
+        self._pos = 0
+        self._chunks = []
+        self._size = 0
+        self._need = 0
+        self._view = None
+        self._plain = False
+        return data
+
+    def _consumed(self, pos, need):
+        if pos == len(self._buffer):
+            self._buffer = ''
+            pos = 0
+        self._pos = pos
+        self._size = len(self._buffer) - pos
+        self._need = need
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+from collections import deque
+from tornado.ioloop import IOLoop
+
+from brukva.client import Connection
+
+
+class ConnectionPool(object):
+    '''
+    Connections to one redis server shared by any number of clients.
+
+    Ordinary commands of all clients built on the pool are multiplexed over
+    the shared `connection`. Commands that monopolise a connection -- blocking
+    list pops, WATCH followed by a transaction, pub/sub -- run on a dedicated
+    connection checked out with `get_connection` and returned with `release`.
+    Idle dedicated connections are kept open for reuse, at most
+    `max_connections` connections (the shared one included) are open at once
+    and checkouts wait in line when all of them are taken.
+
+    With `reconnect` on, every connection of the pool reestablishes itself
+    when lost, with `coalesce_reads` on, identical concurrent reads share a
+    reply, and with `lazy_threshold` set, large multibulk replies come as
+    views, see Connection.
+    '''
+    def __init__(self, host='localhost', port=6379, db=None, max_connections=None, io_loop=None, autopipeline=False,
+                 connect_timeout=None, reconnect=False, replay_reads=False, coalesce_reads=False,
+                 lazy_threshold=None):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.max_connections = max_connections
+        self.io_loop = io_loop or IOLoop.instance()
+        self.autopipeline = autopipeline
+        self.connect_timeout = connect_timeout
+        self.reconnect = reconnect
+        self.replay_reads = replay_reads
+        self.coalesce_reads = coalesce_reads
+        self.lazy_threshold = lazy_threshold
+
+        self.connection = self.make_connection()
+        self._idle = deque()
+        self._waiters = deque()
+        self._in_use = 0
+
+    def __repr__(self):
+        return 'Brukva connection pool (host=%s, port=%s, max_connections=%s)' % (self.host, self.port, self.max_connections)
+
+    @property
+    def total(self):
+        return 1 + len(self._idle) + self._in_use
+
+    def make_connection(self):
+        return Connection(self.host, self.port, timeout=self.connect_timeout, io_loop=self.io_loop,
+                          autopipeline=self.autopipeline, db=self.db, reconnect=self.reconnect,
+                          replay_reads=self.replay_reads, coalesce_reads=self.coalesce_reads,
+                          lazy_threshold=self.lazy_threshold)
+
+    def connect(self, callback=None):
+        if self.connection.connected():
+            if callback is not None:
+                callback((None, True))
+        elif not self.connection.connecting:
+            self.connection.connect(callback)
+        elif callback is not None:
+            self.connection.add_connect_callback(callback)
+
+    def disconnect(self):
+        self.connection.disconnect()
+        while self._idle:
+            self._idle.popleft().disconnect()
+
+    def get_connection(self, callback):
+        while self._idle:
+            connection = self._idle.popleft()
+            if connection.connected():
+                self._in_use += 1
+                callback(connection)
+                return
+        if self.max_connections is None or self.total < self.max_connections:
+            connection = self.make_connection()
+            connection.connect()
+            self._in_use += 1
+            callback(connection)
+        else:
+            self._waiters.append(callback)
+
+    def release(self, connection):
+        self._in_use -= 1
+        if connection.pending or not connection.connected():
+            # e.g. still subscribed or waiting for a reply, nobody else may
+            # use it
+            if connection.connected():
+                connection.disconnect()
+            if self._waiters:
+                self.get_connection(self._waiters.popleft())
+        elif self._waiters:
+            self._in_use += 1
+            self._waiters.popleft()(connection)
+        else:
+            self._idle.append(connection)
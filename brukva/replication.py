@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+from brukva.client import Client, Pipeline, READ_ONLY_COMMANDS
+
+
+# read-only commands a replica answers as well as the master, the ones about
+# the server itself go to the master, and so do scans, whose cursors are
+# those of one server
+REPLICA_COMMANDS = READ_ONLY_COMMANDS - frozenset(['INFO', 'LASTSAVE', 'PING', 'SCAN', 'HSCAN', 'SSCAN', 'ZSCAN'])
+# sent to the replicas as well
+REPLICATED_SESSION_COMMANDS = frozenset(['SELECT', 'AUTH'])
+
+
+class ReplicatedClient(Client):
+    '''
+    Client of a master and its replicas.
+
+    Commands go to the master, which is this client's own connection, apart
+    from read-only ones, which go to the connected replica with the fewest
+    commands waiting for a reply (or to the master while none is connected).
+    A pipeline goes to a replica only when it is not transactional and all
+    of its commands are read-only, and all the commands of a transaction go
+    to the master. Replicas lag behind the master, a value read right after
+    it was written may be stale.
+
+    `replicas` are Client instances or (host, port) pairs, the remaining
+    arguments are those of Client, for the master (and coalesce_reads for
+    the replicas made from pairs too).
+    '''
+    def __init__(self, host='localhost', port=6379, replicas=(), **kwargs):
+        super(ReplicatedClient, self).__init__(host, port, **kwargs)
+        self.replicas = []
+        for replica in replicas:
+            if not isinstance(replica, Client):
+                replica_host, replica_port = replica
+                replica = Client(replica_host, replica_port, io_loop=self._io_loop,
+                                 coalesce_reads=kwargs.get('coalesce_reads', False))
+            self.replicas.append(replica)
+        self._turn = 0
+
+    def __repr__(self):
+        return 'Brukva replicated client (master=%s:%s, replicas=%s)' % (
+            self.connection.host, self.connection.port,
+            ', '.join('%s:%s' % (r.connection.host, r.connection.port) for r in self.replicas))
+
+    def new_pipeline(self, transactional):
+        return ReplicatedPipeline(self, transactional)
+
+    def connect(self, callbacks=None):
+        for replica in self.replicas:
+            replica.connect()
+        super(ReplicatedClient, self).connect(callbacks)
+
+    def disconnect(self):
+        for replica in self.replicas:
+            replica.disconnect()
+        super(ReplicatedClient, self).disconnect()
+
+    def pinned(self):
+        # every command of a transaction goes to the master
+        client = Client.__new__(Client)
+        client.__dict__.update(super(ReplicatedClient, self).pinned().__dict__)
+        return client
+
+    def get_replica(self):
+        # least outstanding requests, ties are taken in turns
+        count = len(self.replicas)
+        best = None
+        for i in xrange(count):
+            replica = self.replicas[(self._turn + i) % count]
+            connection = replica.connection
+            if not connection.connected():
+                continue
+            if best is None or len(connection.pending) < len(best.connection.pending):
+                best = replica
+        if count:
+            self._turn = (self._turn + 1) % count
+        return best
+
+    def execute_command(self, cmd, callbacks, *args, **kwargs):
+        if cmd in REPLICA_COMMANDS:
+            replica = self.get_replica()
+            if replica is not None:
+                kwargs.setdefault('timeout', self.timeout)
+                kwargs.setdefault('deadline', self.deadline)
+                return replica.execute_command(cmd, callbacks, *args, **kwargs)
+        elif cmd in REPLICATED_SESSION_COMMANDS:
+            for replica in self.replicas:
+                replica.execute_command(cmd, [], *args)
+        return super(ReplicatedClient, self).execute_command(cmd, callbacks, *args, **kwargs)
+
+
+class ReplicatedPipeline(Pipeline):
+    def send_pipeline(self, command_stack, callbacks, connection):
+        if command_stack[0].cmd != 'MULTI':
+            for cmd_line in command_stack:
+                if cmd_line.cmd not in REPLICA_COMMANDS:
+                    break
+            else:
+                replica = self.client.get_replica()
+                if replica is not None:
+                    connection = replica.connection
+        super(ReplicatedPipeline, self).send_pipeline(command_stack, callbacks, connection)
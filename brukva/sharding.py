@@ -0,0 +1,423 @@
+# -*- coding: utf-8 -*-
+from bisect import bisect
+from functools import partial
+from hashlib import md5
+from itertools import izip
+from zlib import crc32
+from tornado.ioloop import IOLoop
+
+from brukva.client import (Client, Future, ScanIterator, call_command_callbacks, encode, resolve_future,
+                           resolve_pipeline_future)
+from brukva.commands import COMMANDS, keys_first
+from brukva.exceptions import RedisError
+
+
+def hash_tag(key):
+    # only the part in braces counts when there is one, '{user:42}:name' and
+    # '{user:42}:mail' end up on the same shard
+    key = encode(key)
+    start = key.find('{')
+    if start != -1:
+        end = key.find('}', start + 1)
+        if end > start + 1:
+            key = key[start+1:end]
+    return key
+
+def hash_key(key):
+    return crc32(hash_tag(key)) & 0xffffffff
+
+
+class HashRing(object):
+    '''
+    Consistent hashing of keys to nodes.
+
+    Every node is placed on the ring `replicas` times, a key belongs to the
+    first point at or after its hash. Adding or removing a node only moves
+    the keys of its own points.
+    '''
+    def __init__(self, nodes=(), replicas=160):
+        self.replicas = replicas
+        self._points = []
+        self._nodes = []
+        for node in nodes:
+            self.add_node(node)
+
+    def _node_points(self, node):
+        for i in xrange(self.replicas):
+            yield int(md5('%s-%s' % (node, i)).hexdigest()[:8], 16)
+
+    def add_node(self, node):
+        for point in self._node_points(node):
+            i = bisect(self._points, point)
+            self._points.insert(i, point)
+            self._nodes.insert(i, node)
+
+    def remove_node(self, node):
+        for i in reversed(xrange(len(self._nodes))):
+            if self._nodes[i] == node:
+                del self._points[i]
+                del self._nodes[i]
+
+    def get_node(self, key):
+        if not self._nodes:
+            raise RedisError('No nodes on the ring')
+        i = bisect(self._points, hash_key(key))
+        if i == len(self._points):
+            i = 0
+        return self._nodes[i]
+
+
+class Gather(object):
+    '''
+    Collects the results of several commands and passes them, merged, to
+    the callbacks, or the first error of any of them.
+    '''
+    def __init__(self, count, merge, callbacks):
+        self.results = [None] * count
+        self.waiting = count
+        self.merge = merge
+        self.callbacks = callbacks
+
+    def callback(self, index):
+        return partial(self.on_result, index)
+
+    def on_result(self, index, result):
+        self.results[index] = result
+        self.waiting -= 1
+        if self.waiting:
+            return
+        for error, _ in self.results:
+            if error:
+                result = (error, None)
+                break
+        else:
+            try:
+                result = (None, self.merge([data for _, data in self.results]))
+            except Exception, e:
+                result = (e, None)
+        for callback in self.callbacks:
+            callback(result)
+
+
+def merge_any(results):
+    return any(results)
+
+def merge_all(results):
+    return all(results)
+
+def merge_concat(results):
+    merged = []
+    for result in results:
+        merged.extend(result)
+    return merged
+
+def merge_ordered(count, positions):
+    # the values of the parts of a split command back in the order of its
+    # keys, `positions` are those of the keys of every part
+    def merge(results):
+        merged = [None] * count
+        for part_positions, values in izip(positions, results):
+            for position, value in izip(part_positions, values):
+                merged[position] = value
+        return merged
+    return merge
+
+def merge_script(results):
+    # SCRIPT EXISTS flags are true for scripts on every shard, SCRIPT LOAD
+    # and FLUSH reply the same everywhere
+    if isinstance(results[0], list):
+        return [all(flags) for flags in izip(*results)]
+    return results[0]
+
+def merge_first(results):
+    for result in results:
+        if result:
+            return result
+    return None
+
+# where the keys of the commands using more than one are, all of them have to
+# be on the same shard
+MULTI_KEY_COMMANDS = dict((name, command.keys) for name, command in COMMANDS.iteritems()
+                          if command.keys not in (None, keys_first))
+
+# commands split by shard: arguments per key and how the results merge
+SPLIT_COMMANDS = {
+    'MGET': (1, None),
+    'DEL': (1, merge_any),
+    'MSET': (2, merge_all),
+}
+
+# commands without keys, sent to every shard
+BROADCAST_COMMANDS = {
+    'KEYS': merge_concat,
+    'DBSIZE': sum,
+    'RANDOMKEY': merge_first,
+    'INFO': None,
+    'LASTSAVE': None,
+    'PING': merge_all,
+    'FLUSHDB': merge_all,
+    'FLUSHALL': merge_all,
+    'SELECT': merge_all,
+    'AUTH': merge_all,
+    'SAVE': merge_all,
+    'BGSAVE': merge_all,
+    'BGREWRITEAOF': merge_all,
+    'SHUTDOWN': merge_all,
+    'SCRIPT': merge_script,
+}
+
+PUBSUB_COMMANDS = frozenset(['SUBSCRIBE', 'UNSUBSCRIBE', 'PSUBSCRIBE', 'PUNSUBSCRIBE', 'LISTEN', 'PUBLISH'])
+
+
+class ShardedClient(Client):
+    '''
+    Client of several redis servers, each key stored on one of them.
+
+    `shards` are Client instances or (host, port) pairs, in a list or in a
+    dict by shard name (the name places the shard on the ring, it defaults to
+    'host:port'). Keys are mapped to shards with a consistent hash ring, keys
+    sharing a hash tag ('{user:42}' in '{user:42}:name') are kept together.
+    MGET, MSET and DEL with keys on several shards are split and their
+    results merged in the original order, keyless commands (FLUSHDB, KEYS,
+    DBSIZE, SCRIPT...) go to every shard and INFO and LASTSAVE reply with a dict by
+    shard. Other commands using several keys must have all of them on one
+    shard. SCAN cursors are those of a shard, scan_iter walks the shards one
+    after the other. Pub/sub and the other keyless commands (MULTI, EXEC,
+    UNWATCH...) are not sharded, use the client of a shard directly. The
+    timeout and deadline of a bounded() sharded client apply to the commands
+    it sends to the shards. A transaction runs on the shard of its watched
+    keys, which must all be on the same one.
+    '''
+    def __init__(self, shards, io_loop=None, replicas=160):
+        self._io_loop = io_loop or IOLoop.instance()
+        self.shards = {}
+        if isinstance(shards, dict):
+            shards = shards.items()
+        else:
+            shards = [(None, shard) for shard in shards]
+        for name, shard in shards:
+            if not isinstance(shard, Client):
+                host, port = shard
+                shard = Client(host, port, io_loop=self._io_loop)
+            if name is None:
+                name = '%s:%s' % (shard.connection.host, shard.connection.port)
+            self.shards[name] = shard
+        self.names = sorted(self.shards)
+        self.ring = HashRing(self.names, replicas)
+        self.pool = None
+        self.timeout = None
+        self.deadline = None
+        self.subscribed = False
+
+    def __repr__(self):
+        return 'Brukva sharded client (%s)' % ', '.join(self.names)
+
+    def get_shard(self, key):
+        return self.get_client(self.ring.get_node(key))
+
+    def get_client(self, name):
+        shard = self.shards[name]
+        if self.timeout is None and self.deadline is None:
+            return shard
+        return shard.bounded(self.timeout, self.deadline)
+
+    def pipeline(self, transactional=False):
+        return ShardedPipeline(self, transactional)
+
+    def connect(self, callbacks=None):
+        if callbacks is None:
+            callbacks = []
+        elif not hasattr(callbacks, '__iter__'):
+            callbacks = [callbacks]
+        gather = Gather(len(self.names), merge_all, callbacks)
+        for i, name in enumerate(self.names):
+            self.shards[name].connect(gather.callback(i))
+
+    def disconnect(self):
+        for shard in self.shards.itervalues():
+            shard.disconnect()
+
+    def listen(self, callbacks=None):
+        callbacks = callbacks or []
+        if not hasattr(callbacks, '__iter__'):
+            callbacks = [callbacks]
+        self.call_callbacks(callbacks, (RedisError('Pub/sub is not sharded, use the client of a shard'), None))
+
+    def set_from_file(self, key, fileobj, length=None, callbacks=None):
+        return self.get_shard(key).set_from_file(key, fileobj, length, callbacks)
+
+    def scan_iter(self, match=None, count=None):
+        return ScanIterator([self.get_client(name).scan for name in self.names], (), match, count)
+
+    def transaction(self, func, *keys, **kwargs):
+        names = set(self.ring.get_node(key) for key in keys)
+        if len(names) == 1:
+            return self.get_client(names.pop()).transaction(func, *keys, **kwargs)
+        callbacks = kwargs.get('callbacks')
+        future = None
+        if callbacks is None:
+            future = Future()
+            callbacks = [partial(resolve_pipeline_future, future)]
+        elif not hasattr(callbacks, '__iter__'):
+            callbacks = [callbacks]
+        self.call_callbacks(callbacks, (RedisError('Keys of a transaction must map to one shard'), None))
+        return future
+
+    def route(self, cmd, args):
+        keys = MULTI_KEY_COMMANDS.get(cmd)
+        if keys is None:
+            command = COMMANDS.get(cmd)
+            if not args or (command is not None and command.keys is None):
+                raise RedisError('%s has no key to be sharded by' % cmd)
+            return self.ring.get_node(args[0])
+        names = set(self.ring.get_node(key) for key in keys(args))
+        if len(names) > 1:
+            raise RedisError('Keys of %s map to different shards' % cmd)
+        if not names:
+            raise RedisError('%s without keys can not be sharded' % cmd)
+        return names.pop()
+
+    def execute_command(self, cmd, callbacks, *args, **kwargs):
+        future = None
+        if callbacks is None:
+            future = Future()
+            callbacks = [partial(resolve_future, future)]
+        elif not hasattr(callbacks, '__iter__'):
+            callbacks = [callbacks]
+        if cmd in PUBSUB_COMMANDS:
+            self.call_callbacks(callbacks, (RedisError('Pub/sub is not sharded, use the client of a shard'), None))
+        elif cmd == 'SCAN':
+            self.call_callbacks(callbacks, (RedisError('SCAN is not sharded, use scan_iter'), None))
+        elif cmd in BROADCAST_COMMANDS:
+            self.execute_broadcast(cmd, callbacks, args, kwargs)
+        elif cmd in SPLIT_COMMANDS:
+            self.execute_split(cmd, callbacks, args, kwargs)
+        else:
+            try:
+                name = self.route(cmd, args)
+            except RedisError, e:
+                self.call_callbacks(callbacks, (e, None))
+                return future
+            self.get_client(name).execute_command(cmd, callbacks, *args, **kwargs)
+        return future
+
+    def execute_broadcast(self, cmd, callbacks, args, kwargs):
+        merge = BROADCAST_COMMANDS[cmd] or (lambda results: dict(zip(self.names, results)))
+        gather = Gather(len(self.names), merge, callbacks)
+        for i, name in enumerate(self.names):
+            self.get_client(name).execute_command(cmd, gather.callback(i), *args, **kwargs)
+
+    def execute_split(self, cmd, callbacks, args, kwargs):
+        step, merge = SPLIT_COMMANDS[cmd]
+        if not args:
+            self.call_callbacks(callbacks, (RedisError('%s without keys can not be sharded' % cmd), None))
+            return
+        # shard name -> (positions of its keys, its arguments)
+        groups = {}
+        for i in xrange(0, len(args), step):
+            positions, shard_args = groups.setdefault(self.ring.get_node(args[i]), ([], []))
+            positions.append(i // step)
+            shard_args.extend(args[i:i+step])
+        if len(groups) == 1:
+            self.get_client(groups.keys()[0]).execute_command(cmd, callbacks, *args, **kwargs)
+            return
+        groups = groups.items()
+        if merge is None:
+            merge = merge_ordered(len(args) // step, [positions for _, (positions, _) in groups])
+        gather = Gather(len(groups), merge, callbacks)
+        for i, (name, (_, shard_args)) in enumerate(groups):
+            self.get_client(name).execute_command(cmd, gather.callback(i), *shard_args, **kwargs)
+
+
+class ShardedPipeline(ShardedClient):
+    '''
+    Commands queued per shard and sent as one pipeline to each of them.
+
+    Results come back in the order the commands were queued. A transactional
+    pipeline is a MULTI/EXEC transaction on each shard, not across them.
+    Commands that can not be sent to one shard fail with a RedisError in
+    their place among the results.
+    '''
+    def __init__(self, client, transactional):
+        self.client = client
+        self.transactional = transactional
+        self.command_stack = []
+        self.command_callbacks = []
+
+    def execute_command(self, cmd, callbacks, *args, **kwargs):
+        if callbacks is not None and not hasattr(callbacks, '__iter__'):
+            callbacks = [callbacks]
+        try:
+            name = self.get_shard_name(cmd, args)
+        except RedisError, e:
+            # the error is its result
+            name = e
+        self.command_stack.append((name, cmd, args, kwargs))
+        self.command_callbacks.append(callbacks)
+
+    def get_shard_name(self, cmd, args):
+        if cmd in BROADCAST_COMMANDS or cmd in PUBSUB_COMMANDS or cmd == 'SCAN':
+            raise RedisError('%s can not be pipelined over shards' % cmd)
+        if cmd not in SPLIT_COMMANDS:
+            return self.client.route(cmd, args)
+        names = set(self.client.ring.get_node(key) for key in args[::SPLIT_COMMANDS[cmd][0]])
+        if len(names) > 1:
+            raise RedisError('Keys of %s map to different shards' % cmd)
+        if not names:
+            raise RedisError('%s without keys can not be sharded' % cmd)
+        return names.pop()
+
+    def discard(self):
+        self.command_stack = []
+        self.command_callbacks = []
+
+    def release(self):
+        # nothing to reuse, a pipeline is made per call
+        self.discard()
+
+    def execute(self, callbacks=None, timeout=None, deadline=None):
+        command_stack = self.command_stack
+        command_callbacks = self.command_callbacks
+        self.command_stack = []
+        self.command_callbacks = []
+
+        future = None
+        if callbacks is None:
+            future = Future()
+            callbacks = [partial(resolve_pipeline_future, future)]
+        elif not hasattr(callbacks, '__iter__'):
+            callbacks = [callbacks]
+        if any(command_callbacks):
+            callbacks = [partial(call_command_callbacks, command_callbacks)] + callbacks
+
+        results = [None] * len(command_stack)
+        # shard name -> positions of its commands
+        groups = {}
+        for i, (name, cmd, args, kwargs) in enumerate(command_stack):
+            if isinstance(name, RedisError):
+                results[i] = (name, None)
+            else:
+                groups.setdefault(name, []).append(i)
+        if not groups:
+            self.call_callbacks(callbacks, results)
+            return future
+
+        groups = groups.items()
+        state = {'waiting': len(groups)}
+        def on_results(positions, shard_results):
+            if isinstance(shard_results, tuple):
+                # the whole pipeline of the shard failed
+                shard_results = [shard_results] * len(positions)
+            for position, result in zip(positions, shard_results):
+                results[position] = result
+            state['waiting'] -= 1
+            if not state['waiting']:
+                self.call_callbacks(callbacks, results)
+
+        for name, positions in groups:
+            pipe = self.client.get_client(name).pipeline(self.transactional)
+            for i in positions:
+                _, cmd, args, kwargs = command_stack[i]
+                pipe.execute_command(cmd, None, *args, **kwargs)
+            pipe.execute(partial(on_results, positions), timeout=timeout, deadline=deadline)
+        return future
@@ -0,0 +1,190 @@
+'''
+Micro-benchmark of the work done for a command between writing it and
+calling its callback, in CPU time and Python function calls per command, next
+to the chain of adisp generators brukva read replies with before.
+
+    python demos/bench/dispatch.py
+
+No server is needed, replies are fed to the connection from memory. The
+legacy chain reads them from a buffer synchronously, which leaves out the
+IOStream round trips it used to make per line and flatters it. Python 2 has
+no tracemalloc, the function calls (generators, partials and closures
+included) stand in for the allocations made per command.
+'''
+import sys
+import time
+
+from tornado.ioloop import IOLoop
+
+from brukva.adisp import async, process
+from brukva.client import Client, CmdLine, Reader
+from brukva.exceptions import ResponseError
+
+
+class NullStream(object):
+    def write(self, data, callback=None):
+        pass
+
+    def closed(self):
+        return False
+
+
+def make_client():
+    client = Client(io_loop=IOLoop())
+    client.connection._stream = NullStream()
+    client.connection._reader = Reader()
+    return client
+
+
+class BufferConnection(object):
+    def __init__(self):
+        self.buffer = ''
+        self.pos = 0
+
+    def write(self, data):
+        pass
+
+    def readline(self, callback):
+        end = self.buffer.index('\r\n', self.pos) + 2
+        line = self.buffer[self.pos:end]
+        self.pos = end
+        callback(line)
+
+    def read(self, length, callback):
+        data = self.buffer[self.pos:self.pos+length]
+        self.pos += length
+        callback(data)
+
+
+class LegacyClient(Client):
+    '''
+    Reads replies the way brukva did before its reader and pending queue,
+    one adisp generator per command, per reply and per reply element.
+    '''
+    def __init__(self):
+        super(LegacyClient, self).__init__(io_loop=IOLoop())
+        self.connection = BufferConnection()
+
+    @process
+    def execute_command(self, cmd, callbacks, *args, **kwargs):
+        if callbacks is None:
+            callbacks = []
+        elif not hasattr(callbacks, '__iter__'):
+            callbacks = [callbacks]
+        self.connection.write(self.format(cmd, *args))
+        cmd_line = CmdLine(cmd, *args, **kwargs)
+        data = yield async(self.connection.readline)()
+        try:
+            error, response = yield self.process_data(data, cmd_line)
+            result = self.format_reply(cmd_line, response)
+        except Exception, e:
+            error, result = e, None
+        self.call_callbacks(callbacks, (error, result))
+
+    @async
+    @process
+    def process_data(self, data, cmd_line, callback):
+        error, response = None, None
+        data = data[:-2]
+        if data == '$-1':
+            response = None
+        elif data == '*0' or data == '*-1':
+            response = []
+        else:
+            head, tail = data[0], data[1:]
+            if head == '*':
+                error, response = yield self.consume_multibulk(int(tail), cmd_line)
+            elif head == '$':
+                error, response = yield self.consume_bulk(int(tail)+2)
+            elif head == '+':
+                response = tail
+            elif head == ':':
+                response = int(tail)
+            elif head == '-':
+                error = ResponseError(tail, cmd_line)
+        callback((error, response))
+
+    @async
+    @process
+    def consume_multibulk(self, length, cmd_line, callback):
+        tokens = []
+        errors = {}
+        while len(tokens) < length:
+            data = yield async(self.connection.readline)()
+            error, token = yield self.process_data(data, cmd_line)
+            if error:
+                errors[len(tokens)] = error
+            tokens.append(token)
+        callback((errors, tokens))
+
+    @async
+    @process
+    def consume_bulk(self, length, callback):
+        data = yield async(self.connection.read)(length)
+        callback((None, data[:-2]))
+
+
+FIELDS = ['field:%d' % i for i in xrange(10)]
+
+CASES = [
+    # name, command and arguments, reply
+    ('GET', ('GET', 'user:42'), '$3\r\nbar\r\n'),
+    ('INCR', ('INCR', 'counter'), ':42\r\n'),
+    ('LRANGE 10 items', ('LRANGE', 'list', 0, 9), '*10\r\n' + ''.join('$8\r\nitem:%03d\r\n' % i for i in xrange(10))),
+    ('HGETALL 10 fields', ('HGETALL', 'hash'), '*20\r\n' + ''.join('$%d\r\n%s\r\n$5\r\nvalue\r\n' % (len(f), f) for f in FIELDS)),
+]
+
+
+def run_current(command, reply, count):
+    client = make_client()
+    results = []
+    callback = results.append
+    for i in xrange(count):
+        client.execute_command(command[0], callback, *command[1:])
+    client.connection.on_data(reply * count)
+    assert len(results) == count
+
+
+def run_legacy(command, reply, count):
+    client = LegacyClient()
+    client.connection.buffer = reply * count
+    results = []
+    callback = results.append
+    for i in xrange(count):
+        client.execute_command(command[0], callback, *command[1:])
+    assert len(results) == count
+
+
+def cpu_per_command(run, command, reply, count=10000):
+    best = None
+    for i in xrange(3):
+        start = time.clock()
+        run(command, reply, count)
+        elapsed = time.clock() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / count
+
+
+def calls_per_command(run, command, reply, count=1000):
+    # calls of the setup made once per run are spread over `count` commands
+    calls = [0]
+    def profile(frame, event, arg):
+        if event in ('call', 'c_call'):
+            calls[0] += 1
+    sys.setprofile(profile)
+    try:
+        run(command, reply, count)
+    finally:
+        sys.setprofile(None)
+    return float(calls[0]) / count
+
+
+if __name__ == '__main__':
+    print '%-20s %10s %10s %12s %12s' % ('', 'us/cmd', 'legacy', 'calls/cmd', 'legacy')
+    for name, command, reply in CASES:
+        print '%-20s %10.2f %10.2f %12.1f %12.1f' % (
+            name,
+            cpu_per_command(run_current, command, reply) * 1e6,
+            cpu_per_command(run_legacy, command, reply) * 1e6,
+            calls_per_command(run_current, command, reply),
+            calls_per_command(run_legacy, command, reply))
@@ -0,0 +1,58 @@
+'''
+Micro-benchmark of command encoding, in bytes of requests produced per
+second, next to the token-by-token formatting brukva used before.
+
+    python demos/bench/encode.py
+'''
+import timeit
+
+from brukva.client import CmdLine, encode, format, format_pipeline_request
+
+
+def legacy_format(*tokens):
+    cmds = []
+    for t in tokens:
+        e_t = encode(t)
+        cmds.append('$%s\r\n%s\r\n' % (len(e_t), e_t))
+    return '*%s\r\n%s' % (len(tokens), ''.join(cmds))
+
+def legacy_format_pipeline_request(command_stack):
+    return ''.join(legacy_format(c.cmd, *c.args) for c in command_stack)
+
+
+VALUE = 'x' * 100
+MSET_ARGS = []
+for i in xrange(100):
+    MSET_ARGS.extend(['key:%d' % i, VALUE])
+PIPELINE = [CmdLine('SET', 'key:%d' % (i % 100), VALUE) for i in xrange(1000)]
+LARGE_VALUE = 'x' * (1024 * 1024)
+
+CASES = [
+    ('SET', lambda: format('SET', 'user:42', VALUE),
+            lambda: legacy_format('SET', 'user:42', VALUE)),
+    ('SET 1MB', lambda: format('SET', 'user:42', LARGE_VALUE),
+                lambda: legacy_format('SET', 'user:42', LARGE_VALUE)),
+    ('MSET 100 keys', lambda: format('MSET', *MSET_ARGS),
+                      lambda: legacy_format('MSET', *MSET_ARGS)),
+    ('pipeline of 1000 SET', lambda: format_pipeline_request(PIPELINE),
+                             lambda: legacy_format_pipeline_request(PIPELINE)),
+]
+
+
+def bytes_per_second(func, duration=1.0):
+    size = len(func())
+    timer = timeit.Timer(func)
+    number = 1
+    while True:
+        elapsed = min(timer.repeat(3, number))
+        if elapsed > duration / 10:
+            break
+        number *= 10
+    return size * number / elapsed
+
+
+if __name__ == '__main__':
+    print '%-22s %14s %14s' % ('', 'MB/s', 'legacy MB/s')
+    for name, func, legacy in CASES:
+        assert func() == legacy()
+        print '%-22s %14.1f %14.1f' % (name, bytes_per_second(func) / 2 ** 20, bytes_per_second(legacy) / 2 ** 20)
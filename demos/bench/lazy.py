@@ -0,0 +1,38 @@
+'''
+Benchmark of reading a large ZRANGE ... WITHSCORES reply, fed to the reader
+in socket-sized chunks, as lists of strings and as a lazy MultiBulkView.
+
+    python demos/bench/lazy.py
+'''
+import time
+
+from brukva.parser import Reader
+
+
+CHUNK_SIZE = 4096
+
+
+def zrange_reply(members):
+    parts = ['*%d\r\n' % (members * 2)]
+    for i in xrange(members):
+        member = 'member:%d' % i
+        score = str(i * 1.5)
+        parts.append('$%d\r\n%s\r\n$%d\r\n%s\r\n' % (len(member), member, len(score), score))
+    return ''.join(parts)
+
+
+def read(reply, lazy_threshold):
+    reader = Reader(lazy_threshold)
+    start = time.time()
+    for i in xrange(0, len(reply), CHUNK_SIZE):
+        reader.feed(reply[i:i+CHUNK_SIZE])
+        result = reader.gets()
+    assert result is not False
+    return time.time() - start
+
+
+if __name__ == '__main__':
+    print '%-10s %10s %10s' % ('members', 'eager s', 'lazy s')
+    for members in (100000, 400000, 800000):
+        reply = zrange_reply(members)
+        print '%-10d %10.2f %10.2f' % (members, read(reply, None), read(reply, 1000))
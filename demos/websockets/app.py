@@ -13,7 +13,8 @@ import tornado.websocket
 import tornado.ioloop
 
 
-c = brukva.Client()
+pool = brukva.ConnectionPool(max_connections=100)
+c = brukva.Client(pool=pool)
 c.connect()
 
 
@@ -25,7 +26,7 @@ class MainHandler(tornado.web.RequestHandler):
 class NewMessage(tornado.web.RequestHandler):
     def post(self):
         message = self.get_argument('message')
-        c.publish('test_channel', message)
+        c.publish('test_channel', message, [])
         self.set_header('Content-Type', 'text/plain')
         self.write('sent: %s' % (message,))
 
@@ -33,8 +34,7 @@ class NewMessage(tornado.web.RequestHandler):
 class MessagesCatcher(tornado.websocket.WebSocketHandler):
     def __init__(self, *args, **kwargs):
         super(MessagesCatcher, self).__init__(*args, **kwargs)
-        self.client = brukva.Client()
-        self.client.connect()
+        self.client = brukva.Client(pool=pool)
         self.client.subscribe('test_channel')
 
     def open(self):
@@ -1,12 +1,32 @@
 #!/usr/bin/env python
 
 try:
-    from setuptools import setup
+    from setuptools import setup, Extension
 except ImportError:
-    from distutils.core import setup
+    from distutils.core import setup, Extension
+from distutils.command.build_ext import build_ext
+from distutils.errors import CCompilerError, DistutilsExecError, DistutilsPlatformError
 
 VERSION = '0.0.1'
 
+class optional_build_ext(build_ext):
+    # the C reply parser is an optional speedup, brukva falls back to
+    # brukva.parser when it can not be built
+    def run(self):
+        try:
+            build_ext.run(self)
+        except DistutilsPlatformError:
+            self.warn_fallback()
+
+    def build_extension(self, ext):
+        try:
+            build_ext.build_extension(self, ext)
+        except (CCompilerError, DistutilsExecError, DistutilsPlatformError, IOError):
+            self.warn_fallback()
+
+    def warn_fallback(self):
+        self.warn('failed to build the C reply parser, the pure-Python one will be used')
+
 setup(name='brukva',
       version=VERSION,
       description='Asynchronous Redis client that works within the Tornado IO loop',
@@ -16,5 +36,7 @@ setup(name='brukva',
       url='http://github.com/kmerenkov/brukva',
       keywords=['Redis', 'Tornado'],
       packages=['brukva'],
+      ext_modules=[Extension('brukva._parser', ['brukva/_parser.c'])],
+      cmdclass={'build_ext': optional_build_ext},
       test_suite='tests.all_tests',
      )
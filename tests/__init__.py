@@ -1,8 +1,30 @@
 import unittest
-from server_commands import ServerCommandsTestCase
+from server_commands import ServerCommandsTestCase, ConnectionPoolTestCase
+from reply_parser import ReaderTestCase, CReaderTestCase, LazyReaderTestCase, CLazyReaderTestCase
+from sharding import HashRingTestCase, ShardedClientTestCase
+from replication import ReplicatedClientTestCase
+from cluster import KeySlotTestCase, ClusterClientTestCase
+from cache import LocalCacheTestCase, CachedClientTestCase, KeyspaceInvalidatorTestCase
+from bulk import BulkWriterTestCase
+from command_registry import CommandsTestCase
 
 def all_tests():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(ServerCommandsTestCase))
+    suite.addTest(unittest.makeSuite(ConnectionPoolTestCase))
+    suite.addTest(unittest.makeSuite(ReaderTestCase))
+    suite.addTest(unittest.makeSuite(CReaderTestCase))
+    suite.addTest(unittest.makeSuite(LazyReaderTestCase))
+    suite.addTest(unittest.makeSuite(CLazyReaderTestCase))
+    suite.addTest(unittest.makeSuite(HashRingTestCase))
+    suite.addTest(unittest.makeSuite(ShardedClientTestCase))
+    suite.addTest(unittest.makeSuite(ReplicatedClientTestCase))
+    suite.addTest(unittest.makeSuite(KeySlotTestCase))
+    suite.addTest(unittest.makeSuite(ClusterClientTestCase))
+    suite.addTest(unittest.makeSuite(LocalCacheTestCase))
+    suite.addTest(unittest.makeSuite(CachedClientTestCase))
+    suite.addTest(unittest.makeSuite(KeyspaceInvalidatorTestCase))
+    suite.addTest(unittest.makeSuite(BulkWriterTestCase))
+    suite.addTest(unittest.makeSuite(CommandsTestCase))
     return suite
 
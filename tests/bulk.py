@@ -0,0 +1,68 @@
+import brukva
+from brukva.bulk import BulkWriter
+from brukva.exceptions import ResponseError
+
+from server_commands import TornadoTestCase
+
+
+class BulkWriterTestCase(TornadoTestCase):
+    def test_write(self):
+        windows = []
+        errors = []
+        progress = []
+        def commands():
+            for i in xrange(1000):
+                # commands are only taken while there is room in the window
+                windows.append(writer.in_flight)
+                if i % 100 == 99:
+                    yield ('HGET', 'key:0', 'field')
+                else:
+                    yield ('SET', 'key:%d' % i, i)
+        def on_written(result):
+            self.assertEqual((writer.sent, writer.written, writer.failed), (1000, 990, 10))
+            self.client.dbsize([self.expect(990), self.finish])
+        writer = BulkWriter(self.client, batch_size=50, window=3,
+                            on_error=lambda command, error: errors.append((command, error)),
+                            on_progress=lambda writer: progress.append(writer.written + writer.failed))
+        writer.write(commands(), [self.expect(990), on_written])
+        self.start()
+        self.assertTrue(max(windows) <= 3)
+        self.assertEqual(progress, range(50, 1001, 50))
+        self.assertEqual([command for command, error in errors], [('HGET', 'key:0', 'field')] * 10)
+        self.assertTrue(isinstance(errors[0][1], ResponseError))
+        # every batch went out on the same pipeline, handed back after it
+        self.assertEqual(len(self.client._free_pipelines), 1)
+
+    def test_batch_bytes(self):
+        writer = BulkWriter(self.client, batch_bytes=1000)
+        sizes = []
+        def on_progress(writer):
+            sizes.append(writer.written)
+        writer.on_progress = on_progress
+        writer.write((('SET', 'key:%d' % i, 'x' * 92) for i in xrange(100)), [self.expect(100), self.finish])
+        self.start()
+        # 'SET', key and value make 100 bytes or a little more
+        self.assertEqual(sizes, range(10, 101, 10))
+
+    def test_failed_iterable(self):
+        def commands():
+            yield ('SET', 'foo', 'bar')
+            raise ValueError('bad line')
+        def on_written(result):
+            (error, _) = result
+            self.assertTrue(isinstance(error, ValueError))
+            self.client.get('foo', [self.expect('bar'), self.finish])
+        BulkWriter(self.client).write(commands(), on_written)
+        self.start()
+
+    def test_lost_connection(self):
+        client = brukva.Client(io_loop=self.loop)
+        def on_written(result):
+            (error, _) = result
+            self.assertTrue(isinstance(error, brukva.ConnectionError))
+            # the pipeline failed right away, nothing was sent after it
+            self.assertEqual(writer.sent, 1)
+            self.finish()
+        writer = BulkWriter(client, batch_size=1, window=2)
+        writer.write([('SET', 'foo', 'bar')] * 10, on_written)
+        self.start()
@@ -0,0 +1,199 @@
+import brukva
+from brukva.cache import LocalCache, KeyspaceInvalidator, MISSING
+import time
+import unittest
+from functools import partial
+
+from server_commands import TornadoTestCase
+
+
+class LocalCacheTestCase(unittest.TestCase):
+    def test_lru(self):
+        cache = LocalCache(max_entries=2)
+        cache.set('a', 'a', 1)
+        cache.set('b', 'b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 'c', 3)
+        # b was used least recently
+        self.assertEqual(cache.get('b'), MISSING)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual((cache.hits, cache.misses, cache.evictions), (3, 1, 1))
+
+    def test_bytes(self):
+        cache = LocalCache(max_bytes=100)
+        cache.set('a', 'a', 'x' * 39)
+        cache.set('b', 'b', ['x' * 19, 'y' * 20])
+        self.assertEqual(cache.bytes, 80)
+        cache.set('c', 'c', {'x': 'y' * 29})
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.bytes, 71)
+        # too big to be kept at all
+        cache.set('d', 'd', 'x' * 100)
+        self.assertEqual(cache.get('d'), MISSING)
+        self.assertEqual(len(cache), 2)
+
+    def test_ttl(self):
+        cache = LocalCache()
+        cache.set('a', 'a', 1, ttl=0.01)
+        cache.set('b', 'b', 2)
+        time.sleep(0.02)
+        self.assertEqual(cache.get('a'), MISSING)
+        self.assertEqual(cache.get('b'), 2)
+        self.assertEqual(cache.bytes, 9)
+
+    def test_invalidate(self):
+        cache = LocalCache()
+        cache.set('get a', 'a', 1)
+        cache.set('hget a', 'a', 2)
+        cache.set('get b', 'b', 3)
+        waiting = cache.start_flight('hgetall a', 'a')
+        cache.invalidate(u'a')
+        self.assertEqual(cache.get('get a'), MISSING)
+        self.assertEqual(cache.get('hget a'), MISSING)
+        self.assertEqual(cache.get('get b'), 3)
+        self.assertFalse(cache.end_flight('hgetall a', 'a', waiting))
+        self.assertEqual(cache.keys, {'b': set(['get b'])})
+        cache.clear()
+        self.assertEqual((len(cache), cache.bytes), (0, 0))
+
+
+class CachedClientTestCase(TornadoTestCase):
+    def setUp(self):
+        super(CachedClientTestCase, self).setUp()
+        self.cached = brukva.CachedClient(self.client)
+        self.cache = self.cached.cache
+
+    def test_hits(self):
+        def on_get(result):
+            self.cached.get('foo', self.expect('bar'))
+            self.cached.hgetall('baz', self.expect({}))
+            self.cached.get('foo', [self.expect('bar'), self.finish])
+        self.cached.set('foo', 'bar', self.expect(True))
+        self.cached.get('foo', [self.expect('bar'), on_get])
+        self.cached.hgetall('baz', self.expect({}))
+        self.start()
+        # the second HGETALL is sent before the reply to the first
+        self.assertEqual((self.cache.hits, self.cache.misses, self.cache.coalesced), (2, 3, 1))
+        self.assertEqual(len(self.cache), 2)
+
+    def test_coalescing(self):
+        def on_get(result):
+            self.assertEqual(self.cache.coalesced, 3)
+            self.assertEqual(len(self.client.connection.pending), 0)
+            self.finish()
+        self.client.set('foo', 'bar', self.expect(True))
+        pending = len(self.client.connection.pending)
+        for i in xrange(3):
+            self.cached.get('foo', self.expect('bar'))
+        self.assertEqual(len(self.client.connection.pending), pending + 1)
+        self.cached.get('foo', on_get)
+        self.start()
+
+    def test_invalidation(self):
+        def on_get(result):
+            self.cached.delete('foo', self.expect(True))
+            self.cached.get('foo', self.expect(None))
+            self.cached.mset({'foo': 'baz', 'bar': 'baz'}, self.expect(True))
+            self.cached.get('foo', [self.expect('baz'), on_mset])
+        def on_mset(result):
+            pipe = self.cached.pipeline()
+            pipe.append('foo', '!')
+            pipe.execute(self.pexpect([4]))
+            pipe.release()
+            self.assertEqual(len(self.client._free_pipelines), 1)
+            self.cached.get('foo', [self.expect('baz!'), self.finish])
+        self.cached.set('foo', 'bar', self.expect(True))
+        self.cached.get('foo', self.expect('bar'))
+        # changed while the read is on its way, its reply is not cached
+        self.cached.set('foo', 'baz', self.expect(True))
+        self.cached.get('foo', [self.expect('baz'), on_get])
+        self.start()
+        self.assertEqual(self.cache.hits, 0)
+
+    def test_transaction(self):
+        pool = brukva.ConnectionPool(db=9, io_loop=self.loop)
+        cached = brukva.CachedClient(brukva.Client(pool=pool))
+        pool.connect()
+        def incr(client, pipe):
+            future = client.get('foo')
+            future.add_done_callback(lambda f: pipe.set('foo', int(f.result()) + 1))
+            return future
+        def on_get(result):
+            cached.transaction(incr, 'foo', callbacks=[self.pexpect([True]), on_done])
+        def on_done(result):
+            # what the transaction wrote is read anew
+            cached.get('foo', [self.expect('2'), self.finish])
+        self.client.set('foo', '1', self.expect(True))
+        cached.get('foo', [self.expect('1'), on_get])
+        self.start()
+        self.assertEqual(cached.cache.hits, 0)
+        pool.disconnect()
+
+    def test_ttl(self):
+        cached = brukva.CachedClient(self.client, {'GET': 0.01, 'HGET': None})
+        def on_get(result):
+            time.sleep(0.02)
+            cached.get('foo', self.expect('bar'))
+            cached.hget('baz', 'a', [self.expect('b'), self.finish])
+        self.client.set('foo', 'bar', self.expect(True))
+        self.client.hset('baz', 'a', 'b', self.expect(True))
+        cached.get('foo', self.expect('bar'))
+        cached.hget('baz', 'a', [self.expect('b'), on_get])
+        self.start()
+        self.assertEqual((cached.cache.hits, cached.cache.misses), (1, 3))
+        self.assertRaises(ValueError, brukva.CachedClient, self.client, ['INCR'])
+
+
+class KeyspaceInvalidatorTestCase(TornadoTestCase):
+    def setUp(self):
+        super(KeyspaceInvalidatorTestCase, self).setUp()
+        self.client.execute_command('CONFIG', self.expect('OK'), 'SET', 'notify-keyspace-events', 'KA')
+        self.cached = brukva.CachedClient(self.client, ttl=None)
+        self.cache = self.cached.cache
+        self.invalidator = KeyspaceInvalidator(self.cache, brukva.Client(io_loop=self.loop), db=9, retry_delay=0.05)
+        self.other = brukva.Client(io_loop=self.loop)
+        self.other.connect()
+        self.other.select(9)
+
+    def tearDown(self):
+        self.invalidator.stop()
+        self.other.disconnect()
+        self.client.execute_command('CONFIG', None, 'SET', 'notify-keyspace-events', '')
+        self.client.ping(self.finish)
+        self.start()
+
+    def wait_for(self, condition, callback):
+        if condition():
+            callback()
+        else:
+            self.loop.add_timeout(time.time() + 0.01, partial(self.wait_for, condition, callback))
+
+    def test_invalidation(self):
+        def on_subscribed():
+            self.assertEqual(self.cache.max_ttl, None)
+            self.cached.get('foo', [self.expect('bar'), on_cached])
+        def on_cached(result):
+            self.cached.get('foo', self.expect('bar'))
+            self.assertEqual(self.cache.hits, 1)
+            self.other.set('foo', 'baz', self.expect(True))
+            self.wait_for(lambda: not len(self.cache), on_invalidated)
+        def on_invalidated():
+            self.cached.get('foo', [self.expect('baz'), on_get])
+        def on_get(result):
+            self.assertEqual(len(self.cache), 1)
+            # the subscription is lost, and made anew
+            self.invalidator.subscriber.connection._stream.close()
+            self.wait_for(lambda: not self.invalidator.subscribed, on_lost)
+        def on_lost():
+            self.assertEqual(len(self.cache), 0)
+            self.assertEqual(self.cache.max_ttl, 1)
+            self.wait_for(lambda: self.invalidator.subscribed, on_resubscribed)
+        def on_resubscribed():
+            self.other.delete('foo', self.expect(True))
+            self.cached.get('foo', [self.expect(None), self.finish])
+        self.client.set('foo', 'bar', self.expect(True))
+        self.assertEqual(self.cache.max_ttl, 1)
+        self.invalidator.start()
+        self.wait_for(lambda: self.invalidator.subscribed, on_subscribed)
+        self.start()
@@ -0,0 +1,247 @@
+import brukva
+from brukva.client import format
+from brukva.cluster import key_slot, crc16, SLOTS
+from brukva.parser import Reader
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+import unittest
+
+from server_commands import TornadoTestCase
+
+
+PORTS = (7379, 7380)
+
+def command(port, *args):
+    # a blocking round trip, to set the cluster up
+    sock = socket.create_connection(('127.0.0.1', port))
+    try:
+        sock.sendall(format(*args))
+        reader = Reader()
+        reply = False
+        while reply is False:
+            reader.feed(sock.recv(65536))
+            reply = reader.gets()
+        return reply
+    finally:
+        sock.close()
+
+
+class KeySlotTestCase(unittest.TestCase):
+    def test_key_slot(self):
+        self.assertEqual(crc16('123456789'), 0x31c3)
+        self.assertEqual(key_slot('foo'), 12182)
+        self.assertEqual(key_slot('{user1000}.following'), key_slot('{user1000}.followers'))
+        self.assertEqual(key_slot('{user1000}.following'), key_slot('user1000'))
+        self.assertNotEqual(key_slot('{}.following'), key_slot('{}.followers'))
+
+
+class ClusterClientTestCase(TornadoTestCase):
+    '''
+    Runs against a cluster of two redis servers started for the test case,
+    the slots split between them.
+    '''
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp()
+        cls.servers = []
+        try:
+            for port in PORTS:
+                cls.servers.append(subprocess.Popen(
+                    ['redis-server', '--port', str(port), '--cluster-enabled', 'yes',
+                     '--cluster-config-file', os.path.join(cls.dir, 'nodes-%d.conf' % port),
+                     '--dir', cls.dir, '--save', '', '--appendonly', 'no'],
+                    stdout=open(os.devnull, 'w')))
+        except OSError:
+            cls.tearDownClass()
+            raise unittest.SkipTest('redis-server can not be started')
+        for port in PORTS:
+            for _ in xrange(100):
+                try:
+                    command(port, 'PING')
+                    break
+                except socket.error:
+                    time.sleep(0.05)
+        cls.ids = [command(port, 'CLUSTER', 'MYID') for port in PORTS]
+        half = SLOTS // 2
+        command(PORTS[0], 'CLUSTER', 'ADDSLOTS', *range(half))
+        command(PORTS[1], 'CLUSTER', 'ADDSLOTS', *range(half, SLOTS))
+        command(PORTS[0], 'CLUSTER', 'MEET', '127.0.0.1', PORTS[1])
+        for _ in xrange(200):
+            if all(command(port, 'CLUSTER', 'INFO').find('cluster_state:ok') != -1 and
+                   len(command(port, 'CLUSTER', 'SLOTS')) == 2 for port in PORTS):
+                break
+            time.sleep(0.05)
+
+    @classmethod
+    def tearDownClass(cls):
+        for server in cls.servers:
+            server.terminate()
+            server.wait()
+        shutil.rmtree(cls.dir)
+
+    def setUp(self):
+        super(ClusterClientTestCase, self).setUp()
+        for port in PORTS:
+            command(port, 'FLUSHALL')
+        self.cluster = brukva.ClusterClient([('127.0.0.1', PORTS[0])], io_loop=self.loop)
+        self.cluster.connect(self.finish)
+        self.start()
+
+    def tearDown(self):
+        super(ClusterClientTestCase, self).tearDown()
+        self.cluster.disconnect()
+
+    def node_port(self, key):
+        return PORTS[key_slot(key) >= SLOTS // 2]
+
+    def set_slot(self, slot, port):
+        # moves a slot, without its keys, to the node at `port`
+        node = self.ids[PORTS.index(port)]
+        for p in PORTS:
+            command(p, 'CLUSTER', 'SETSLOT', slot, 'NODE', node)
+        # or gossip of the old owner may take the slot back
+        command(port, 'CLUSTER', 'BUMPEPOCH')
+
+    def test_routing(self):
+        keys = ['key:%d' % i for i in xrange(20)]
+        self.assertEqual(len(self.cluster.names), 2)
+        def on_set(result):
+            for key in keys:
+                self.assertEqual(command(self.node_port(key), 'GET', key), key)
+            self.cluster.dbsize(self.expect(len(keys)))
+            self.cluster.mget(keys + ['missing'], self.expect(keys + [None]))
+            self.cluster.execute_command('DEL', self.expect(True), *keys)
+            self.cluster.mget(keys, [self.expect([None] * len(keys)), self.finish])
+        self.cluster.mset(dict((key, key) for key in keys), [self.expect(True), on_set])
+        self.start()
+
+    def test_multi_key_commands(self):
+        def on_error(result):
+            (error, _) = result
+            self.assertTrue(isinstance(error, brukva.RedisError))
+        self.cluster.sadd('{user:1}:a', 'x', self.expect(True))
+        self.cluster.sadd('{user:1}:b', 'x', self.expect(True))
+        self.cluster.sinter(['{user:1}:a', '{user:1}:b'], self.expect(set(['x'])))
+        self.cluster.sinter(['a', 'b'], on_error)
+        keys = []
+        def on_scanned(result):
+            self.assertEqual(sorted(keys), ['{user:1}:a', '{user:1}:b'])
+            self.finish()
+        self.cluster.scan_iter().each(keys.extend, [self.expect(None), on_scanned])
+        self.start()
+
+    def test_unsupported_commands(self):
+        errors = []
+        def on_error(result):
+            (error, _) = result
+            errors.append(error)
+        self.cluster.execute_command('MULTI', on_error)
+        self.cluster.unwatch(on_error)
+        self.cluster.subscribe('foo', [on_error])
+        self.cluster.listen(on_error)
+        self.assertEqual(len(errors), 4)
+        for error in errors:
+            self.assertTrue(isinstance(error, brukva.RedisError))
+
+    def test_without_keys(self):
+        def on_error(result):
+            (error, _) = result
+            self.assertTrue(isinstance(error, brukva.RedisError))
+        self.cluster.mget([], on_error)
+        self.cluster.execute_command('DEL', [on_error, self.finish])
+        self.start()
+
+    def test_pipeline_errors(self):
+        @brukva.adisp.process
+        def run():
+            pipe = self.cluster.pipeline()
+            pipe.set('foo', 'a')
+            # not sent, failed in their place
+            pipe.sinter(['a', 'b'])
+            pipe.keys('*')
+            pipe.mget([])
+            results = yield pipe.execute()
+            self.assertEqual(results[0], (None, True))
+            for error, _ in results[1:]:
+                self.assertTrue(isinstance(error, brukva.RedisError))
+            self.finish()
+        run()
+        self.start()
+
+    def test_bounded(self):
+        def on_timeout(result):
+            (error, _) = result
+            self.assertTrue(isinstance(error, brukva.TimeoutError))
+        name = self.cluster.names[0]
+        self.assertEqual(self.cluster.bounded(timeout=5).get_client(name).timeout, 5)
+        late = self.cluster.bounded(deadline=time.time() - 1)
+        late.get('foo', on_timeout)
+        pipe = late.pipeline()
+        pipe.get('foo')
+        pipe.execute([lambda results: on_timeout(results[0]), self.finish])
+        self.start()
+
+    def test_unserved_slot(self):
+        slot = key_slot('foo')
+        def on_pipeline(results):
+            (error, _) = results[0]
+            self.assertTrue(isinstance(error, brukva.RedisError))
+            self.assertEqual(results[1], (None, None))
+            # the slot map is being loaded anew
+            self.assertTrue(self.cluster._loading is not None or self.cluster.slots[slot] is not None)
+            self.cluster.load_slots([on_reloaded])
+        def on_reloaded(result):
+            self.assertEqual(self.cluster.slots[slot], '127.0.0.1:%d' % self.node_port('foo'))
+            self.cluster.get('foo', [self.expect(None), self.finish])
+        self.cluster.slots[slot] = None
+        pipe = self.cluster.pipeline()
+        pipe.get('foo')
+        pipe.get('key:0')
+        pipe.execute(on_pipeline)
+        self.start()
+
+    def test_moved(self):
+        slot = key_slot('foo')
+        port = self.node_port('foo')
+        other = PORTS[1 - PORTS.index(port)]
+        def on_moved(result):
+            self.assertEqual(self.cluster.slots[slot], '127.0.0.1:%d' % other)
+            self.assertEqual(command(other, 'GET', 'foo'), 'bar')
+            # a slot holding keys can not be given away
+            command(other, 'DEL', 'foo')
+            self.set_slot(slot, port)
+            pipe = self.cluster.pipeline()
+            pipe.set('foo', 'baz')
+            pipe.get('foo')
+            pipe.get('key:0')
+            pipe.execute([self.pexpect([True, 'baz', None]), on_pipeline])
+        def on_pipeline(result):
+            self.assertEqual(self.cluster.slots[slot], '127.0.0.1:%d' % port)
+            self.finish()
+        self.set_slot(slot, other)
+        self.cluster.set('foo', 'bar', self.expect(True))
+        self.cluster.get('foo', [self.expect('bar'), on_moved])
+        self.start()
+
+    def test_ask(self):
+        slot = key_slot('foo')
+        port = self.node_port('foo')
+        other = PORTS[1 - PORTS.index(port)]
+        source, target = self.ids[PORTS.index(port)], self.ids[PORTS.index(other)]
+        def on_set(result):
+            # the slot stays where it was, the new key went to the target
+            self.assertEqual(self.cluster.slots[slot], '127.0.0.1:%d' % port)
+            command(port, 'CLUSTER', 'SETSLOT', slot, 'STABLE')
+            command(other, 'CLUSTER', 'SETSLOT', slot, 'STABLE')
+            self.assertEqual((command(port, 'DBSIZE'), command(other, 'DBSIZE')), (0, 1))
+            self.finish()
+        command(other, 'CLUSTER', 'SETSLOT', slot, 'IMPORTING', source)
+        command(port, 'CLUSTER', 'SETSLOT', slot, 'MIGRATING', target)
+        # a missing key is looked for on the target
+        self.cluster.get('foo', self.expect(None))
+        self.cluster.set('foo', 'bar', [self.expect(True), on_set])
+        self.start()
@@ -0,0 +1,45 @@
+from brukva.client import Client, CmdLine, format
+from brukva.commands import COMMANDS, CACHEABLE_COMMANDS, READ_ONLY_COMMANDS, DEDICATED_COMMANDS, get_command
+from tornado.ioloop import IOLoop
+import unittest
+
+
+class CommandsTestCase(unittest.TestCase):
+    def test_registry(self):
+        get = COMMANDS['GET']
+        self.assertEqual(get.header, '$3\r\nGET\r\n')
+        self.assertTrue(get.read_only and get.coalesced)
+        self.assertFalse(COMMANDS['SRANDMEMBER'].coalesced)
+        self.assertTrue('BLPOP' in DEDICATED_COMMANDS and COMMANDS['BLPOP'].blocking)
+        self.assertFalse('SET' in READ_ONLY_COMMANDS)
+        self.assertEqual(COMMANDS['ZUNIONSTORE'].keys(('out', 2, 'a', 'b', 'WEIGHTS', 1, 2)), ('out', 'a', 'b'))
+        self.assertEqual(COMMANDS['MSET'].keys(('a', 1, 'b', 2)), ('a', 'b'))
+        self.assertTrue(COMMANDS['PING'].keys is None)
+
+    def test_unknown_command(self):
+        self.assertEqual(format('OBJECT', 'ENCODING', 'foo'), '*3\r\n$6\r\nOBJECT\r\n$8\r\nENCODING\r\n$3\r\nfoo\r\n')
+        # not registered
+        self.assertFalse('OBJECT' in COMMANDS)
+        command = get_command('OBJECT')
+        self.assertEqual(command.header, '$6\r\nOBJECT\r\n')
+        self.assertTrue(command.reply is None)
+        self.assertEqual(command.writes(('ENCODING', 'foo')), ('ENCODING',))
+
+    def test_derived_sets(self):
+        self.assertTrue('GET' in CACHEABLE_COMMANDS)
+        self.assertFalse('TTL' in CACHEABLE_COMMANDS or 'SRANDMEMBER' in CACHEABLE_COMMANDS)
+        for name in ('SCAN', 'HSCAN', 'SSCAN', 'ZSCAN'):
+            self.assertTrue(name in READ_ONLY_COMMANDS)
+        self.assertTrue(COMMANDS['GET'].writes is None)
+        self.assertTrue(COMMANDS['PUBLISH'].writes is None)
+        self.assertEqual(COMMANDS['DEL'].writes(('a', 'b')), ('a', 'b'))
+        self.assertEqual(COMMANDS['SORT'].writes(('a', 'STORE', 'b')), ('b',))
+        self.assertEqual(COMMANDS['WATCH'].writes(('a',)), ())
+
+    def test_format_reply(self):
+        client = Client(io_loop=IOLoop())
+        self.assertEqual(client.format_reply(CmdLine('ZRANGE', 'foo', 0, -1, 'WITHSCORES'), ['a', '1']),
+                         [('a', 1.0)])
+        self.assertEqual(client.format_reply(CmdLine('ZRANGE', 'foo', 0, -1), ['a']), ['a'])
+        self.assertEqual(client.format_reply(CmdLine('SCRIPT', 'EXISTS', 'x', 'y'), [1, 0]), [True, False])
+        self.assertEqual(client.format_reply(CmdLine('OBJECT', 'ENCODING', 'foo'), 'raw'), 'raw')
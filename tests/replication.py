@@ -0,0 +1,75 @@
+import brukva
+
+from server_commands import TornadoTestCase
+
+
+class ReplicatedClientTestCase(TornadoTestCase):
+    def setUp(self):
+        super(ReplicatedClientTestCase, self).setUp()
+        # the "replicas" are the master's server as well
+        self.replicated = brukva.ReplicatedClient(replicas=[('localhost', 6379), ('localhost', 6379)],
+                                                  io_loop=self.loop)
+        self.replicated.connect()
+        self.replicated.select(9, self.finish)
+        self.start()
+        self.master = self.replicated.connection
+        self.replicas = [replica.connection for replica in self.replicated.replicas]
+
+    def tearDown(self):
+        super(ReplicatedClientTestCase, self).tearDown()
+        self.replicated.disconnect()
+
+    def pending(self):
+        return [len(self.master.pending)] + [len(replica.pending) for replica in self.replicas]
+
+    def test_routing(self):
+        self.replicated.set('foo', 'bar', self.expect(True))
+        self.assertEqual(self.pending(), [1, 0, 0])
+        self.replicated.get('foo', self.expect('bar'))
+        self.replicated.hgetall('baz', self.expect({}))
+        self.assertEqual(self.pending(), [1, 1, 1])
+        self.replicated.ping(self.expect(True))
+        self.assertEqual(self.pending(), [2, 1, 1])
+        self.replicated.mget(['foo'], [self.expect(['bar']), self.finish])
+        self.start()
+
+    def test_least_outstanding(self):
+        self.replicated.replicas[0].blpop(['list'], callbacks=self.expect(['list', 'a']))
+        for i in xrange(3):
+            self.replicated.llen('list', self.expect(0))
+        self.assertEqual(self.pending(), [0, 2, 2])
+        self.replicated.rpush('list', 'a', [self.expect(1), self.finish])
+        self.start()
+
+    def test_transaction(self):
+        pool = brukva.ConnectionPool(db=9, io_loop=self.loop)
+        replicated = brukva.ReplicatedClient(pool=pool, replicas=self.replicated.replicas, io_loop=self.loop)
+        pool.connect()
+        def incr(client, pipe):
+            future = client.get('foo')
+            # on the master, replicas may lag behind
+            self.assertEqual(self.pending()[1:], [0, 0])
+            future.add_done_callback(lambda f: pipe.set('foo', int(f.result() or 0) + 1))
+            return future
+        def on_done(result):
+            pool.disconnect()
+            self.finish()
+        replicated.transaction(incr, 'foo', callbacks=[self.pexpect([True]), on_done])
+        self.start()
+
+    def test_pipelines(self):
+        pipe = self.replicated.pipeline()
+        def on_read(result):
+            pipe.set('foo', 'bar')
+            pipe.get('foo')
+            pipe.execute([self.pexpect([True, 'bar']), on_write])
+            self.assertEqual(self.pending(), [1, 0, 0])
+        def on_write(result):
+            pipe.transactional = True
+            pipe.get('foo')
+            pipe.execute([self.pexpect(['bar']), self.finish])
+            self.assertEqual(self.pending(), [1, 0, 0])
+        pipe.get('foo')
+        pipe.execute([self.pexpect([None]), on_read])
+        self.assertEqual(self.pending(), [0, 1, 0])
+        self.start()
@@ -0,0 +1,177 @@
+from brukva import parser
+from brukva.exceptions import ResponseError, InvalidResponse
+import unittest
+
+try:
+    from brukva import _parser
+except ImportError:
+    _parser = None
+
+
+class ReaderTestCase(unittest.TestCase):
+    Reader = parser.Reader
+
+    def setUp(self):
+        self.reader = self.Reader()
+
+    def test_status(self):
+        self.reader.feed('+OK\r\n')
+        self.assertEqual(self.reader.gets(), 'OK')
+        self.assertEqual(self.reader.gets(), False)
+
+    def test_integer(self):
+        self.reader.feed(':-42\r\n')
+        self.assertEqual(self.reader.gets(), -42)
+
+    def test_error(self):
+        self.reader.feed('-ERR unknown command\r\n-WRONGTYPE bad\r\n')
+        error = self.reader.gets()
+        self.assertTrue(isinstance(error, ResponseError))
+        self.assertEqual(error.message, 'unknown command')
+        self.assertEqual(self.reader.gets().message, 'WRONGTYPE bad')
+
+    def test_bulk(self):
+        self.reader.feed('$5\r\nfoo\r\n\r\n$0\r\n\r\n$-1\r\n')
+        self.assertEqual(self.reader.gets(), 'foo\r\n')
+        self.assertEqual(self.reader.gets(), '')
+        self.assertEqual(self.reader.gets(), None)
+        self.assertEqual(self.reader.gets(), False)
+
+    def test_multibulk(self):
+        self.reader.feed('*3\r\n$1\r\na\r\n:1\r\n*2\r\n$-1\r\n*0\r\n*-1\r\n')
+        self.assertEqual(self.reader.gets(), ['a', 1, [None, []]])
+        self.assertEqual(self.reader.gets(), None)
+
+    def test_multibulk_with_errors(self):
+        self.reader.feed('*2\r\n+OK\r\n-ERR wrong\r\n')
+        ok, error = self.reader.gets()
+        self.assertEqual(ok, 'OK')
+        self.assertTrue(isinstance(error, ResponseError))
+
+    def test_byte_by_byte(self):
+        data = '*2\r\n$3\r\nfoo\r\n*2\r\n:7\r\n$3\r\nbar\r\n+PONG\r\n'
+        replies = []
+        for char in data:
+            self.reader.feed(char)
+            reply = self.reader.gets()
+            while reply is not False:
+                replies.append(reply)
+                reply = self.reader.gets()
+        self.assertEqual(replies, [['foo', [7, 'bar']], 'PONG'])
+
+    def test_large_multibulk(self):
+        items = ['value:%d' % i for i in xrange(10000)]
+        data = '*%d\r\n%s' % (len(items), ''.join('$%d\r\n%s\r\n' % (len(i), i) for i in items))
+        for i in xrange(0, len(data), 4096):
+            self.reader.feed(data[i:i+4096])
+        self.assertEqual(self.reader.gets(), items)
+
+    def test_protocol_error(self):
+        self.reader.feed('?what\r\n')
+        self.assertRaises(InvalidResponse, self.reader.gets)
+
+    def test_feed_after_partial_reply(self):
+        self.reader.feed('$10\r\n01234')
+        self.assertEqual(self.reader.gets(), False)
+        self.reader.feed('56789\r')
+        self.assertEqual(self.reader.gets(), False)
+        self.reader.feed('\n:1\r\n')
+        self.assertEqual(self.reader.gets(), '0123456789')
+        self.assertEqual(self.reader.gets(), 1)
+
+    def test_drain(self):
+        self.reader.feed('+OK\r\n$5\r\nhel')
+        self.reader.feed('lo\r\n')
+        self.assertEqual(self.reader.gets(), 'OK')
+        self.assertEqual(self.reader.drain(), '$5\r\nhello\r\n')
+        self.assertEqual(self.reader.gets(), False)
+        self.reader.feed(':1\r\n')
+        self.assertEqual(self.reader.gets(), 1)
+        self.assertEqual(self.reader.drain(), '')
+
+
+@unittest.skipIf(_parser is None, 'C reply parser is not built')
+class CReaderTestCase(ReaderTestCase):
+    if _parser is not None:
+        Reader = _parser.Reader
+
+class LazyReaderTestCase(unittest.TestCase):
+    Reader = parser.Reader
+
+    def setUp(self):
+        self.reader = self.Reader(lazy_threshold=3)
+
+    def test_view(self):
+        data = '*4\r\n$3\r\nfoo\r\n$-1\r\n$0\r\n\r\n$5\r\n1.5\r\n\r\n'
+        for c in data:
+            self.assertEqual(self.reader.gets(), False)
+            self.reader.feed(c)
+        view = self.reader.gets()
+        self.assertTrue(isinstance(view, parser.MultiBulkView))
+        self.assertEqual(view, ['foo', None, '', '1.5\r\n'])
+        self.assertEqual((len(view), view[0], view[-1], view[1:3]), (4, 'foo', '1.5\r\n', [None, '']))
+        self.assertEqual(list(view.pairs()), [('foo', None), ('', '1.5\r\n')])
+        pairs = parser.PairsView(view, len)
+        self.assertEqual((len(pairs), pairs[1]), (2, ('', 5)))
+        self.assertEqual(self.reader.gets(), False)
+
+    def test_large_view(self):
+        items = ['value:%d' % i for i in xrange(10000)]
+        data = '*%d\r\n%s+OK\r\n' % (len(items), ''.join('$%d\r\n%s\r\n' % (len(i), i) for i in items))
+        for i in xrange(0, len(data), 4096):
+            self.reader.feed(data[i:i+4096])
+            if i + 4096 < len(data) - 5:
+                self.assertEqual(self.reader.gets(), False)
+        self.assertEqual(self.reader.gets(), items)
+        self.assertEqual(self.reader.gets(), 'OK')
+
+    def test_chunked_view(self):
+        # the elements read are moved out of the buffer as chunks arrive,
+        # which holds no more than a chunk and an element. The C reader
+        # keeps the reply in its buffer instead
+        items = ['member:%d' % i for i in xrange(20000)]
+        data = '*%d\r\n%s:1\r\n' % (len(items), ''.join('$%d\r\n%s\r\n' % (len(i), i) for i in items))
+        largest = 0
+        for i in xrange(0, len(data), 4096):
+            self.reader.feed(data[i:i+4096])
+            reply = self.reader.gets()
+            if self.Reader is parser.Reader:
+                largest = max(largest, len(self.reader._buffer))
+            if reply is not False:
+                break
+        self.assertTrue(largest <= 4096 + 32)
+        self.assertTrue(isinstance(reply, parser.MultiBulkView))
+        self.assertEqual(reply, items)
+        self.assertEqual(self.reader.gets(), 1)
+
+    def test_small_and_nested(self):
+        self.reader.feed('*2\r\n$1\r\na\r\n$1\r\nb\r\n')
+        self.assertEqual(type(self.reader.gets()), list)
+        self.reader.feed('*3\r\n$1\r\na\r\n*3\r\n:1\r\n:2\r\n')
+        self.assertEqual(self.reader.gets(), False)
+        self.reader.feed(':3\r\n-ERR no\r\n*3\r\n$1\r\nx\r\n$1\r\ny\r\n$1\r\nz\r\n')
+        reply = self.reader.gets()
+        self.assertEqual(type(reply), list)
+        self.assertEqual(reply[:2], ['a', [1, 2, 3]])
+        self.assertEqual(reply[2].message, 'no')
+        self.assertTrue(isinstance(self.reader.gets(), parser.MultiBulkView))
+
+    def test_mixed_view(self):
+        # read as usual once an element turns out to be no bulk string
+        self.reader.feed('*4\r\n$1\r\na\r\n$-1\r\n')
+        self.assertEqual(self.reader.gets(), False)
+        self.reader.feed(':1\r\n$1\r\nb\r\n*3\r\n$1\r\nc')
+        reply = self.reader.gets()
+        self.assertEqual(type(reply), list)
+        self.assertEqual(reply, ['a', None, 1, 'b'])
+        self.assertEqual(self.reader.gets(), False)
+        self.reader.feed('\r\n$0\r\n\r\n$-1\r\n')
+        self.assertEqual(self.reader.gets(), ['c', '', None])
+
+@unittest.skipIf(_parser is None, 'C reply parser is not built')
+class CLazyReaderTestCase(LazyReaderTestCase):
+    if _parser is not None:
+        Reader = _parser.Reader
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,12 @@
 import brukva
-from brukva.exceptions import ResponseError
+from brukva.exceptions import ResponseError, WatchError
 import unittest
+import mmap
 import sys
+import tempfile
+import time
+from functools import partial
+from StringIO import StringIO
 from datetime import datetime, timedelta
 from tornado.ioloop import IOLoop
 
@@ -217,6 +222,493 @@ class ServerCommandsTestCase(TornadoTestCase):
         self.client.decr('foo', [self.expect(-1), self.finish])
         self.start()
 
+    def test_large_lrange(self):
+        pipe = self.client.pipeline()
+        for i in xrange(1000):
+            pipe.rpush('foo', 'value:%d' % i)
+        pipe.execute(self.pexpect(range(1, 1001)))
+        self.client.lrange('foo', 0, -1, [self.expect(['value:%d' % i for i in xrange(1000)]), self.finish])
+        self.start()
+
+    def test_lazy_replies(self):
+        client = brukva.Client(io_loop=self.loop, lazy_threshold=100)
+        client.connect()
+        client.select(9)
+        pipe = client.pipeline()
+        for i in xrange(100):
+            pipe.rpush('foo', 'value:%d' % i)
+            pipe.hset('bar', 'field:%d' % i, i)
+            pipe.zadd('baz', i, 'member:%d' % i)
+        pipe.execute()
+        client.lrange('foo', 0, -1, self.expect(['value:%d' % i for i in xrange(100)]))
+        client.hgetall('bar', self.expect(dict(('field:%d' % i, str(i)) for i in xrange(100))))
+        client.zrange('baz', 0, -1, True, self.expect([('member:%d' % i, float(i)) for i in xrange(100)]))
+        client.zrange('baz', 0, 1, True, [self.expect([('member:0', 0.0), ('member:1', 1.0)]), self.finish])
+        self.start()
+        client.disconnect()
+
+    def test_pubsub(self):
+        subscriber = brukva.Client(io_loop=self.loop)
+        subscriber.connect()
+        def on_subscribed(result):
+            self.client.publish('foo', 'bar', self.expect(1))
+            self.client.publish('foo', 'zar', self.expect(1))
+        subscriber.subscribe('foo', [self.expect(lambda m: m.kind == 'subscribe'), on_subscribed])
+        messages = []
+        def on_message(result):
+            (error, message) = result
+            self.assertFalse(error)
+            messages.append(message.body)
+            if len(messages) == 2:
+                self.assertEqual(messages, ['bar', 'zar'])
+                subscriber.disconnect()
+                self.finish()
+        subscriber.listen(on_message)
+        self.start()
+
+    def test_psubscribe(self):
+        subscriber = brukva.Client(io_loop=self.loop)
+        subscriber.connect()
+        def on_subscribed(result):
+            self.client.publish('news.sport', 'bar', self.expect(1))
+        subscriber.psubscribe('news.*', [self.expect(lambda m: m.kind == 'psubscribe'), on_subscribed])
+        def on_message(result):
+            (error, message) = result
+            self.assertFalse(error)
+            self.assertEqual((message.kind, message.pattern, message.channel, message.body),
+                             ('pmessage', 'news.*', 'news.sport', 'bar'))
+            self.assertEqual(subscriber.connection.patterns, set(['news.*']))
+            subscriber.disconnect()
+            self.finish()
+        subscriber.listen(on_message)
+        self.start()
+
+    def test_coalesce_reads(self):
+        client = brukva.Client(io_loop=self.loop, coalesce_reads=True)
+        client.connect()
+        client.select(9)
+        client.set('foo', 'bar', self.expect(True))
+        for i in xrange(3):
+            client.get('foo', self.expect('bar'))
+        self.assertEqual(len(client.connection.pending), 3)
+        self.assertEqual(client.connection.coalesced, 2)
+        # reads after a write do not share the replies of earlier ones
+        client.get('foo', self.expect('bar'))
+        client.set('foo', 'baz', self.expect(True))
+        client.get('foo', self.expect('baz'))
+        client.get('foo', self.expect('baz'))
+        self.assertEqual(client.connection.coalesced, 4)
+        def on_error(result):
+            (error, _) = result
+            self.assertTrue(isinstance(error, ResponseError))
+        client.rpush('list', 'a', self.expect(1))
+        client.get('list', on_error)
+        client.get('list', [on_error, self.finish])
+        self.start()
+        self.assertEqual(client.connection.coalesced, 5)
+        self.assertEqual(client.connection.flights, {})
+        client.disconnect()
+
+    def test_futures(self):
+        self.client.set('foo', 'bar')
+        get = self.client.get('foo')
+        hgetall = self.client.hgetall('foo')
+        pipe = self.client.pipeline()
+        pipe.get('foo')
+        pipe.hgetall('foo')
+        execute = pipe.execute()
+        def on_done(future):
+            self.assertEqual(get.result(), 'bar')
+            self.assertTrue(isinstance(hgetall.exception(), ResponseError))
+            self.assertRaises(ResponseError, hgetall.result)
+            (first, second) = future.result()
+            self.assertEqual(first, (None, 'bar'))
+            self.assertTrue(isinstance(second[0], ResponseError))
+            self.finish()
+        self.assertFalse(get.done())
+        execute.add_done_callback(on_done)
+        self.start()
+
+    def test_ignored_replies(self):
+        # no future for replies nobody waits for
+        self.assertEqual(self.client.set('foo', 'bar', []), None)
+        self.assertEqual(self.client.hgetall('foo', []), None)
+        pipe = self.client.pipeline()
+        pipe.incr('foo')
+        self.assertEqual(pipe.execute([]), None)
+        self.client.get('foo', [self.expect('bar'), self.finish])
+        self.start()
+
+    def test_adisp(self):
+        async = partial(brukva.adisp.async, cbname='callbacks')
+        results = []
+        @brukva.adisp.process
+        def run():
+            results.append((yield async(self.client.set)('foo', 'bar')))
+            results.append((yield [async(self.client.get)('foo'), self.client.exists('foo')]))
+            results.append((yield []))
+            self.finish()
+        run()
+        self.start()
+        self.assertEqual(results, [(None, True), [(None, 'bar'), True], []])
+
+    def test_adisp_futures(self):
+        results = []
+        @brukva.adisp.process
+        def run():
+            yield self.client.set('foo', 'bar')
+            results.append((yield [self.client.get('foo'), self.client.exists('foo'), self.client.get('baz')]))
+            try:
+                yield [self.client.get('foo'), self.client.hgetall('foo')]
+            except ResponseError, e:
+                results.append(e)
+            self.finish()
+        run()
+        self.start()
+        self.assertEqual(results[0], ['bar', True, None])
+        self.assertTrue(isinstance(results[1], ResponseError))
+
+    def test_scan(self):
+        keys = ['key:%d' % i for i in xrange(100)]
+        self.client.mset(dict((key, key) for key in keys), self.expect(True))
+        self.client.set('other', 'x', self.expect(True))
+        self.client.scan(0, 'key:*', 1000, self.expect(lambda r: r[0] == 0 and sorted(r[1]) == sorted(keys)))
+        batches = []
+        @brukva.adisp.process
+        def run():
+            scan = self.client.scan_iter('key:*', count=10)
+            while True:
+                batch = yield scan.next()
+                if batch is None:
+                    break
+                batches.append(batch)
+            self.finish()
+        run()
+        self.start()
+        self.assertTrue(len(batches) > 1)
+        self.assertEqual(sorted(sum(batches, [])), sorted(keys))
+
+    def test_collection_scans(self):
+        # past the sizes small collections are kept in, which come whole
+        pipe = self.client.pipeline()
+        for i in xrange(200):
+            pipe.hset('hash', 'field:%d' % i, i)
+            pipe.sadd('set', 'member:%d' % i)
+            pipe.zadd('zset', i, 'member:%d' % i)
+        pipe.execute()
+        fields = {}
+        members = []
+        pairs = []
+        waiting = []
+        def on_batch(batch):
+            # the next batch waits for the future
+            future = brukva.client.Future()
+            waiting.append(future)
+            pairs.extend(batch)
+            self.loop.add_callback(partial(future.set_result, None))
+            return future
+        @brukva.adisp.process
+        def run():
+            yield self.client.hscan_iter('hash', count=10).each(fields.update)
+            yield self.client.sscan_iter('set', 'member:1*', 10).each(members.extend)
+            yield self.client.zscan_iter('zset', count=10).each(on_batch)
+            self.finish()
+        run()
+        self.start()
+        self.assertEqual(fields, dict(('field:%d' % i, str(i)) for i in xrange(200)))
+        self.assertEqual(sorted(members), sorted('member:%d' % i for i in xrange(200) if str(i).startswith('1')))
+        self.assertEqual(sorted(pairs), sorted(('member:%d' % i, float(i)) for i in xrange(200)))
+        self.assertTrue(len(waiting) > 1)
+
+    def test_scripts(self):
+        script = self.client.register_script("return redis.call('INCRBY', KEYS[1], ARGV[1])")
+        def on_loaded(result):
+            self.client.script_exists([script.sha, '0' * 40], self.expect([True, False]))
+            pipe = self.client.pipeline()
+            script(['foo'], [1], client=pipe)
+            pipe.get('foo')
+            pipe.execute([self.pexpect([6, '6']), on_pipeline])
+        def on_pipeline(result):
+            self.assertTrue(script.sha in self.client.connection.scripts)
+            self.client.script_flush(self.expect(True))
+            pipe = self.client.pipeline()
+            script(['foo'], [1], client=pipe)
+            pipe.execute([lambda results: self.assertTrue('NOSCRIPT' in results[0][0].message), on_flushed])
+        def on_flushed(result):
+            pipe = self.client.pipeline()
+            script(['foo'], [1], client=pipe)
+            pipe.execute([self.pexpect([7]), self.finish])
+        self.client.eval('return {KEYS[1], ARGV[1]}', ['a'], ['b'], self.expect(['a', 'b']))
+        self.client.script_flush(self.expect(True))
+        # not loaded, sent whole with EVAL
+        script(['foo'], [2], callbacks=self.expect(2))
+        script(['foo'], [3], callbacks=[self.expect(5), on_loaded])
+        self.start()
+
+    def test_autopipeline(self):
+        client = brukva.Client(io_loop=self.loop, autopipeline=True)
+        client.connect()
+        client.select(9)
+        writes = []
+        stream_write = client.connection._stream.write
+        def write(data, *args, **kwargs):
+            writes.append(data)
+            return stream_write(data, *args, **kwargs)
+        client.connection._stream.write = write
+        for i in xrange(30):
+            client.set('foo%d' % i, i)
+        for i in xrange(29):
+            client.get('foo%d' % i, self.expect(str(i)))
+        def on_last(result):
+            self.assertEqual(len(writes), 1)
+            self.finish()
+        client.get('foo29', [self.expect('29'), on_last])
+        self.start()
+
+    def test_instrument(self):
+        client = brukva.Client(io_loop=self.loop, instrument=True)
+        client.connect()
+        client.select(9)
+        client.set('foo', 'bar', [])
+        client.hgetall('foo', [])
+        pipe = client.pipeline()
+        pipe.get('foo')
+        pipe.hgetall('foo')
+        pipe.execute([])
+        pipe = client.pipeline(transactional=True)
+        pipe.get('foo')
+        pipe.execute([])
+        def on_get(result):
+            stats = client.stats
+            self.assertEqual(sorted(stats), ['GET', 'HGETALL', 'SELECT', 'SET'])
+            self.assertEqual((stats['GET'].calls, stats['GET'].errors), (3, 0))
+            self.assertEqual((stats['HGETALL'].calls, stats['HGETALL'].errors), (2, 2))
+            self.assertTrue(stats['GET'].command.read_only)
+            self.assertTrue(stats['SET'].seconds > 0)
+            self.assertEqual(self.client.stats, None)
+            self.finish()
+        client.get('foo', [self.expect('bar'), on_get])
+        self.start()
+        client.disconnect()
+
+    def test_autopipeline_fragments(self):
+        client = brukva.Client(io_loop=self.loop, autopipeline=True)
+        large = 'x' * 100000
+        def on_connect(result):
+            client.select(9, [])
+            client.set('foo', large, [])
+            pipe = client.pipeline()
+            pipe.append('foo', 'y')
+            pipe.get('foo')
+            pipe.execute([])
+            # the value is only copied when the buffer is flushed
+            self.assertTrue(any(fragment is large for fragment in client.connection._write_buffer))
+            client.append('foo', 'z', [self.expect(100002), self.finish])
+        client.connect(on_connect)
+        self.start()
+        client.disconnect()
+
+    def test_many_in_flight(self):
+        results = []
+        for i in xrange(5000):
+            self.client.incr('foo', lambda result: results.append(result[1]))
+        def on_last(result):
+            self.assertEqual(results, range(1, 5001))
+            self.finish()
+        self.client.get('foo', [self.expect('5000'), on_last])
+        self.start()
+
+    def test_connect_callback(self):
+        client = brukva.Client(io_loop=self.loop, connect_timeout=1)
+        client.connect([self.expect(True), self.finish])
+        client.ping(self.expect(True))
+        self.start()
+
+    def test_connect_refused(self):
+        client = brukva.Client(port=1, io_loop=self.loop, connect_timeout=1)
+        def on_connect(result):
+            (error, _) = result
+            self.assertTrue(isinstance(error, brukva.ConnectionError))
+            self.finish()
+        client.connect(on_connect)
+        def on_get(result):
+            (error, _) = result
+            self.assertTrue(isinstance(error, brukva.ConnectionError))
+        client.get('foo', on_get)
+        self.start()
+
+    def test_reconnect(self):
+        client = brukva.Client(io_loop=self.loop, reconnect=True, replay_reads=True)
+        client.connect()
+        client.select(9)
+        def on_set(result):
+            # the GET is on the wire when the connection goes away
+            client.get('foo', [self.expect('bar'), on_get])
+            client.incr('counter', on_incr)
+            client.connection._stream.close()
+        def on_incr(result):
+            (error, _) = result
+            self.assertTrue(isinstance(error, brukva.ConnectionError))
+        def on_get(result):
+            # the database selected before is selected again
+            client.get('foo', [self.expect('bar'), self.finish])
+        # after the database is flushed
+        self.client.ping(lambda result: client.set('foo', 'bar', [self.expect(True), on_set]))
+        self.start()
+        client.disconnect()
+
+    def test_reconnect_fail_fast(self):
+        client = brukva.Client(io_loop=self.loop, reconnect=True)
+        client.connect()
+        client.select(9)
+        def on_set(result):
+            client.get('foo', on_lost)
+            client.connection._stream.close()
+            client.get('foo', [self.expect('bar'), self.finish])
+        def on_lost(result):
+            (error, _) = result
+            self.assertTrue(isinstance(error, brukva.ConnectionError))
+        # after the database is flushed
+        self.client.ping(lambda result: client.set('foo', 'bar', [self.expect(True), on_set]))
+        self.start()
+        client.disconnect()
+
+    def test_reconnect_attempts(self):
+        client = brukva.Client(port=1, io_loop=self.loop, reconnect=True)
+        client.connection.reconnect_delay = 0.01
+        client.connection.max_reconnect_attempts = 3
+        def on_connect(result):
+            (error, _) = result
+            self.assertTrue(isinstance(error, brukva.ConnectionError))
+            self.assertEqual(client.connection._reconnect_attempts, 0)
+            self.finish()
+        client.connect(on_connect)
+        self.start()
+
+    def test_resubscribe(self):
+        subscriber = brukva.Client(io_loop=self.loop, reconnect=True)
+        subscriber.connect()
+        def on_subscribed(result):
+            subscriber.listen(on_message)
+            subscriber.connection._stream.close()
+            publish()
+        def publish():
+            self.client.publish('resubscribed', 'bar', on_published)
+        received = []
+        def on_published(result):
+            (error, receivers) = result
+            self.assertFalse(error)
+            if not received:
+                # not subscribed again yet, the server may still count the
+                # connection closed
+                self.loop.add_timeout(time.time() + 0.05, publish)
+        def on_message(result):
+            (error, message) = result
+            self.assertFalse(error)
+            self.assertEqual(message.body, 'bar')
+            received.append(message)
+            subscriber.disconnect()
+            self.finish()
+        # a channel nobody else listens to
+        subscriber.subscribe(['resubscribed'], [self.expect(lambda m: m.kind == 'subscribe'), on_subscribed])
+        self.start()
+
+    def test_command_timeout(self):
+        other = brukva.Client(io_loop=self.loop)
+        other.connect()
+        other.select(9)
+        def on_timeout(result):
+            (error, _) = result
+            self.assertTrue(isinstance(error, brukva.TimeoutError))
+            other.rpush('foo', 'a', [self.expect(1), on_push])
+        def on_push(result):
+            # the late BLPOP reply is discarded, not handed to LLEN
+            self.client.llen('foo', [self.expect(0), self.finish])
+        self.client.execute_command('BLPOP', on_timeout, 'foo', 0, timeout=0.05)
+        self.start()
+        other.disconnect()
+
+    def test_default_timeout(self):
+        self.client.timeout = 0.05
+        self.client.set('foo', 'bar', self.expect(True))
+        self.client.blpop(['bar'], callbacks=[lambda result: self.assertTrue(isinstance(result[0], brukva.TimeoutError)),
+                                              self.finish])
+        self.start()
+        # the BLPOP is still blocking
+        self.client.disconnect()
+
+    def test_bounded_timeout(self):
+        bounded = self.client.bounded(timeout=0.05)
+        # the GET waits behind the BLPOP on the same connection
+        self.client.blpop(['foo'])
+        def on_get(result):
+            (error, _) = result
+            self.assertTrue(isinstance(error, brukva.TimeoutError))
+            self.assertEqual(self.client.timeout, None)
+            self.finish()
+        bounded.get('foo', on_get)
+        self.start()
+        self.client.disconnect()
+
+    def test_deadline(self):
+        bounded = self.client.bounded(deadline=time.time() + 0.05)
+        def on_blpop(result):
+            (error, _) = result
+            self.assertTrue(isinstance(error, brukva.TimeoutError))
+            # the deadline has passed, nothing is sent any more
+            bounded.get('foo', on_get)
+        def on_get(result):
+            (error, _) = result
+            self.assertTrue(isinstance(error, brukva.TimeoutError))
+            self.assertEqual(len(self.client.connection.pending), 1)
+            self.finish()
+        bounded.blpop(['foo'], callbacks=on_blpop)
+        self.start()
+        self.client.disconnect()
+
+    def test_encoding(self):
+        large = 'x' * 100000
+        self.client.set(u'\u043a\u043b\u044e\u0447', 1, self.expect(True))
+        self.client.set('large', large, self.expect(True))
+        self.client.get(u'\u043a\u043b\u044e\u0447', self.expect('1'))
+        self.client.mget(['large', 'large'], [self.expect([large, large]), self.finish])
+        self.start()
+
+    def test_get_stream(self):
+        value = ''.join(chr(i % 256) for i in xrange(1000000))
+        sink = StringIO()
+        chunks = []
+        def on_stream(result):
+            (error, length) = result
+            self.assertFalse(error)
+            self.assertEqual(length, len(value))
+            self.assertEqual(sink.getvalue(), value)
+        def on_chunks(result):
+            self.assertEqual(''.join(chunks), value)
+        self.client.set('foo', value, self.expect(True))
+        self.client.get_stream('foo', sink, on_stream)
+        self.client.get_stream('foo', chunks.append, on_chunks)
+        self.client.get_stream('missing', sink, self.expect(None))
+        self.client.rpush('list', 'a', self.expect(1))
+        self.client.get_stream('list', sink, lambda result: self.assertTrue(isinstance(result[0], ResponseError)))
+        self.client.get('foo', [self.expect(value), self.finish])
+        self.start()
+
+    def test_set_from_file(self):
+        value = 'x' * 200000 + 'y' * 100000
+        f = tempfile.TemporaryFile()
+        f.write(value)
+        f.flush()
+        f.seek(0)
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.client.set_from_file('foo', f, callbacks=self.expect(True))
+        self.client.set_from_file('bar', m, callbacks=self.expect(True))
+        self.client.get('foo', self.expect(value))
+        self.client.get('bar', [self.expect(value), self.finish])
+        self.start()
+        m.close()
+        f.close()
+
     def test_ping(self):
         self.client.ping([self.expect(True), self.finish])
         self.start()
@@ -443,6 +935,12 @@ class ServerCommandsTestCase(TornadoTestCase):
         pipe.execute([self.pexpect([True , True, ['123', '456',]]), self.finish])
         self.start()
 
+    def test_pipe_empty(self):
+        pipe = self.client.pipeline()
+        pipe.execute(self.pexpect([]))
+        self.client.ping([self.expect(True), self.finish])
+        self.start()
+
     def test_pipe_multi(self):
         pipe = self.client.pipeline(transactional=True)
         pipe.set('foo', '123')
@@ -519,9 +1017,47 @@ class ServerCommandsTestCase(TornadoTestCase):
         self.client.set('foo', 'zar', self.expect(True))
         pipe = self.client.pipeline(transactional=True)
         pipe.get('foo')
-        pipe.execute([self.pexpect([]), self.finish])
+        def on_exec(result):
+            self.assertTrue(isinstance(result, tuple))
+            self.assertTrue(isinstance(result[0], WatchError))
+            self.finish()
+        pipe.execute(on_exec)
+        self.start()
+
+    def test_pipe_independent(self):
+        first = self.client.pipeline()
+        second = self.client.pipeline(transactional=True)
+        self.assertFalse(first is second)
+        self.assertTrue(second.transactional)
+        results = []
+        first.set('foo', 'bar', results.append)
+        second.incr('counter', [self.expect(1), results.append])
+        first.get('foo', results.append)
+        second.execute(self.pexpect([1]))
+        def on_first(result):
+            # the callbacks of the commands come first
+            self.assertEqual(results, [(None, 1), (None, True), (None, 'bar')])
+            first.release()
+            self.assertTrue(self.client.pipeline() is first)
+            first.get('foo')
+            first.execute([self.pexpect(['bar']), self.finish])
+        first.execute([self.pexpect([True, 'bar']), on_first])
         self.start()
 
+    def test_pipe_helpers(self):
+        pipe = self.client.pipeline()
+        # made by the client
+        other = pipe.pipeline(transactional=True)
+        self.assertTrue(isinstance(other, brukva.client.Pipeline))
+        self.assertFalse(other is pipe)
+        self.assertTrue(other.transactional)
+        self.assertEqual((pipe.transactions, pipe.transaction_retries), (0, 0))
+        self.assertRaises(Exception, pipe.auth, 'secret')
+        self.assertRaises(Exception, pipe.execute_command, 'AUTH', None, 'secret')
+        # a substring of 'AUTH' is no AUTH
+        pipe.execute_command('A', None)
+        self.assertEqual(len(pipe.command_stack), 1)
+
     def test_pipe_unwatch(self):
         self.client.set('foo', 'bar', self.expect(True))
         self.client.watch('foo', self.expect(True))
@@ -532,6 +1068,30 @@ class ServerCommandsTestCase(TornadoTestCase):
         pipe.execute([self.pexpect(['zar']), self.finish])
         self.start()
 
+    def test_transaction(self):
+        values = []
+        def incr(client, pipe):
+            done = brukva.client.Future()
+            def on_get(future):
+                values.append(future.result())
+                if len(values) == 1:
+                    # the first attempt is aborted
+                    client.set('foo', '5')
+                pipe.set('foo', int(future.result()) + 1)
+                done.set_result(None)
+            client.get('foo').add_done_callback(on_get)
+            return done
+        results = []
+        self.client.set('foo', '1', self.expect(True))
+        self.client.transaction(incr, 'foo', callbacks=[self.pexpect([True]), results.append])
+        # waits for the first one, its WATCH would be dropped by the EXEC
+        self.client.transaction(incr, 'foo', callbacks=[self.pexpect([True]), results.append, self.finish])
+        self.start()
+        self.assertEqual(values, ['1', '5', '6'])
+        self.assertEqual([result.retries for result in results], [1, 0])
+        self.assertEqual((self.client.transactions, self.client.transaction_retries), (2, 1))
+        self.assertFalse(self.client.connection.transactions)
+
     def test_pipe_zsets(self):
         pipe = self.client.pipeline(transactional=True)
 
@@ -613,5 +1173,209 @@ class ServerCommandsTestCase(TornadoTestCase):
         ])
         self.start()
 
+class ConnectionPoolTestCase(TornadoTestCase):
+    def setUp(self):
+        super(ConnectionPoolTestCase, self).setUp()
+        # the pool's connections must not race the flush
+        self.client.ping(self.finish)
+        self.start()
+        self.pool = brukva.ConnectionPool(db=9, max_connections=2, io_loop=self.loop)
+        self.pooled = brukva.Client(pool=self.pool)
+        self.pooled.connect()
+
+    def tearDown(self):
+        super(ConnectionPoolTestCase, self).tearDown()
+        self.pool.disconnect()
+
+    def test_shared_connection(self):
+        other = brukva.Client(pool=self.pool)
+        other.connect()
+        self.assertTrue(other.connection is self.pooled.connection)
+        self.pooled.set('foo', 'bar', self.expect(True))
+        other.get('foo', [self.expect('bar'), self.finish])
+        self.start()
+
+    def test_connect_in_progress(self):
+        pool = brukva.ConnectionPool(db=9, io_loop=self.loop)
+        first = brukva.Client(pool=pool)
+        second = brukva.Client(pool=pool)
+        done = []
+        def on_connect(result):
+            self.assertEqual(result, (None, True))
+            done.append(result)
+            if len(done) == 2:
+                pool.disconnect()
+                self.finish()
+        first.connect(on_connect)
+        # the shared connection is still connecting
+        second.connect(on_connect)
+        self.start()
+
+    def test_blocking_pops(self):
+        self.pooled.blpop(['foo'], callbacks=self.expect(['foo', 'a']))
+        # the pool is exhausted, this one waits for the first to finish
+        self.pooled.brpop(['bar'], callbacks=[self.expect(['bar', 'b']), self.finish])
+        self.assertEqual(self.pool.total, 2)
+        self.pooled.rpush('foo', 'a', self.expect(1))
+        self.pooled.rpush('bar', 'b', self.expect(1))
+        self.start()
+        self.assertEqual(self.pool.total, 2)
+
+    def test_blocking_timeout(self):
+        pool = brukva.ConnectionPool(db=9, max_connections=2, io_loop=self.loop)
+        pooled = brukva.Client(pool=pool)
+        pooled.connect()
+        def on_timeout(result):
+            (error, _) = result
+            self.assertTrue(isinstance(error, brukva.TimeoutError))
+        def on_second_timeout(result):
+            on_timeout(result)
+            # the blocked connections were closed and their slots freed
+            self.assertEqual(pool.total, 1)
+            # not 'foo', the server may not have seen the blocked connections
+            # closed yet and hand them the value
+            pooled.rpush('bar', 'a', self.expect(1))
+            pooled.blpop(['bar'], callbacks=[self.expect(['bar', 'a']), on_popped])
+        def on_popped(result):
+            pool.disconnect()
+            self.finish()
+        # the server would wait forever
+        pooled.execute_command('BLPOP', on_timeout, 'foo', 0, timeout=0.05)
+        # waits for the connection of the first one
+        pooled.execute_command('BLPOP', on_second_timeout, 'foo', 0, timeout=0.1)
+        self.start()
+
+    def test_watch(self):
+        def on_watch(result):
+            self.pooled.set('foo', 'zar', self.expect(True))
+            pipe = self.pooled.pipeline(transactional=True)
+            pipe.get('foo')
+            pipe.execute(on_exec)
+        def on_exec(result):
+            self.assertTrue(isinstance(result[0], WatchError))
+            self.assertFalse(self.pooled._dedicated)
+            self.finish()
+        self.pooled.set('foo', 'bar', self.expect(True))
+        self.pooled.watch('foo', [self.expect(True), on_watch])
+        self.start()
+
+    def test_transaction(self):
+        def incr(client, pipe):
+            future = client.get('foo')
+            future.add_done_callback(lambda f: pipe.set('foo', int(f.result()) + 1))
+            return future
+        done = []
+        def on_done(result):
+            done.append(result)
+            if len(done) < 3:
+                return
+            self.assertFalse(self.pooled._dedicated)
+            self.pooled.get('foo', [self.expect('4'), self.finish])
+        def on_set(result):
+            # on connections of their own, they start over when another
+            # one came first
+            for i in xrange(3):
+                self.pooled.transaction(incr, 'foo', callbacks=[self.pexpect([True]), on_done])
+        self.pooled.set('foo', '1', [self.expect(True), on_set])
+        self.start()
+        self.assertEqual(self.pooled.transactions, 3)
+
+    def test_transaction_retried(self):
+        values = []
+        def incr(client, pipe):
+            done = brukva.client.Future()
+            def on_get(future):
+                values.append(future.result())
+                if len(values) == 1:
+                    # the first attempt is aborted
+                    client.set('foo', '5')
+                pipe.set('foo', int(future.result()) + 1)
+                done.set_result(None)
+            client.get('foo').add_done_callback(on_get)
+            return done
+        def on_done(result):
+            self.assertEqual(result.retries, 1)
+            self.finish()
+        def on_set(result):
+            self.pooled.transaction(incr, 'foo', callbacks=[self.pexpect([True]), on_done])
+        self.pooled.set('foo', '1', [self.expect(True), on_set])
+        self.start()
+        self.assertEqual(values, ['1', '5'])
+        self.assertEqual((self.pooled.transactions, self.pooled.transaction_retries), (1, 1))
+
+    def test_transaction_aborted(self):
+        @brukva.adisp.async
+        @brukva.adisp.process
+        def touch(client, pipe, callback):
+            value = yield client.get('foo')
+            yield client.set('foo', value)
+            pipe.set('foo', 'baz')
+            callback(None)
+        def fail(client, pipe):
+            pipe.set('foo', 'baz')
+            raise ValueError('no')
+        def on_aborted(result):
+            (error, _) = result
+            self.assertTrue(isinstance(error, WatchError))
+            self.assertEqual(error.retries, 2)
+            self.assertEqual(self.pooled.transaction_retries, 2)
+            self.pooled.transaction(fail, 'foo', callbacks=on_failed)
+        def on_failed(result):
+            (error, _) = result
+            self.assertTrue(isinstance(error, ValueError))
+            self.pooled.get('foo', [self.expect('bar'), self.finish])
+        def on_set(result):
+            self.pooled.transaction(touch, 'foo', callbacks=on_aborted, max_attempts=3, backoff=0.001)
+        self.pooled.set('foo', 'bar', [self.expect(True), on_set])
+        self.start()
+
+    def test_pipe_transaction(self):
+        def incr(client, pipe):
+            pipe.incr('foo')
+        pipe = self.pooled.pipeline()
+        def on_done(result):
+            self.assertEqual((pipe.transactions, self.pooled.transactions), (1, 1))
+            self.finish()
+        pipe.transaction(incr, 'foo', callbacks=[self.pexpect([1]), on_done])
+        self.start()
+
+    def test_pubsub(self):
+        def on_subscribed(result):
+            self.pooled.publish('foo', 'bar', self.expect(1))
+        self.pooled.subscribe('foo', [self.expect(lambda m: m.kind == 'subscribe'), on_subscribed])
+        def on_message(result):
+            (error, message) = result
+            self.assertEqual(message.body, 'bar')
+            connection = self.pooled._dedicated['pubsub']
+            self.pooled.disconnect()
+            # unsubscribed, the connection goes back to the pool
+            self.loop.add_timeout(time.time() + 0.1, partial(on_reset, connection))
+        def on_reset(connection):
+            self.assertEqual(self.pool.total, 2)
+            self.assertTrue(connection.connected())
+            self.assertFalse(connection.channels)
+            self.pool.get_connection(partial(on_reused, connection))
+        def on_reused(connection, reused):
+            self.assertTrue(reused is connection)
+            self.pool.release(reused)
+            self.finish()
+        self.pooled.listen(on_message)
+        self.start()
+
+    def test_watch_released(self):
+        def on_watch(result):
+            connection = self.pooled._dedicated['watch']
+            self.pooled.disconnect()
+            self.loop.add_timeout(time.time() + 0.1, partial(on_unwatched, connection))
+        def on_unwatched(connection):
+            self.assertEqual(self.pool.total, 2)
+            self.pool.get_connection(partial(on_reused, connection))
+        def on_reused(connection, reused):
+            self.assertTrue(reused is connection)
+            self.pool.release(reused)
+            self.finish()
+        self.pooled.watch('foo', [self.expect(True), on_watch])
+        self.start()
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,202 @@
+import brukva
+from brukva.sharding import HashRing, hash_key
+import time
+import unittest
+
+from server_commands import TornadoTestCase
+
+
+class HashRingTestCase(unittest.TestCase):
+    def test_hash_tags(self):
+        self.assertEqual(hash_key('{user:42}:name'), hash_key('{user:42}:mail'))
+        self.assertEqual(hash_key('{user:42}:name'), hash_key('user:42'))
+        # empty and unclosed tags are no tags
+        self.assertNotEqual(hash_key('{}:name'), hash_key('{}:mail'))
+        self.assertNotEqual(hash_key('{user:name'), hash_key('{user:mail'))
+
+    def test_distribution(self):
+        ring = HashRing(['a', 'b', 'c'])
+        counts = {}
+        for i in xrange(30000):
+            node = ring.get_node('key:%d' % i)
+            counts[node] = counts.get(node, 0) + 1
+        self.assertEqual(sorted(counts), ['a', 'b', 'c'])
+        for count in counts.itervalues():
+            self.assertTrue(7000 < count < 13000, counts)
+
+    def test_add_node(self):
+        ring = HashRing(['a', 'b', 'c'])
+        keys = ['key:%d' % i for i in xrange(10000)]
+        before = [ring.get_node(key) for key in keys]
+        ring.add_node('d')
+        after = [ring.get_node(key) for key in keys]
+        # keys only move to the new node
+        for old, new in zip(before, after):
+            self.assertTrue(new == old or new == 'd')
+        ring.remove_node('d')
+        self.assertEqual([ring.get_node(key) for key in keys], before)
+
+
+class ShardedClientTestCase(TornadoTestCase):
+    def setUp(self):
+        super(ShardedClientTestCase, self).setUp()
+        shards = {}
+        for name, db in (('a', 10), ('b', 9)):
+            shards[name] = brukva.Client(io_loop=self.loop)
+            shards[name].connect()
+            shards[name].select(db)
+        self.sharded = brukva.ShardedClient(shards, io_loop=self.loop)
+        self.sharded.flushdb(self.finish)
+        self.start()
+        # keys on either shard
+        self.keys = ['key:%d' % i for i in xrange(20)]
+
+    def tearDown(self):
+        super(ShardedClientTestCase, self).tearDown()
+        self.sharded.disconnect()
+
+    def test_routing(self):
+        def on_set(result):
+            self.sharded.shards['a'].dbsize(on_a)
+        def on_a(result):
+            (_, size) = result
+            self.assertTrue(0 < size < len(self.keys))
+            self.sharded.dbsize([self.expect(len(self.keys)), self.finish])
+        for key in self.keys:
+            self.sharded.set(key, key, self.expect(True))
+        self.sharded.get(self.keys[-1], [self.expect(self.keys[-1]), on_set])
+        self.start()
+
+    def test_split_commands(self):
+        mapping = dict((key, key.upper()) for key in self.keys)
+        self.sharded.mset(mapping, self.expect(True))
+        self.sharded.mget(self.keys + ['missing'], self.expect([key.upper() for key in self.keys] + [None]))
+        self.sharded.execute_command('DEL', self.expect(True), *self.keys)
+        self.sharded.mget(self.keys, [self.expect([None] * len(self.keys)), self.finish])
+        self.start()
+
+    def test_multi_key_commands(self):
+        def on_error(result):
+            (error, _) = result
+            self.assertTrue(isinstance(error, brukva.RedisError))
+        self.sharded.sadd('{user:1}:a', 'x', self.expect(True))
+        self.sharded.sadd('{user:1}:b', 'x', self.expect(True))
+        self.sharded.sinter(['{user:1}:a', '{user:1}:b'], self.expect(set(['x'])))
+        self.sharded.sinter(self.keys, on_error)
+        self.sharded.keys('*', [self.expect(lambda keys: sorted(keys) == ['{user:1}:a', '{user:1}:b']), self.finish])
+        self.start()
+
+    def test_unsharded_commands(self):
+        errors = []
+        def on_error(result):
+            (error, _) = result
+            errors.append(error)
+        # keyless commands and pub/sub fail through the callbacks
+        self.sharded.execute_command('MULTI', on_error)
+        self.sharded.unwatch(on_error)
+        self.sharded.subscribe('foo', [on_error])
+        self.sharded.publish('foo', 'bar', on_error)
+        self.sharded.listen(on_error)
+        self.assertEqual(len(errors), 5)
+        for error in errors:
+            self.assertTrue(isinstance(error, brukva.RedisError))
+
+    def test_without_keys(self):
+        def on_error(result):
+            (error, _) = result
+            self.assertTrue(isinstance(error, brukva.RedisError))
+        self.sharded.mget([], on_error)
+        self.sharded.execute_command('DEL', [on_error, self.finish])
+        self.start()
+
+    def test_pipeline_errors(self):
+        @brukva.adisp.process
+        def run():
+            pipe = self.sharded.pipeline()
+            pipe.set(self.keys[0], 'a')
+            # not sent, failed in their place
+            pipe.sinter(self.keys)
+            pipe.keys('*')
+            pipe.mget([])
+            results = yield pipe.execute()
+            self.assertEqual(results[0], (None, True))
+            for error, _ in results[1:]:
+                self.assertTrue(isinstance(error, brukva.RedisError))
+            self.finish()
+        run()
+        self.start()
+
+    def test_transaction(self):
+        def incr(client, pipe):
+            pipe.incr(self.keys[0])
+        def on_error(result):
+            (error, _) = result
+            self.assertTrue(isinstance(error, brukva.RedisError))
+        # the keys are on both shards
+        self.sharded.transaction(incr, *self.keys, callbacks=on_error)
+        self.sharded.transaction(incr, self.keys[0], callbacks=[self.pexpect([1]), self.finish])
+        self.start()
+
+    def test_bounded(self):
+        def on_timeout(result):
+            (error, _) = result
+            self.assertTrue(isinstance(error, brukva.TimeoutError))
+        bounded = self.sharded.bounded(timeout=5)
+        self.assertEqual(bounded.get_shard(self.keys[0]).timeout, 5)
+        self.assertEqual(self.sharded.get_shard(self.keys[0]).timeout, None)
+        # the deadline has passed, nothing is sent to the shards
+        late = self.sharded.bounded(deadline=time.time() - 1)
+        late.get(self.keys[0], on_timeout)
+        late.mget(self.keys, on_timeout)
+        pipe = late.pipeline()
+        pipe.get(self.keys[0])
+        pipe.execute([lambda results: on_timeout(results[0]), self.finish])
+        self.start()
+
+    def test_scan(self):
+        keys = []
+        def on_scanned(result):
+            self.assertEqual(sorted(keys), sorted(self.keys))
+            self.sharded.scan(0, callbacks=[on_error, self.finish])
+        def on_error(result):
+            (error, _) = result
+            self.assertTrue(isinstance(error, brukva.RedisError))
+        for key in self.keys:
+            self.sharded.set(key, key, self.expect(True))
+        self.sharded.scan_iter(count=2).each(keys.extend, on_scanned)
+        self.start()
+
+    def test_scripts(self):
+        script = self.sharded.register_script("return redis.call('SET', KEYS[1], ARGV[1])")
+        results = []
+        @brukva.adisp.process
+        def run():
+            results.append((yield [script([key], [key]) for key in self.keys]))
+            results.append((yield self.sharded.mget(self.keys)))
+            results.append((yield self.sharded.script_exists([script.sha])))
+            try:
+                yield self.sharded.eval('return 1')
+            except brukva.RedisError, e:
+                results.append(e)
+            self.finish()
+        run()
+        self.start()
+        self.assertEqual(results[:3], [['OK'] * len(self.keys), self.keys, [True]])
+        self.assertTrue(isinstance(results[3], brukva.RedisError))
+
+    def test_pipeline(self):
+        pipe = self.sharded.pipeline()
+        for key in self.keys:
+            pipe.set(key, key)
+        for key in self.keys:
+            pipe.get(key)
+        pipe.execute([self.pexpect([True] * len(self.keys) + self.keys), self.finish])
+        self.start()
+        # callbacks of the commands get their results, in the order queued
+        results = []
+        pipe = self.sharded.pipeline()
+        for key in self.keys:
+            pipe.get(key, results.append)
+        pipe.execute(self.finish)
+        self.start()
+        self.assertEqual(results, [(None, key) for key in self.keys])